@@ -0,0 +1,2 @@
+# The benchmark modules import from the benchmarking directory (python -m utils.recipe_artifact);
+# pytest puts this directory on sys.path for the tests in tests/.
@@ -1,11 +1,20 @@
 import json
 
-from ollama import ChatResponse, chat
-
 from prompts.prompt_R import format_user_content, prompt_recipe
 
+SYSTEM_PROMPT = "Follow the instructions exactly. Output ONLY valid JSON, no extra text."
+OPTIONS = {"temperature": 0.5}
 
-def evaluate_recipe(
+
+def ollama_chat(model, messages, options):
+    # imported here so that the prompt and parsing helpers can be used without ollama installed
+    from ollama import ChatResponse, chat
+
+    response: ChatResponse = chat(model=model, messages=messages, options=options)
+    return response["message"]["content"]
+
+
+def build_messages(
     user_id,
     context_text,
     context_type,
@@ -13,7 +22,6 @@ def evaluate_recipe(
     title,
     ingredients,
     instructions,
-    model_name,
 ):
     prompt_r = prompt_recipe.get(context_type)
     if not prompt_r:
@@ -28,22 +36,14 @@ def evaluate_recipe(
         user_id, context_text, recipe_id, title, ingredients, instructions
     )
 
-    # send to model
-    response: ChatResponse = chat(
-        model=model_name,
-        messages=[
-            {
-                "role": "system",
-                "content": "Follow the instructions exactly. Output ONLY valid JSON, no extra text.",
-            },
-            {"role": "user", "content": prompt_text},
-            {"role": "user", "content": user_content},
-        ],
-        options={"temperature": 0.5},
-    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt_text},
+        {"role": "user", "content": user_content},
+    ]
 
-    response_text = response["message"]["content"]
 
+def parse_response(response_text):
     # check for empty response
     if not response_text or not response_text.strip():
         raise ValueError("Empty response received from the model.")
@@ -61,3 +61,35 @@ def evaluate_recipe(
             raise ValueError(
                 f"JSON not found in response. Original response: {response_text}"
             )
+
+
+def evaluate_recipe(
+    user_id,
+    context_text,
+    context_type,
+    recipe_id,
+    title,
+    ingredients,
+    instructions,
+    model_name,
+    chat=ollama_chat,
+    cache=None,
+):
+    messages = build_messages(
+        user_id, context_text, context_type, recipe_id, title, ingredients, instructions
+    )
+
+    # only responses that could be parsed are cached
+    key = cache.key("evaluate_recipe", model_name, messages, OPTIONS) if cache is not None else None
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            return parse_response(cached)
+
+    # send to model
+    response_text = chat(model_name, messages, OPTIONS)
+
+    result = parse_response(response_text)
+    if key:
+        cache.put(key, response_text)
+    return result
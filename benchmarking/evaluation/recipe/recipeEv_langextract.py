@@ -1,92 +1,21 @@
+"""
+Usage (from benchmarking/, like the other runners):
+    python -m evaluation.recipe.recipeEv_langextract --type unstructured_context --ratings ... --recipes_zip ...
+"""
 import argparse
-import ast
 import csv
 import os
 import random
 import textwrap
-import zipfile
 
 import langextract as lx
-import polars as pl
-
-
-def load_recipes_from_zip(zip_path):
-    """Apre lo ZIP, trova il file Parquet e lo carica in un DataFrame Polars."""
-    with zipfile.ZipFile(zip_path, "r") as z:
-        parquet_files = [f for f in z.namelist() if f.endswith(".parquet")]
-        if not parquet_files:
-            raise FileNotFoundError("Nessun file .parquet trovato dentro lo ZIP.")
-        parquet_file = parquet_files[0]
-        print(f"File Parquet trovato: {parquet_file}")
-        df = pl.read_parquet(z.open(parquet_file))
-    print(f"Caricate {df.shape[0]} ricette dal Parquet.")
-
-    return df
-
-
-# estrae il testo della ricetta dal DataFrame
-def get_recipe_text(df, recipe_id):
-    row_df = df.filter(pl.col("id") == int(recipe_id))
-
-    if row_df.is_empty():
-        raise ValueError(f"Ricetta {recipe_id} non trovata nel Parquet.")
-
-    try:
-        title = row_df.item(0, "name") or f"Ricetta {recipe_id}"
-    except pl.exceptions.ColumnNotFoundError:
-        title = f"Ricetta {recipe_id}"
-
-    try:
-        ingredients_data = row_df.item(0, "parsed_ingredients")
-
-        if ingredients_data is None or (
-            isinstance(ingredients_data, str) and not ingredients_data.strip()
-        ):
-            raise ValueError("Lista 'parsed_ingredients' vuota o nullo")
-
-        # Se è stringa, prova a convertire
-        if isinstance(ingredients_data, str):
-            try:
-                ingredients_list = ast.literal_eval(ingredients_data)
-            except Exception:
-                ingredients_list = [ingredients_data]
-        elif isinstance(ingredients_data, list):
-            ingredients_list = ingredients_data
-        else:
-            # Se arriva come Series o altra struttura, convertila in lista
-            ingredients_list = list(ingredients_data)
-
-        ingredients_str = ", ".join(map(str, ingredients_list))
-
-    except Exception as e:
-        raise ValueError(
-            f"Ricetta {recipe_id} ('{title}'): Impossibile parsare 'parsed_ingredients' - {e}"
-        )
 
-    try:
-        directions_data = row_df.item(0, "directions")
+from utils.recipe_artifact import load_recipe_index
 
-        if directions_data is None or (
-            isinstance(directions_data, str) and not directions_data.strip()
-        ):
-            raise ValueError("Stringa 'directions' vuota o nullo")
 
-        if isinstance(directions_data, str):
-            try:
-                directions_list = ast.literal_eval(directions_data)
-            except Exception:
-                directions_list = [directions_data]
-        elif isinstance(directions_data, list):
-            directions_list = directions_data
-        else:
-            directions_list = list(directions_data)
-
-        instructions_str = ". ".join([step for step in directions_list if step])
-
-    except Exception as e:
-        raise ValueError(
-            f"Ricetta {recipe_id} ('{title}'): Impossibile parsare 'directions' - {e}"
-        )
+# testo della ricetta come lo costruiva il loader di questo script: campi non ripuliti, titolo "Ricetta <id>"
+def format_recipe_text(recipe_id, name, ingredients_str, instructions_str):
+    title = name or f"Ricetta {recipe_id}"
 
     if not ingredients_str or not instructions_str:
         raise ValueError(
@@ -244,6 +173,11 @@ def main():
         required=True,
         help="Archivio ZIP contenente phase_recipes.parquet",
     )
+    parser.add_argument(
+        "--artifact_dir",
+        type=str,
+        help="Cartella dei testi precompilati delle ricette (default: recipe_texts/ accanto allo ZIP)",
+    )
 
     # parser.add_argument("--model", type=str, default="llama3.1:8b")
     # parser.add_argument("--model", type=str, default="qwen2.5:32b")
@@ -261,9 +195,6 @@ def main():
         f"evaluated_recipes_{args.type.lower()}_{args.model.replace(':', '_')}.csv",
     )
 
-    # Carica le ricette dal Parquet
-    recipes_df = load_recipes_from_zip(args.recipes_zip)
-
     if args.type == "unstructured_context" and not args.uc_file:
         raise ValueError("Devi passare --uc_file per il tipo 'unstructured_context'")
     if args.type == "questionnaires" and (
@@ -388,6 +319,14 @@ def main():
         random.shuffle(recipe_list)
         user_recipes[member_id] = recipe_list
 
+    # Testi delle ricette degli utenti, dall'artefatto precompilato dello ZIP (creato alla prima esecuzione)
+    recipe_index = load_recipe_index(
+        args.recipes_zip,
+        {recipe_id for user in users for recipe_id in user_recipes.get(int(user["user_id"]), [])},
+        args.artifact_dir,
+        format_recipe_text,
+    )
+
     # Crea CSV output
     with open(output_file, "w", newline="", encoding="utf-8") as f_out:
         writer = csv.writer(f_out)
@@ -418,9 +357,7 @@ def main():
                     break
 
                 try:
-                    title, ingredients_str, instructions_str = get_recipe_text(
-                        recipes_df, recipe_id
-                    )
+                    title, ingredients_str, instructions_str = recipe_index.get(recipe_id)
 
                     result = evaluate_recipe(
                         user_id,
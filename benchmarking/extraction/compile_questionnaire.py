@@ -1,11 +1,20 @@
+import json
 import re
 
 import langextract as lx
+from langextract import data_lib
 from langextract.core.exceptions import InferenceRuntimeError
 
 
 def compile_questionnaire(
-    user_id, biography_text, prompt, examples, model_name, specific_question=None
+    user_id,
+    biography_text,
+    prompt,
+    examples,
+    model_name,
+    specific_question=None,
+    specific_questions=None,
+    cache=None,
 ):
     biography_text = biography_text.replace(
         '"', "'"
@@ -31,6 +40,32 @@ def compile_questionnaire(
             "Extract the answer following the rules above. "
             "Ignore other questionnaire fields."
         )
+    elif specific_questions:
+        # several questions answered by one model call
+        questions_text = "; ".join(f"'{q}'" for q in specific_questions)
+        input_text += f" | QUESTIONS_TO_ANSWER: {questions_text}"
+
+        prompt_question = (
+            f"{prompt}\n\n"
+            f"IMPORTANT TASK: Focus ONLY on the questions: {questions_text}. "
+            "Extract one answer per question following the rules above. "
+            "Ignore other questionnaire fields."
+        )
+
+    # cached as the serialized annotated document
+    key = None
+    if cache is not None:
+        key = cache.key(
+            "compile_questionnaire",
+            model_name,
+            prompt_question,
+            input_text,
+            repr(examples),
+            {"temperature": 0.0, "format": "json"},
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            return data_lib.dict_to_annotated_document(json.loads(cached))
 
     try:
         result = lx.extract(
@@ -47,7 +82,7 @@ def compile_questionnaire(
         if "Ollama Model timed out" in str(e):
             print("Timeout rilevato. Ritento con timeout=300...")
 
-            return lx.extract(
+            result = lx.extract(
                 text_or_documents=input_text,
                 prompt_description=prompt_question,
                 examples=examples,
@@ -63,4 +98,6 @@ def compile_questionnaire(
         else:
             raise e
 
+    if key:
+        cache.put(key, json.dumps(data_lib.annotated_document_to_dict(result)))
     return result
@@ -7,7 +7,7 @@ from prompts.prompt_Q import config
 from utils.text_utils import normalize_text
 
 
-def preprocess_questionnaire(questionnaire_type, dataset_source):
+def preprocess_questionnaire(questionnaire_type, dataset_source, questionnaire_dir="questionnaires"):
     # load file in base to type
     #PER HUMMUS
     #questionnaire_file = os.path.join("questionnaires", f"./questionnaire_{questionnaire_type}.csv")
@@ -22,7 +22,7 @@ def preprocess_questionnaire(questionnaire_type, dataset_source):
     # add file extension
     filename += ".csv"
 
-    questionnaire_file = os.path.join("questionnaires", filename)
+    questionnaire_file = os.path.join(questionnaire_dir, filename)
 
     questionnaire = pd.read_csv(questionnaire_file)
 
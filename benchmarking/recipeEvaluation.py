@@ -1,13 +1,83 @@
 import argparse
 import csv
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from evaluation.recipe.evaluate_recipe import evaluate_recipe
-from evaluation.recipe.load_recipes import load_recipes_from_zip
-from utils.extract_text_recipes import get_recipe_text
+from utils.llm_cache import add_cache_arguments, open_cache
+from utils.recipe_artifact import load_recipe_index
 from utils.smart_load_data import smart_load_data
 
 
+def run_in_order(jobs, evaluate, concurrency):
+    """
+    Run evaluate(job) for every job with up to `concurrency` calls in progress,
+    yielding (job, result, error) in the order of `jobs`
+    """
+
+    def collect(job, future):
+        try:
+            return job, future.result(), None
+        except Exception as e:
+            return job, None, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append((job, executor.submit(evaluate, job)))
+            # a small look-ahead keeps every worker busy while the oldest job is awaited
+            if len(pending) >= 2 * concurrency:
+                yield collect(*pending.popleft())
+        while pending:
+            yield collect(*pending.popleft())
+
+
+OUTPUT_HEADER = ["user_id", "recipe_id", "score", "review"]
+
+
+def load_finished_rows(output_file):
+    """
+    Recipes already evaluated per user in an existing output file ({user_id: set of recipe ids}).
+    A last row cut off by an interruption is removed from the file, so it is evaluated again.
+    """
+    finished = {}
+    if not os.path.exists(output_file):
+        return finished
+
+    with open(output_file, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            f.truncate(content.rfind(b"\n") + 1)
+
+    with open(output_file, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            finished.setdefault(row["user_id"], set()).add(int(row["recipe_id"]))
+    return finished
+
+
+class DurableCsvWriter:
+    """CSV rows flushed after every write and fsynced at most every `sync_interval` seconds"""
+
+    def __init__(self, f, sync_interval=2.0):
+        self.f = f
+        self.writer = csv.writer(f)
+        self.sync_interval = sync_interval
+        self.last_sync = time.monotonic()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.f.flush()
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_sync = time.monotonic()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Rate recipes per user based on their bio or questionnaire or both."
@@ -29,6 +99,11 @@ def main():
     parser.add_argument("--questionaire_FCQ", type=str)
     parser.add_argument("--questionaire_JC", type=str)
     parser.add_argument("--recipes_zip", type=str, required=True, default="./data.zip")
+    parser.add_argument(
+        "--artifact_dir",
+        type=str,
+        help="Where the precompiled recipe texts of --recipes_zip are kept (default: recipe_texts/ next to it)",
+    )
     parser.add_argument(
         "--model",
         type=str,
@@ -52,7 +127,21 @@ def main():
     )
     parser.add_argument("--out_dir", type=str, required=True)
     parser.add_argument("--num_recipes", type=int, default=10)
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Start from scratch instead of resuming from the rows already in the output file",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Parallel requests to the model server (Ollama serves up to OLLAMA_NUM_PARALLEL at once)",
+    )
+    add_cache_arguments(parser)
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
 
     os.makedirs(args.out_dir, exist_ok=True)
     output_file = os.path.join(
@@ -60,9 +149,6 @@ def main():
         f"evaluated_recipes_{args.type.lower()}_{args.model.replace(':', '_')}.csv",
     )
 
-    # load recipes
-    recipes_df = load_recipes_from_zip(args.recipes_zip)
-
     # validate args
     if args.type == "unstructured_context" and not args.uc_file:
         raise ValueError("Devi passare --uc_file per 'unstructured_context'")
@@ -205,59 +291,103 @@ def main():
     for member_id in user_recipes:
         user_recipes[member_id] = sorted(list(user_recipes[member_id]))
 
-    # Csv output
-    with open(output_file, "w", newline="", encoding="utf-8") as f_out:
-        writer = csv.writer(f_out)
-        writer.writerow(["user_id", "recipe_id", "score", "review"])
+    if args.type in ["only_fcq", "only_jc"]:
+        type_to_pass = "questionnaires"
+    else:
+        type_to_pass = args.type
 
-        for user in users:
-            user_id = str(user["user_id"]).strip()
+    # resume: rows already written count toward each user's objective
+    if args.overwrite and os.path.exists(output_file):
+        os.remove(output_file)
+    finished = load_finished_rows(output_file)
+    if finished:
+        print(
+            f"Resuming {output_file}: {sum(len(r) for r in finished.values())} recipes "
+            f"of {len(finished)} users already evaluated"
+        )
 
-            context_text = user["context_text"]
-            recipes_to_rate = sorted(user_recipes.get(user_id, []))[: args.num_recipes]
+    # one job per (user, recipe), in the order of the output rows
+    jobs = []
+    for user in users:
+        user_id = str(user["user_id"]).strip()
+        done = finished.get(user_id, set())
+        recipes_to_rate = [
+            r for r in sorted(user_recipes.get(user_id, [])) if r not in done
+        ][: max(args.num_recipes - len(done), 0)]
 
-            if not recipes_to_rate:
+        if not recipes_to_rate:
+            if not done:
                 print(f"No recipe to evaluate for{user_id}")
-                continue
+            continue
 
-            successful_recipes_count = 0
-            print(f"\nUser {user_id}: Start evaluation (Objective: {args.num_recipes})")
+        for recipe_id in recipes_to_rate:
+            jobs.append((user_id, user["context_text"], recipe_id))
 
-            for recipe_id in recipes_to_rate:
-                if successful_recipes_count >= args.num_recipes:
-                    break
-                try:
-                    title, ingredients_str, instructions_str = get_recipe_text(
-                        recipes_df, recipe_id
-                    )
-                    print(f"Recipe development {recipe_id}", end=" ", flush=True)
-
-                    if args.type in ["only_fcq", "only_jc"]:
-                        type_to_pass = "questionnaires"
-                    else:
-                        type_to_pass = args.type
-
-                    result = evaluate_recipe(
-                        user_id,
-                        context_text,
-                        type_to_pass,
-                        recipe_id,
-                        title,
-                        ingredients_str,
-                        instructions_str,
-                        args.model,
-                    )
-                    score = result.get("score", "Unknown")
-                    short_review = result.get("short_review", "Unknown")
-                    writer.writerow([user_id, recipe_id, score, short_review])
-                    successful_recipes_count += 1
-                    print(
-                        f"User {user_id}: Recipe {recipe_id} evaluated ({successful_recipes_count}/{args.num_recipes})"
-                    )
-                except Exception as e:
-                    print(f"Error {user_id}/{recipe_id}: {e}")
-                    continue
+    # texts of the scheduled recipes, from the precompiled artifact of the ZIP (built on the first run)
+    recipe_index = load_recipe_index(args.recipes_zip, {job[2] for job in jobs}, args.artifact_dir)
+
+    def evaluate_job(job):
+        user_id, context_text, recipe_id = job
+        title, ingredients_str, instructions_str = recipe_index.get(recipe_id)
+        return evaluate_recipe(
+            user_id,
+            context_text,
+            type_to_pass,
+            recipe_id,
+            title,
+            ingredients_str,
+            instructions_str,
+            args.model,
+            cache=cache,
+        )
 
+    cache = open_cache(args)
+
+    # Csv output, written by this thread only and in job order
+    start_time = time.perf_counter()
+    successful_recipes_count = {}
+    errors = 0
+    new_file = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
+    with open(output_file, "a", newline="", encoding="utf-8") as f_out:
+        writer = DurableCsvWriter(f_out)
+        if new_file:
+            writer.writerow(OUTPUT_HEADER)
+
+        for (user_id, _, recipe_id), result, error in run_in_order(
+            jobs, evaluate_job, args.concurrency
+        ):
+            if user_id not in successful_recipes_count:
+                successful_recipes_count[user_id] = len(finished.get(user_id, ()))
+                print(
+                    f"\nUser {user_id}: Start evaluation (Objective: {args.num_recipes}, "
+                    f"already evaluated: {successful_recipes_count[user_id]})"
+                )
+
+            if error is not None:
+                errors += 1
+                print(f"Error {user_id}/{recipe_id}: {error}")
+                continue
+
+            score = result.get("score", "Unknown")
+            short_review = result.get("short_review", "Unknown")
+            writer.writerow([user_id, recipe_id, score, short_review])
+            successful_recipes_count[user_id] += 1
+            print(
+                f"User {user_id}: Recipe {recipe_id} evaluated ({successful_recipes_count[user_id]}/{args.num_recipes})"
+            )
+        writer.sync()
+
+    elapsed = time.perf_counter() - start_time
+    evaluated = sum(successful_recipes_count.values()) - sum(
+        len(finished.get(user_id, ())) for user_id in successful_recipes_count
+    )
+    print(
+        f"\n{evaluated} recipes evaluated ({errors} errors) in {elapsed:.1f}s: "
+        f"{evaluated / elapsed if elapsed else 0:.2f} recipes/s with concurrency {args.concurrency}"
+    )
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
     print(f"\nAll evaluations completed. File saved in: {output_file}")
 
 
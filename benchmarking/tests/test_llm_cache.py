@@ -0,0 +1,49 @@
+from utils.llm_cache import LLMCache
+
+
+def test_responses_round_trip_and_persist(tmp_path):
+    path = str(tmp_path / "cache" / "llm.sqlite")
+    cache = LLMCache(path)
+    key = LLMCache.key("model", "system prompt", "user content", {"temperature": 0})
+
+    assert cache.get(key) is None
+    cache.put(key, "réponse")
+    assert cache.get(key) == "réponse"
+    cache.close()
+
+    reopened = LLMCache(path)
+    assert reopened.get(key) == "réponse"
+    assert "1 hits, 0 misses" in reopened.summary()
+    reopened.close()
+
+
+def test_key_depends_on_every_part():
+    assert LLMCache.key("model", {"a": 1, "b": 2}) == LLMCache.key("model", {"b": 2, "a": 1})
+    assert LLMCache.key("model", "prompt") != LLMCache.key("other model", "prompt")
+    assert LLMCache.key("model", object) == LLMCache.key("model", object)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.sqlite"), max_bytes=256 * 1024)
+    cache.put("first", "x" * 2000)
+    for i in range(500):
+        cache.get("first")
+        cache.put(f"key-{i}", "y" * 2000)
+
+    assert cache.evicted > 0
+    assert cache._used_bytes() <= cache.max_bytes
+    assert cache.get("first") is not None
+    assert cache.get("key-0") is None
+    assert cache.get("key-499") is not None
+    cache.close()
+
+
+def test_limit_holds_across_caches_sharing_the_file(tmp_path):
+    path = str(tmp_path / "llm.sqlite")
+    caches = [LLMCache(path, max_bytes=256 * 1024) for _ in range(2)]
+    for i in range(400):
+        caches[i % 2].put(f"key-{i}", "z" * 2000)
+
+    for cache in caches:
+        assert cache._used_bytes() <= cache.max_bytes
+        cache.close()
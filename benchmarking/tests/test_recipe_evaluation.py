@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip("pandas")  # recipeEvaluation imports the data loaders
+
+from recipeEvaluation import load_finished_rows  # noqa: E402
+
+
+def test_missing_output_file_has_no_finished_rows(tmp_path):
+    assert load_finished_rows(str(tmp_path / "results.csv")) == {}
+
+
+def test_finished_rows_are_grouped_by_user(tmp_path):
+    output_file = tmp_path / "results.csv"
+    output_file.write_text(
+        "user_id,recipe_id,score,review\nu1,10,4,good\nu1,11,3,ok\nu2,10,5,great\n", encoding="utf-8"
+    )
+
+    assert load_finished_rows(str(output_file)) == {"u1": {10, 11}, "u2": {10}}
+
+
+def test_a_row_cut_off_by_an_interruption_is_removed(tmp_path):
+    output_file = tmp_path / "results.csv"
+    output_file.write_bytes(b'user_id,recipe_id,score,review\nu1,10,4,good\nu1,11,3,"cut')
+
+    assert load_finished_rows(str(output_file)) == {"u1": {10}}
+    assert output_file.read_bytes() == b"user_id,recipe_id,score,review\nu1,10,4,good\n"
@@ -7,6 +7,7 @@ import pandas as pd
 
 from extraction.compile_questionnaire import compile_questionnaire
 from preprocessing.preprocess_questionnaire import preprocess_questionnaire
+from utils.llm_cache import add_cache_arguments, open_cache
 from utils.text_utils import normalize_text
 
 # logging.basicConfig(level=logging.DEBUG)
@@ -33,6 +34,7 @@ def main():
     parser.add_argument("--out_dir", type=str, default="./data/hummus/structured_context_output/")
     parser.add_argument("--overwrite", action="store_true", help="Se attivo, sovrascrive il file di output esistente.")
     parser.add_argument("--dataset", type=str, choices=["hummus", "prolific"])
+    add_cache_arguments(parser)
     args = parser.parse_args()
 
     output_file = os.path.join(
@@ -83,6 +85,7 @@ def main():
     print(f"Users to process: {to_process}")
 
     prompt, examples, questionnaire_df = preprocess_questionnaire(args.type, dataset_source=args.dataset)
+    cache = open_cache(args)
 
     # iterates the users to process
     for _, user_context_row in unstructured_context.iterrows():
@@ -103,6 +106,7 @@ def main():
                     examples,
                     args.model,
                     specific_question=question,
+                    cache=cache,
                 )
 
                 if not compile_csv.extractions:
@@ -161,6 +165,9 @@ def main():
         print(f"Success with user {user_id}")
 
     print(f"\nAll compilations completed. Saved to {output_file}")
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
     # Write the json file and create the HTML view
     if all_processed_documents:
         print("\nSaving annotated documents for viewing")
@@ -5,40 +5,29 @@ import polars as pl
 from utils.text_utils import clean_text
 
 
-# extracts the recipe text from the DataFrame
-def get_recipe_text(df, recipe_id):
-    row_df = df.filter(pl.col("id") == int(recipe_id))
-
-    if row_df.is_empty():
-        raise ValueError(f"Recipe {recipe_id} not found in Parquet.")
-
+def _as_list(data):
+    # if is string, try to eval as list
+    if isinstance(data, str):
+        try:
+            return ast.literal_eval(data)
+        except Exception:
+            return [data]
+    elif isinstance(data, list):
+        return data
+    else:
+        # if arrives as Series or other structure, convert to list
+        return list(data)
+
+
+# joins the ingredients and directions of a recipe row, without cleaning them
+def recipe_fields_from_row(recipe_id, title, ingredients_data, directions_data):
     try:
-        title = row_df.item(0, "name") or f"Recipe {recipe_id}"
-    except pl.exceptions.ColumnNotFoundError:
-        title = f"Recipe {recipe_id}"
-
-    try:
-        ingredients_data = row_df.item(0, "parsed_ingredients")
-
         if ingredients_data is None or (
             isinstance(ingredients_data, str) and not ingredients_data.strip()
         ):
             raise ValueError("List 'parsed_ingredients' empty or null")
 
-        # if is string, try to eval as list
-        if isinstance(ingredients_data, str):
-            try:
-                ingredients_list = ast.literal_eval(ingredients_data)
-            except Exception:
-                ingredients_list = [ingredients_data]
-        elif isinstance(ingredients_data, list):
-            ingredients_list = ingredients_data
-        else:
-            # if arrives as Series or other structure, convert to list
-            ingredients_list = list(ingredients_data)
-
-        ingredients_str = ", ".join(map(str, ingredients_list))
-        ingredients_str = clean_text(ingredients_str)
+        ingredients_str = ", ".join(map(str, _as_list(ingredients_data)))
 
     except Exception as e:
         raise ValueError(
@@ -46,32 +35,27 @@ def get_recipe_text(df, recipe_id):
         )
 
     try:
-        directions_data = row_df.item(0, "directions")
-
         if directions_data is None or (
             isinstance(directions_data, str) and not directions_data.strip()
         ):
             raise ValueError("String 'directions' empty or null")
 
-        if isinstance(directions_data, str):
-            try:
-                directions_list = ast.literal_eval(directions_data)
-            except Exception:
-                directions_list = [directions_data]
-        elif isinstance(directions_data, list):
-            directions_list = directions_data
-        else:
-            directions_list = list(directions_data)
-
+        directions_list = _as_list(directions_data)
         instructions_str = ". ".join([step for step in directions_list if step])
-        instructions_str = clean_text(instructions_str)
 
     except Exception as e:
         raise ValueError(
             f"Recipe {recipe_id} ('{title}'): Impossible to parse 'directions' - {e}"
         )
 
-    title = clean_text(title)
+    return ingredients_str, instructions_str
+
+
+# builds the cleaned recipe text from the joined fields of a recipe
+def recipe_text_from_fields(recipe_id, name, ingredients_str, instructions_str):
+    title = clean_text(name or f"Recipe {recipe_id}")
+    ingredients_str = clean_text(ingredients_str)
+    instructions_str = clean_text(instructions_str)
 
     if not ingredients_str:  # or not instructions_str:
         raise ValueError(
@@ -79,3 +63,58 @@ def get_recipe_text(df, recipe_id):
         )
 
     return title, ingredients_str, instructions_str
+
+
+class RecipeTextIndex:
+    """
+    Texts of the recipes a run needs, built once and looked up by id.
+
+    The needed ids are joined with the precompiled recipe fields (utils/recipe_artifact.py) in one pass,
+    instead of a filter over the whole recipe DataFrame per lookup, and `format_text` turns the fields of
+    each recipe into the (title, ingredients, instructions) of the runner's prompts.
+    """
+
+    def __init__(self, texts, errors=None, missing=0):
+        self._texts = texts
+        self._errors = errors or {}
+        self.missing = missing
+
+    @classmethod
+    def from_fields(cls, fields_df, recipe_ids, format_text=recipe_text_from_fields):
+        ids = pl.DataFrame(
+            {"id": sorted({int(recipe_id) for recipe_id in recipe_ids})},
+            schema={"id": fields_df.schema["id"]},
+        )
+        needed = fields_df.select("id", "name", "ingredients", "instructions", "error").join(
+            ids, on="id", how="semi"
+        )
+
+        texts, errors = {}, {}
+        for recipe_id, name, ingredients, instructions, error in needed.iter_rows():
+            if error is not None:
+                # recipes that could not be parsed when the artifact was built
+                errors[recipe_id] = error
+                continue
+            try:
+                texts[recipe_id] = format_text(recipe_id, name, ingredients, instructions)
+            except ValueError as e:
+                errors[recipe_id] = str(e)
+        return cls(texts, errors, ids.height - needed.height)
+
+    def get(self, recipe_id):
+        recipe_id = int(recipe_id)
+        text = self._texts.get(recipe_id)
+        if text is not None:
+            return text
+        if recipe_id in self._errors:
+            raise ValueError(self._errors[recipe_id])
+        raise ValueError(f"Recipe {recipe_id} not found in Parquet.")
+
+    def summary(self):
+        return (
+            f"{len(self._texts)} recipe texts, {len(self._errors)} recipes could not be parsed, "
+            f"{self.missing} not found"
+        )
+
+    def __len__(self):
+        return len(self._texts)
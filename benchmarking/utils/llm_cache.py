@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    """
+    Disk cache of LLM responses in SQLite (WAL mode, so several runs can share the file).
+
+    Entries are keyed by a hash of everything that determines the response (model, prompts, user content,
+    options); the least recently used ones are evicted once the database holds more than `max_bytes`. The size
+    is read from the database itself (its pages in use), so the limit holds across the processes sharing it.
+    """
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key(*parts):
+        """Hash of JSON-serializable parts (non-serializable values are hashed through their repr)"""
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=repr)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now),
+            )
+            self.stored += 1
+            if self._used_bytes() > self.max_bytes:
+                self._evict()
+
+    def _used_bytes(self):
+        # pages in use by the database as every process sees it (free pages are reused, not counted)
+        page_count = self._db.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def _evict(self):
+        # under self._lock: drop least recently used entries down to 90% of the limit. The write lock is
+        # taken before measuring, so that two processes over the limit do not both evict.
+        target = self.max_bytes * 0.9
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            excess = self._used_bytes() - target
+            freed_keys = []
+            for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                if excess <= 0:
+                    break
+                freed_keys.append((key,))
+                excess -= size
+            self._db.executemany("DELETE FROM responses WHERE key = ?", freed_keys)
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self.evicted += len(freed_keys)
+
+    def summary(self):
+        with self._lock:
+            size = self._used_bytes()
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        return (
+            f"LLM cache {self.path}: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+            f"{self.stored} stored, {self.evicted} evicted, {size / 1024 / 1024:.1f} MB"
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_cache(args):
+    """LLMCache of the --cache_file / --cache_max_mb / --no_cache options, or None"""
+    if args.no_cache:
+        return None
+    return LLMCache(args.cache_file, args.cache_max_mb * 1024 * 1024)
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default="./llm_cache.sqlite",
+        help="SQLite cache of LLM responses, reused across runs",
+    )
+    parser.add_argument("--cache_max_mb", type=int, default=1024)
+    parser.add_argument("--no_cache", action="store_true", help="Always call the model")
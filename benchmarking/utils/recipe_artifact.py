@@ -0,0 +1,141 @@
+"""
+Precompiled recipe texts.
+
+The recipe ZIP is read and the ingredients and directions of every recipe are parsed and joined once
+(recipe_fields_from_row), then written as an Arrow IPC file with only id, name, ingredients, instructions,
+error (why a recipe could not be parsed, null otherwise) and token_length. The benchmark runners open that
+file memory-mapped instead of extracting the Parquet from the ZIP on every run. The fields are stored as
+parsed, not cleaned: each runner formats the texts of its prompts itself (RecipeTextIndex.from_fields).
+
+The file name carries a hash of the ZIP, so a changed ZIP gets a new artifact; the hash is recomputed only
+when the ZIP's size or modification time changes.
+
+Usage:
+    python -m utils.recipe_artifact --recipes_zip ./data.zip [--artifact_dir DIR] [--force]
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import polars as pl
+
+from evaluation.recipe.load_recipes import load_recipes_from_zip
+from utils.extract_text_recipes import RecipeTextIndex, recipe_fields_from_row, recipe_text_from_fields
+
+# bump when the parsing or cleaning of recipe texts changes, so existing artifacts are rebuilt
+ARTIFACT_VERSION = 2
+
+
+def zip_digest(zip_path):
+    """SHA-256 of the ZIP, cached in a sidecar file next to it while its size and mtime are unchanged"""
+    stat = os.stat(zip_path)
+    stamp_path = zip_path + ".sha256.json"
+    try:
+        with open(stamp_path, encoding="utf-8") as f:
+            stamp = json.load(f)
+        if stamp["size"] == stat.st_size and stamp["mtime_ns"] == stat.st_mtime_ns:
+            return stamp["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    sha = hashlib.sha256()
+    with open(zip_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    try:
+        with open(stamp_path, "w", encoding="utf-8") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}, f)
+    except OSError:
+        pass  # read-only data directory: hash again next time
+    return digest
+
+
+def artifact_path(zip_path, artifact_dir=None):
+    artifact_dir = artifact_dir or os.path.join(os.path.dirname(os.path.abspath(zip_path)), "recipe_texts")
+    return os.path.join(artifact_dir, f"recipe_texts_v{ARTIFACT_VERSION}_{zip_digest(zip_path)[:16]}.arrow")
+
+
+def build_artifact(zip_path, path):
+    start = time.perf_counter()
+    df = load_recipes_from_zip(zip_path)
+    columns = ["id", "parsed_ingredients", "directions"] + (["name"] if "name" in df.columns else [])
+
+    rows = {"id": [], "name": [], "ingredients": [], "instructions": [], "error": []}
+    failed = 0
+    for row in df.select(columns).iter_rows(named=True):
+        recipe_id, name = row["id"], row.get("name")
+        try:
+            ingredients, instructions = recipe_fields_from_row(
+                recipe_id, name or f"Recipe {recipe_id}", row["parsed_ingredients"], row["directions"]
+            )
+            error = None
+        except ValueError as e:
+            ingredients = instructions = None
+            error = str(e)
+            failed += 1
+        rows["id"].append(recipe_id)
+        rows["name"].append(name)
+        rows["ingredients"].append(ingredients)
+        rows["instructions"].append(instructions)
+        rows["error"].append(error)
+    del df
+
+    fields = pl.DataFrame(
+        rows,
+        schema={"id": pl.Int64, "name": pl.Utf8, "ingredients": pl.Utf8, "instructions": pl.Utf8, "error": pl.Utf8},
+    )
+    # whitespace tokens of the whole recipe text, an estimate of the prompt size
+    fields = fields.with_columns(
+        pl.concat_str(["name", "ingredients", "instructions"], separator=" ", ignore_nulls=True)
+        .str.count_matches(r"\S+")
+        .cast(pl.Int32)
+        .alias("token_length")
+    ).sort("id")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    fields.write_ipc(tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+    print(
+        f"Recipe texts artifact {path}: {fields.height} recipes ({failed} could not be parsed) "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def open_recipe_fields(zip_path, artifact_dir=None):
+    """Memory-mapped recipe fields of a recipe ZIP, building the artifact on first use"""
+    path = artifact_path(zip_path, artifact_dir)
+    if not os.path.exists(path):
+        print(f"No recipe texts artifact for {zip_path} yet, building it")
+        build_artifact(zip_path, path)
+    fields = pl.read_ipc(path)  # uncompressed IPC files are memory-mapped by polars
+    print(f"Loaded {fields.height} recipes from {path}")
+    return fields
+
+
+def load_recipe_index(zip_path, recipe_ids, artifact_dir=None, format_text=recipe_text_from_fields):
+    """RecipeTextIndex of the given recipes, from the artifact of the ZIP"""
+    index = RecipeTextIndex.from_fields(open_recipe_fields(zip_path, artifact_dir), recipe_ids, format_text)
+    print(f"Indexed {index.summary()}")
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the precompiled recipe texts of a recipe ZIP.")
+    parser.add_argument("--recipes_zip", type=str, required=True)
+    parser.add_argument("--artifact_dir", type=str, help="Defaults to recipe_texts/ next to the ZIP")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the artifact exists")
+    args = parser.parse_args()
+
+    path = artifact_path(args.recipes_zip, args.artifact_dir)
+    if os.path.exists(path) and not args.force:
+        print(f"Recipe texts artifact already built: {path}")
+        return
+    build_artifact(args.recipes_zip, path)
+
+
+if __name__ == "__main__":
+    main()
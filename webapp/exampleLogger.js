@@ -1,11 +1,13 @@
 import { ref } from 'vue'
 import axios from 'axios'
 import { useRecaptcha } from './useRecaptcha'
+import { newEventId } from './src/api.js'
 
 
 const logs_url = import.meta.env.VITE_API_URL ? `${import.meta.env.VITE_API_URL}/logs` : "http://localhost:3000/server/api/logs"
 const RECAPTCHA_V3_SITE_KEY = import.meta.env.VITE_RECAPTCHA_V3_SITE_KEY || ''
 const RECAPTCHA_V2_SITE_KEY = import.meta.env.VITE_RECAPTCHA_V2_SITE_KEY || ''
+const MAX_LOG_ATTEMPTS = 3
 const MAX_RECAPTCHA_CHECKS = parseInt(import.meta.env.VITE_MAX_RECAPTCHA_CHECKS || '5')
 const RECAPTCHA_TARGET_EVENTS = (import.meta.env.VITE_RECAPTCHA_TARGET_EVENTS || 'static-context-submitted,questionnaires-submitted,recipe-ratings-static-submitted').split(',').map(e => e.trim())
 
@@ -69,7 +71,8 @@ export function useActivityLogger(focusMonitor, fromProlific = true) {
         let enriched_data = {
             ...data,
             type: type,
-            user_id: sessionStorage.getItem("uuid")
+            user_id: sessionStorage.getItem("uuid"),
+            event_id: newEventId() // reused by retries, so the server stores the event once
         }
 
         // Get reCAPTCHA token on specific events + random 1% (unless beta passkey provided)
@@ -109,8 +112,10 @@ export function useActivityLogger(focusMonitor, fromProlific = true) {
 
     const processQueue = async () => {
         isProcessing.value = true
+        let attempts = 0
         while (requestQueue.value.length > 0) {
             const data = requestQueue.value[0] // Don't shift yet, in case we need to retry
+            attempts++
             try {
                 const response = await axios.post(logs_url, data)
                 // V2 CAPTCHA verification (unless beta passkey provided)
@@ -131,9 +136,15 @@ export function useActivityLogger(focusMonitor, fromProlific = true) {
                     }
                 }
                 requestQueue.value.shift() // Remove the processed request
+                attempts = 0
             } catch (error) {
                 console.error('Error logging data:', error)
-                requestQueue.value.shift() // Remove failed request to prevent infinite retry
+                // Retry timeouts and network errors with the same event_id; drop the request after
+                // an error response or too many attempts to prevent infinite retry
+                if (error.response || attempts >= MAX_LOG_ATTEMPTS) {
+                    requestQueue.value.shift()
+                    attempts = 0
+                }
             }
         }
         isProcessing.value = false
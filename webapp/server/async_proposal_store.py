@@ -0,0 +1,121 @@
+"""
+aiomysql counterparts of the proposal_store operations used while serving requests.
+
+The statements and the decisions between them (which candidates to try, how completions and expired leases
+change the counts) are those of proposal_store, see there for how the counts are kept; only the driver calls
+are awaited here. Schema migrations and the one-time rebuild of the counts are not duplicated: the async server
+runs the synchronous versions once at startup.
+"""
+import logging
+from collections import Counter
+from datetime import datetime
+
+import pymysql
+
+from proposal_store import (ADD_COUNTS, DEACTIVATE_LEASE, DELETE_USER_LEASES, INSERT_COMPLETION, INSERT_LEASES,
+                            INSERT_PROPOSALS, INSERT_RECIPE_ROW, LOCK_CONFLICT_ERRNOS, RELEASE_LEASES, RESERVE,
+                            SELECT_COMPLETION, SELECT_EXPIRED_LEASES, SELECT_PROPOSAL_COUNTS, SELECT_USER_LEASES,
+                            Reservation, completion_counts, count_params, release_params, reservation_column)
+
+logger = logging.getLogger(__name__)
+
+
+async def _add_counts(cursor, column, counts):
+    if counts:
+        await cursor.executemany(ADD_COUNTS[column], count_params(counts))
+
+
+async def _release_leases(cursor, counts):
+    if counts:
+        await cursor.executemany(RELEASE_LEASES, release_params(counts))
+
+
+async def ensure_recipe_rows(cnx, recipe_ids):
+    async with cnx.cursor() as cursor:
+        await cursor.executemany(INSERT_RECIPE_ROW, [(str(recipe_id),) for recipe_id in recipe_ids])
+    await cnx.commit()
+
+
+async def reserve_recipes(cnx, user_id, candidate_ids, k, max_proposals, lease_minutes, fetched_at=None, attempts=3):
+    """Same as proposal_store.reserve_recipes"""
+    fetched_at = fetched_at or datetime.now().replace(microsecond=0)
+
+    for attempt in range(attempts):
+        try:
+            async with cnx.cursor() as cursor:
+                await cursor.execute(SELECT_COMPLETION, (user_id,))
+                column = reservation_column(await cursor.fetchone() is not None)
+
+                reservation = Reservation(candidate_ids, k)
+                for round_ids in reservation.rounds():
+                    for recipe_id in round_ids:
+                        await cursor.execute(RESERVE[column], (recipe_id, max_proposals))
+                        if cursor.rowcount == 1:
+                            reservation.reserved.add(recipe_id)
+
+                reserved_ids = reservation.reserved_ids()
+                if reserved_ids and column == 'leased':
+                    await cursor.executemany(INSERT_LEASES,
+                                             [(user_id, recipe_id, lease_minutes) for recipe_id in reserved_ids])
+                if reserved_ids:
+                    await cursor.executemany(INSERT_PROPOSALS,
+                                             [(user_id, recipe_id, fetched_at) for recipe_id in reserved_ids])
+            await cnx.commit()
+            return reserved_ids
+        except pymysql.err.OperationalError as e:
+            await cnx.rollback()
+            if e.args[0] not in LOCK_CONFLICT_ERRNOS or attempt == attempts - 1:
+                raise
+            logger.warning(f"Retrying recipe reservation for {user_id} after lock conflict: {e}")
+        except Exception:
+            await cnx.rollback()
+            raise
+
+
+async def record_study_completed(cnx, user_id):
+    """Same as proposal_store.record_study_completed"""
+    if not user_id:
+        return
+
+    try:
+        async with cnx.cursor() as cursor:
+            await cursor.execute(INSERT_COMPLETION, (user_id,))
+            if cursor.rowcount == 0:
+                await cnx.commit()
+                return
+
+            await cursor.execute(SELECT_USER_LEASES, (user_id,))
+            completed_counts, released_counts = completion_counts(await cursor.fetchall())
+            await _add_counts(cursor, 'completed', completed_counts)
+            await _release_leases(cursor, released_counts)
+            await cursor.execute(DELETE_USER_LEASES, (user_id,))
+        await cnx.commit()
+    except Exception:
+        await cnx.rollback()
+        raise
+
+
+async def expire_proposal_leases(cnx):
+    """Same as proposal_store.expire_proposal_leases"""
+    try:
+        async with cnx.cursor() as cursor:
+            await cursor.execute(SELECT_EXPIRED_LEASES)
+            expired = await cursor.fetchall()
+            if expired:
+                await cursor.executemany(DEACTIVATE_LEASE, [(lease_id,) for lease_id, _ in expired])
+                await _release_leases(cursor, Counter(recipe_id for _, recipe_id in expired))
+        await cnx.commit()
+        return len(expired)
+    except Exception:
+        await cnx.rollback()
+        raise
+
+
+async def read_proposal_counts(cnx):
+    """Same as proposal_store.read_proposal_counts"""
+    async with cnx.cursor() as cursor:
+        await cursor.execute(SELECT_PROPOSAL_COUNTS)
+        rows = await cursor.fetchall()
+    # End the read-only transaction so the next refresh sees fresh counts
+    await cnx.commit()
+    return {recipe_id: int(count) for recipe_id, count in rows}
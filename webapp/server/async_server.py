@@ -0,0 +1,775 @@
+"""
+Asyncio variant of the study server (aiohttp + aiomysql).
+
+Serves /server/api/logs, /logs/batch, /recipes and /study/complete with the same JSON contracts as the
+Flask app, but a request waiting on MySQL or on reCAPTCHA no longer holds one of a fixed number of
+threads: thousands of participants can be in flight on one event loop, bounded only by ASYNC_DB_POOL_SIZE
+connections. The recipe catalog, the recipe sampler and its refresh state, the reCAPTCHA caches and the
+configuration are shared with production_server; schema migrations and the one-time rebuild of the
+proposal counts run with the synchronous driver in a worker thread.
+
+Started with `python server/production_server.py --mode async`.
+"""
+import asyncio
+import hmac
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+import aiohttp
+import aiomysql
+import pymysql
+import simplejson as json
+from aiohttp import web
+from pydantic import ValidationError
+
+import async_proposal_store
+from log_sink import (CLAIM_EVENT_ID, INSERT_ACTIVITY_LOG, PRUNE_BATCH_SIZE, PRUNE_EVENT_IDS, ROW_DATA_ERRNOS,
+                      new_event_rows, select_claimed_ids)
+from metrics import Registry
+from response_compression import compress_body, compressible
+
+logger = logging.getLogger(__name__)
+
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", 20))
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'OPTIONS, GET, POST',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+_STOP = object()
+
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=json.dumps)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Request latency and counts in the same metrics as the Flask server's after_request hook"""
+    server = request.app['state'].server
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        server.request_duration.observe(time.perf_counter() - started_at, (route, request.method))
+        server.request_count.inc(1, (route, request.method, status))
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """Same compression as the Flask server (see response_compression)"""
+    response = await handler(request)
+    server = request.app['state'].server
+    if (server.COMPRESSION_ENABLED and isinstance(response, web.Response) and isinstance(response.body, bytes)
+            and 'Content-Encoding' not in response.headers and compressible(response.content_type, response.status)):
+        response.headers['Vary'] = 'Accept-Encoding'
+        body, encoding = compress_body(response.body, request.headers.get('Accept-Encoding'),
+                                       server.COMPRESSION_MIN_BYTES)
+        if encoding is not None:
+            response.body = body
+            response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def is_row_data_error(error):
+    """pymysql counterpart of log_sink.is_row_data_error"""
+    if isinstance(error, (pymysql.err.DataError, pymysql.err.IntegrityError)):
+        return True
+    if isinstance(error, pymysql.err.MySQLError):
+        return bool(error.args) and error.args[0] in ROW_DATA_ERRNOS
+    return isinstance(error, (TypeError, ValueError))
+
+
+class AsyncActivityLogSink:
+    """Event-loop counterpart of log_sink.ActivityLogSink: one writer task inserting batches"""
+
+    def __init__(self, max_queue=10000, batch_size=200, flush_interval=0.5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.pool = None
+        self._queue = None
+        self._task = None
+        self.written = 0
+        self.duplicates = 0
+        self.failed = 0
+
+    def start(self, pool):
+        self.pool = pool
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _insert(self, rows):
+        """Insert rows in one transaction, skipping events whose event_id is already stored"""
+        async with self.pool.acquire() as cnx:
+            try:
+                async with cnx.cursor() as cursor:
+                    ids = list(dict.fromkeys(row[0] for row in rows if row[0] is not None))
+                    claimed = []
+                    if ids:
+                        token = uuid.uuid4().hex
+                        await cursor.executemany(CLAIM_EVENT_ID, [(event_id, token) for event_id in ids])
+                        await cursor.execute(select_claimed_ids(len(ids)), ids + [token])
+                        claimed = [row[0] for row in await cursor.fetchall()]
+                    new_rows = new_event_rows(rows, claimed)
+                    if new_rows:
+                        await cursor.executemany(INSERT_ACTIVITY_LOG, new_rows)
+                await cnx.commit()
+            except Exception:
+                await cnx.rollback()
+                raise
+        self.written += len(new_rows)
+        self.duplicates += len(rows) - len(new_rows)
+
+    async def write(self, rows):
+        """Write rows now. Returns True if every row was stored; rows MySQL rejects are dropped one by one."""
+        try:
+            await self._insert(rows)
+            return True
+        except Exception as e:
+            if len(rows) > 1 and is_row_data_error(e):
+                logger.warning(f"Activity log batch of {len(rows)} rows rejected, writing them one by one: {e}")
+                return await self._write_each(rows)
+            self.failed += len(rows)
+            logger.error(f"Failed to write {len(rows)} activity log rows: {e}")
+            return False
+
+    async def _write_each(self, rows):
+        stored = True
+        for i, row in enumerate(rows):
+            try:
+                await self._insert([row])
+            except Exception as e:
+                stored = False
+                if is_row_data_error(e):
+                    self.failed += 1
+                    logger.error(f"Dropping activity log of user {row[1]} ({row[2]}) rejected by MySQL: {e}")
+                    continue
+                self.failed += len(rows) - i
+                logger.error(f"Failed to write {len(rows) - i} activity log rows: {e}")
+                break
+        return stored
+
+    async def submit(self, row):
+        """Queue a row; returns False if the queue was full and writing the row directly failed"""
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except asyncio.QueueFull:
+            # Back-pressure: this request writes its own row instead of growing the queue
+            return await self.write([row])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self._queue.get()
+            if row is _STOP:
+                return
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is _STOP:
+                    stop = True
+                    break
+                batch.append(row)
+            await self.write(batch)
+            if stop:
+                return
+
+    async def shutdown(self):
+        if self._task is not None:
+            await self._queue.put(_STOP)
+            await self._task
+            self._task = None
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+class AsyncServerState:
+    def __init__(self, server):
+        self.server = server
+        self.pool = None
+        self.http = None
+        self.log_sink = AsyncActivityLogSink(
+            max_queue=int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+            batch_size=int(os.getenv("LOG_BATCH_SIZE", 200)),
+            flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", 0.5))
+        )
+        self.init_lock = asyncio.Lock()
+        self.sampler_lock = asyncio.Lock()
+        self.warm_up_task = None
+        self.metrics = self._create_metrics()
+
+    def _create_metrics(self):
+        """Metrics of the components the threaded server does not use, rendered after the shared ones"""
+        metrics = Registry()
+        metrics.callback('study_async_activity_log_queue_depth', 'Activity log rows waiting for the writer task',
+                         self.log_sink.depth)
+        metrics.callback('study_async_activity_log_rows_written_total', 'Activity log rows written by the writer task',
+                         lambda: self.log_sink.written, kind='counter')
+        metrics.callback('study_async_activity_log_rows_failed_total',
+                         'Activity log rows the writer task failed to write',
+                         lambda: self.log_sink.failed, kind='counter')
+        metrics.callback('study_async_log_duplicate_events_total',
+                         'Repeated events (same event_id) the writer task did not store again',
+                         lambda: self.log_sink.duplicates, kind='counter')
+        metrics.callback('study_async_db_pool_size', 'Connections allowed in the aiomysql pool',
+                         lambda: self.pool.maxsize if self.pool is not None else 0)
+        metrics.callback('study_async_db_pool_in_use', 'Connections checked out of the aiomysql pool',
+                         lambda: self.pool.size - self.pool.freesize if self.pool is not None else 0)
+        return metrics
+
+
+def prepare_proposal_store(server):
+    """Migrations and the first proposal count rebuild, with the synchronous driver (runs in a worker thread)"""
+    cnx = server.create_db_connection(server.DB_NAME)
+    try:
+        server.init_proposal_store(cnx)
+    finally:
+        cnx.close()
+
+
+async def ensure_proposal_store(state):
+    if state.server.proposal_store_ready:
+        return
+    async with state.init_lock:
+        if not state.server.proposal_store_ready:
+            await asyncio.get_running_loop().run_in_executor(None, prepare_proposal_store, state.server)
+
+
+async def verify_recaptcha(state, token, version='v3', user_id=None):
+    """Same caches and results as RecaptchaVerifier.verify, with the upstream call made through aiohttp"""
+    verifier = state.server.recaptcha_verifier
+    verification = verifier.lookup(token, version, user_id)
+    if verification is not None:
+        return verification
+
+    result = None
+    failed = False
+    start = time.perf_counter()
+    try:
+        async with state.http.post(verifier.verify_url, data={
+            'secret': verifier.secrets.get(version) or '',
+            'response': token
+        }) as response:
+            response.raise_for_status()
+            result = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        failed = True
+        logger.warning(f"reCAPTCHA {version} verification request failed: {e}")
+    finally:
+        verifier.record_latency(time.perf_counter() - start, failed)
+    return verifier.record_result(token, version, user_id, result)
+
+
+async def check_log_recaptcha(state, data):
+    """Verify the optional reCAPTCHA token of a log request. Returns an error response, or None if it passed."""
+    token = data.get('recaptcha_token')
+    version = data.get('recaptcha_version', 'v3')
+
+    if token:
+        verification = await verify_recaptcha(state, token, version, data.get('user_id'))
+
+        if version == 'v3' and verification['requireV2']:
+            return json_response({'success': False, 'requireV2Verification': True})
+
+        if not verification['success']:
+            return json_response({'success': False, 'error': 'reCAPTCHA verification failed'}, 403)
+
+    return None
+
+
+async def append_to_spool(state, rows):
+    """The spool's fsync blocks, so it runs in the default executor"""
+    return await asyncio.get_running_loop().run_in_executor(None, state.server.append_to_spool, rows)
+
+
+async def log_to_activity_logs(state, user_id, activity_type, data, timestamp=None, event_id=None):
+    """Spool or queue a log row, or write it now for the activity types that must be durable"""
+    server = state.server
+    row = (event_id, user_id, activity_type, json.dumps(data), timestamp or datetime.now())
+    if await append_to_spool(state, [row]):
+        return
+    if server.LOG_SINK_ENABLED and activity_type not in server.SYNC_ACTIVITY_TYPES:
+        stored = await state.log_sink.submit(row)
+    else:
+        stored = await state.log_sink.write([row])
+    if not stored:
+        # As in production_server.log_to_activity_logs: fail the request so that its event id is released
+        raise RuntimeError(f"Could not store the {activity_type} activity log")
+
+
+async def record_study_completed(state, user_id):
+    """Apply the completion to the proposal counts, logging instead of failing the request"""
+    try:
+        await ensure_proposal_store(state)
+        async with state.pool.acquire() as cnx:
+            await async_proposal_store.record_study_completed(cnx, user_id)
+    except Exception as e:
+        logger.error(f"Failed to update proposal counts: {e}")
+
+
+async def refresh_recipe_sampler(state, cnx, catalog):
+    """Same policy as production_server.refresh_recipe_sampler; a single refresh runs at a time"""
+    server = state.server
+    sampler = server.recipe_sampler
+    if sampler.catalog_version != catalog.digest:
+        sampler.reset(catalog.by_id.keys(), catalog.digest)
+        server.recipe_sampler_refreshed_at = None
+    if cnx is None or state.sampler_lock.locked():
+        return
+    if server.recipe_sampler_refreshed_at is not None and \
+            time.monotonic() - server.recipe_sampler_refreshed_at < server.SAMPLER_REFRESH_SECONDS:
+        return
+    async with state.sampler_lock:
+        try:
+            expired = await async_proposal_store.expire_proposal_leases(cnx)
+            sampler.sync(await async_proposal_store.read_proposal_counts(cnx))
+            server.recipe_sampler_refreshed_at = time.monotonic()
+            if expired:
+                logger.info(f"Released {expired} expired recipe leases")
+        except Exception as e:
+            logger.error(f"Error refreshing recipe proposal counts: {e}")
+        try:
+            if server.event_id_prune_due():
+                async with cnx.cursor() as cursor:
+                    await cursor.execute(PRUNE_EVENT_IDS, (server.log_partitions.EVENT_ID_RETENTION_DAYS,
+                                                           PRUNE_BATCH_SIZE))
+                    deleted = cursor.rowcount
+                await cnx.commit()
+                server.record_event_id_prune(deleted)
+        except Exception as e:
+            logger.error(f"Error pruning the event id ledger: {e}")
+
+
+async def reserve_for(state, cnx, catalog, user_id, fetched_at):
+    """Draw candidates and reserve them (raises if they cannot be); mirrors production_server.food_get_recipes"""
+    server = state.server
+    sampler = server.recipe_sampler
+    if server.proposal_store_catalog_version != catalog.digest:
+        await async_proposal_store.ensure_recipe_rows(cnx, catalog.by_id.keys())
+        server.proposal_store_catalog_version = catalog.digest
+    await refresh_recipe_sampler(state, cnx, catalog)
+
+    candidate_ids = sampler.draw(server.RECIPES_PER_PARTICIPANT + server.RESERVATION_SPARE_CANDIDATES)
+    selected_ids = await async_proposal_store.reserve_recipes(
+        cnx, user_id, candidate_ids,
+        server.RECIPES_PER_PARTICIPANT, server.MAX_RECIPE_PROPOSALS, server.PROPOSAL_LEASE_MINUTES, fetched_at
+    )
+    sampler.add(selected_ids)
+    tried = candidate_ids[:candidate_ids.index(selected_ids[-1]) + 1] if selected_ids else candidate_ids
+    sampler.mark_full(set(tried) - set(selected_ids))
+    return selected_ids
+
+
+async def options_handler(request):
+    return web.Response(status=204, headers=CORS_HEADERS)
+
+
+async def food_log_activity(request):
+    """Log user activity throughout the study"""
+    state = request.app['state']
+    server = state.server
+    try:
+        data = json.loads(await request.text())
+        user_id = data.get('user_id')
+        activity_type = data.get('type')
+        event_id = data.get('event_id')
+        if event_id is not None and (not isinstance(event_id, str)
+                                     or not 0 < len(event_id) <= server.EVENT_ID_MAX_LENGTH):
+            return json_response({'success': False, 'error': 'Invalid event_id'}, 400)
+
+        recaptcha_error = await check_log_recaptcha(state, data)
+        if recaptcha_error:
+            return recaptcha_error
+
+        if event_id is not None and not server.recent_event_ids.claim(event_id):
+            return json_response({'success': True, 'message': 'Log recorded successfully'})
+
+        data.pop('recaptcha_token', None)
+        data.pop('recaptcha_version', None)
+
+        try:
+            await log_to_activity_logs(state, user_id, activity_type, data, event_id=event_id)
+
+            if activity_type == 'recipe-ratings-static-submitted':
+                await log_to_activity_logs(state, user_id, 'study_completed', {'status': 'completed'},
+                                           event_id=server.completion_event_id(event_id))
+                await record_study_completed(state, user_id)
+                logger.info(f"User {user_id} completed the study (recipe ratings submitted)")
+        except Exception:
+            if event_id is not None:
+                server.recent_event_ids.forget([event_id])
+            raise
+
+        return json_response({'success': True, 'message': 'Log recorded successfully'})
+
+    except Exception as e:
+        logger.error(f"Error logging activity: {e}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+async def food_log_activity_batch(request):
+    """Log several client events of one user with a single request and a single multi-row insert"""
+    state = request.app['state']
+    server = state.server
+    try:
+        data = json.loads(await request.text())
+        try:
+            batch = server.LogBatch.model_validate(data)
+        except ValidationError as e:
+            return json_response({'success': False, 'error': 'Invalid log batch',
+                                  'details': e.errors(include_url=False, include_context=False)}, 400)
+
+        recaptcha_error = await check_log_recaptcha(state, data)
+        if recaptcha_error:
+            return recaptcha_error
+
+        user_id = batch.user_id
+        now = datetime.now()
+        rows = []
+        claimed_ids = []
+        completed = False
+        for event in batch.events:
+            if event.event_id is not None:
+                if not server.recent_event_ids.claim(event.event_id):
+                    continue
+                claimed_ids.append(event.event_id)
+
+            event_data = event.model_dump(mode='json', exclude={'type', 'timestamp'}, exclude_none=True)
+            event_data.update(type=event.type, user_id=user_id)
+            if event.timestamp is not None:
+                event_data['client_timestamp'] = event.timestamp.isoformat()
+            rows.append((event.event_id, user_id, event.type, json.dumps(event_data),
+                         server.event_timestamp(event.timestamp, now)))
+            if event.type == 'recipe-ratings-static-submitted':
+                rows.append((server.completion_event_id(event.event_id), user_id, 'study_completed',
+                             json.dumps({'status': 'completed'}), now))
+                completed = True
+
+        sync = completed or any(row[2] in server.SYNC_ACTIVITY_TYPES for row in rows)
+        if not rows or await append_to_spool(state, rows):
+            stored = True
+        elif server.LOG_SINK_ENABLED and not sync:
+            stored = all([await state.log_sink.submit(row) for row in rows])
+        else:
+            stored = await state.log_sink.write(rows)
+        if not stored:
+            server.recent_event_ids.forget(claimed_ids)
+            return json_response({'success': False, 'error': 'Failed to store log batch'}, 500)
+
+        if completed:
+            await record_study_completed(state, user_id)
+            logger.info(f"User {user_id} completed the study (recipe ratings submitted)")
+
+        return json_response({'success': True, 'message': 'Logs recorded successfully', 'count': len(batch.events)})
+
+    except Exception as e:
+        logger.error(f"Error logging activity batch: {e}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+async def food_get_recipes(request):
+    """Get recipes for rating (static context phase)"""
+    state = request.app['state']
+    server = state.server
+    try:
+        user_id = request.query.get('user_id')
+        if not user_id:
+            return json_response({'success': False, 'error': 'user_id is required'}, 400)
+        catalog = server.recipe_catalog.get()
+        fetched_at = datetime.now().replace(microsecond=0)
+
+        # Recipes are only served once they are reserved, as in the Flask route
+        try:
+            await ensure_proposal_store(state)
+            async with state.pool.acquire() as cnx:
+                selected_ids = await reserve_for(state, cnx, catalog, user_id, fetched_at)
+        except Exception as e:
+            logger.error(f"Error reserving recipes for {user_id}: {e}")
+            response = json_response({'success': False, 'error': 'Recipes could not be reserved, retry later'}, 503)
+            response.headers['Retry-After'] = str(server.RESERVATION_RETRY_AFTER_SECONDS)
+            return response
+
+        recipes_by_id = catalog.summaries if request.query.get('view') == 'summary' else catalog.by_id
+        random_recipes = [recipes_by_id[recipe_id] for recipe_id in selected_ids if recipe_id in recipes_by_id]
+
+        await log_to_activity_logs(state, user_id, 'recipes_fetched',
+                                   {'recipe_ids': [r['id'] for r in random_recipes]}, fetched_at)
+
+        return json_response({'success': True, 'recipes': random_recipes})
+
+    except Exception as e:
+        logger.error(f"Error getting recipes: {e}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+async def food_get_recipe_detail(request):
+    """Full recipe, cached by the browser and revalidated with its ETag (same as the Flask route)"""
+    server = request.app['state'].server
+    catalog = server.recipe_catalog.get()
+    recipe_id = request.match_info['recipe_id']
+    recipe = catalog.by_id.get(recipe_id)
+    if recipe is None:
+        return json_response({'success': False, 'error': 'Recipe not found'}, 404)
+
+    etag = catalog.etag(recipe_id)
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match == '*' or etag in (tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(',')):
+        response = web.Response(status=304)
+    else:
+        response = json_response({'success': True, 'recipe': recipe})
+    response.headers['ETag'] = f'W/"{etag}"'
+    response.headers['Cache-Control'] = f'public, max-age={server.RECIPE_DETAIL_MAX_AGE}'
+    return response
+
+
+async def food_llm_rate_recipes(request):
+    """LLM ratings of recipes (same as the Flask route); the model calls run on the rater's threads"""
+    server = request.app['state'].server
+    endpoint = request.match_info['endpoint']
+    if endpoint not in ('static', 'dynamic'):
+        return json_response({'success': False, 'error': 'Not found'}, 404)
+
+    try:
+        user_id, items, error = server.llm_rating_items(endpoint, json.loads(await request.text()))
+        if error:
+            return json_response({'success': False, 'error': error}, 400)
+        try:
+            submitted = server.submit_llm_ratings(user_id, items)
+        except KeyError as e:
+            return json_response({'success': False, 'error': f'Recipe not found: {e.args[0]}'}, 404)
+        except server.llm_rating.QueueFullError as e:
+            logger.warning(f"Rejected LLM ratings of user {user_id}: {e}")
+            response = json_response({'success': False, 'error': 'Too many ratings in progress, retry later'}, 503)
+            response.headers['Retry-After'] = str(server.LLM_RETRY_AFTER_SECONDS)
+            return response
+
+        await asyncio.wait([asyncio.wrap_future(future) for _, future in submitted], timeout=server.LLM_WAIT_SECONDS)
+        body, status = server.llm_ratings_body(submitted)
+        return json_response(body, status)
+
+    except Exception as e:
+        logger.error(f"Error rating recipes with the LLM: {e}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+async def food_generate_questionnaires(request):
+    """Queue a questionnaire generation job (same as the Flask route)"""
+    server = request.app['state'].server
+    try:
+        try:
+            body = server.QuestionnaireRequest.model_validate(json.loads(await request.text()))
+        except ValidationError:
+            return json_response({'success': False, 'error': 'Invalid questionnaire request'}, 400)
+        try:
+            job = server.get_questionnaire_jobs().submit(body.user_id, body.text, tuple(body.questionnaires))
+        except server.questionnaire_jobs.QueueFullError as e:
+            logger.warning(f"Rejected questionnaire job of user {body.user_id}: {e}")
+            response = json_response({'success': False, 'error': 'Too many questionnaire jobs, retry later'}, 503)
+            response.headers['Retry-After'] = '30'
+            return response
+
+        body, status = server.questionnaire_job_body(job)
+        return json_response(body, status)
+
+    except Exception as e:
+        logger.error(f"Error generating questionnaires: {e}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+async def food_questionnaire_job(request):
+    server = request.app['state'].server
+    job = server.get_questionnaire_jobs().get(request.match_info['job_id'])
+    if job is None:
+        return json_response({'success': False, 'error': 'Job not found'}, 404)
+    body, status = server.questionnaire_job_body(job)
+    return json_response(body, status)
+
+
+async def food_questionnaire_job_stream(request):
+    """Progress of a questionnaire job as NDJSON (same lines as the Flask route), polled without a thread"""
+    server = request.app['state'].server
+    job = server.get_questionnaire_jobs().get(request.match_info['job_id'])
+    if job is None:
+        return json_response({'success': False, 'error': 'Job not found'}, 404)
+    try:
+        index = max(int(request.query.get('after', 0)), 0)
+    except ValueError:
+        index = 0
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+    deadline = time.monotonic() + server.QUESTIONNAIRE_STREAM_SECONDS
+    while True:
+        events, finished = job.events_after(index)
+        for event in events:
+            await response.write((json.dumps(dict(event, index=index)) + '\n').encode('utf-8'))
+            index += 1
+        if finished or time.monotonic() >= deadline:
+            await response.write((json.dumps({'status': job.status, 'done': index, 'total': job.total,
+                                              'reconnect': not finished}) + '\n').encode('utf-8'))
+            break
+        await asyncio.sleep(0.5)
+    await response.write_eof()
+    return response
+
+
+async def food_ready(request):
+    """Readiness probe (same as the Flask route)"""
+    server = request.app['state'].server
+    if server.shutting_down:
+        return json_response({'ready': False, 'phase': 'draining'}, 503)
+    if not server.server_ready.is_set():
+        return json_response({'ready': False, 'phase': server.startup_phase}, 503)
+    return json_response({'ready': True, 'startup_seconds': server.startup_timings})
+
+
+async def food_metrics(request):
+    """Prometheus text exposition: the metrics shared with the Flask server, then the async-only ones"""
+    state = request.app['state']
+    server = state.server
+    if server.METRICS_TOKEN:
+        supplied = request.query.get('token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode(), server.METRICS_TOKEN.encode()):
+            return web.Response(status=403)
+    body = server.metrics.render() + state.metrics.render()
+    return web.Response(body=body.encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+async def prime_pool(state, count):
+    """Open `count` pooled connections up front by holding them all at once"""
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(await state.pool.acquire())
+    finally:
+        for cnx in connections:
+            state.pool.release(cnx)
+
+
+async def warm_up(state):
+    """production_server.warm_up in a worker thread, then the aiomysql pool; retried until it succeeds"""
+    server = state.server
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    while True:
+        try:
+            # A single synchronous connection: the request path uses the aiomysql pool
+            await loop.run_in_executor(None, server.warm_up, 1)
+            with server.timed_phase('async_db_pool'):
+                await prime_pool(state, min(server.WARM_POOL_CONNECTIONS, ASYNC_DB_POOL_SIZE))
+        except Exception as e:
+            logger.error(f"Startup phase {server.startup_phase} failed, "
+                         f"retrying in {server.WARM_UP_RETRY_SECONDS}s: {e}")
+            await asyncio.sleep(server.WARM_UP_RETRY_SECONDS)
+            continue
+        server.startup_timings['total'] = round(time.perf_counter() - start, 3)
+        server.server_ready.set()
+        logger.info(f"Async server warm after {server.startup_timings['total']:.3f}s")
+        return
+
+
+async def food_complete_study(request):
+    """Mark study as complete"""
+    state = request.app['state']
+    try:
+        data = json.loads(await request.text())
+        user_id = data.get('user_id')
+
+        await log_to_activity_logs(state, user_id, 'study_completed', {'status': 'completed'})
+        await record_study_completed(state, user_id)
+
+        return json_response({'success': True, 'message': 'Study completed successfully'})
+
+    except Exception as e:
+        logger.error(f"Error completing study: {e}")
+        return json_response({'success': False, 'error': str(e)}, 500)
+
+
+async def on_startup(app):
+    state = app['state']
+    server = state.server
+    state.pool = await aiomysql.create_pool(
+        host=os.getenv("DB_HOST", "localhost"),
+        user=os.getenv("DB_USER", "root"),
+        password=os.getenv("DB_PWD") or "",
+        db=server.DB_NAME,
+        minsize=0,  # connect lazily, so that the server starts even if MySQL is not reachable yet
+        maxsize=ASYNC_DB_POOL_SIZE,
+        connect_timeout=server.DB_CONNECT_TIMEOUT,
+        pool_recycle=3600,
+        autocommit=False
+    )
+    connect_timeout, read_timeout = server.recaptcha_verifier.timeout
+    state.http = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout),
+        connector=aiohttp.TCPConnector(limit=ASYNC_DB_POOL_SIZE)
+    )
+    state.log_sink.start(state.pool)
+    # Warm up in the background while the server already accepts connections; /ready reports when done
+    state.warm_up_task = asyncio.create_task(warm_up(state))
+    logger.info(f"Async server started (database pool of up to {ASYNC_DB_POOL_SIZE} connections)")
+
+
+async def on_cleanup(app):
+    state = app['state']
+    state.warm_up_task.cancel()
+    await state.log_sink.shutdown()
+    await state.http.close()
+    state.pool.close()
+    await state.pool.wait_closed()
+
+
+def create_app(server):
+    """aiohttp application serving the study routes; `server` is the production_server module"""
+    app = web.Application(middlewares=[metrics_middleware, compression_middleware])
+    app['state'] = AsyncServerState(server)
+    routes = (
+        ('/server/api/logs', 'POST', food_log_activity),
+        ('/server/api/logs/batch', 'POST', food_log_activity_batch),
+        ('/server/api/recipes', 'GET', food_get_recipes),
+        ('/server/api/recipes/{recipe_id}', 'GET', food_get_recipe_detail),
+        ('/server/api/llm/rate-recipes-{endpoint}', 'POST', food_llm_rate_recipes),
+        ('/server/api/llm/generate-questionnaires', 'POST', food_generate_questionnaires),
+        ('/server/api/llm/generate-questionnaires/{job_id}', 'GET', food_questionnaire_job),
+        ('/server/api/llm/generate-questionnaires/{job_id}/stream', 'GET', food_questionnaire_job_stream),
+        ('/server/api/study/complete', 'POST', food_complete_study),
+        ('/server/api/ready', 'GET', food_ready),
+        ('/server/api/metrics', 'GET', food_metrics),
+    )
+    for path, method, handler in routes:
+        for route_path in (path, path + '/'):
+            app.router.add_route(method, route_path, handler)
+            app.router.add_route('OPTIONS', route_path, options_handler)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run(server, host='0.0.0.0', port=3050):
+    # A large listen backlog absorbs cohort bursts while the loop accepts connections
+    web.run_app(create_app(server), host=host, port=port, access_log=None, backlog=2048)
@@ -0,0 +1,402 @@
+"""
+Load-testing harness for the study server.
+
+Seeds a scratch MySQL (or MariaDB) database with a synthetic activity_logs history, then drives simulated
+participants through the real sequence of study calls (start, consent, focus events, biography,
+questionnaires, recipes, directions toggles, ratings, completion) at several concurrency levels.
+For each (log table size, concurrency) it reports throughput, p50/p95/p99 latency per endpoint and the
+number of database statements per label, and writes everything to a JSON file so that revisions can be
+compared.
+
+The harness empties activity_logs and the proposal tables of the target database, so point DB_NAME at a
+scratch database:
+
+    DB_NAME=food_study_bench python server/bench_server.py --log_rows 0 100000 --concurrency 1 16 64 \\
+        --participants 200 --out bench_results.json
+"""
+import argparse
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import simplejson as json
+
+ACTIVITY_LOGS_DDL = """
+    CREATE TABLE IF NOT EXISTS activity_logs (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id VARCHAR(255) NOT NULL,
+        activity_type VARCHAR(100) NOT NULL,
+        data JSON,
+        timestamp DATETIME NOT NULL,
+        INDEX idx_user_id (user_id),
+        INDEX idx_activity_type (activity_type),
+        INDEX idx_timestamp (timestamp)
+    )
+"""
+
+SEED_ROWS_PER_USER = 25  # roughly what a participant leaves behind, focus events included
+SEED_CHUNK = 5000
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed_history(server, num_rows, completed_share=0.3):
+    """
+    Fill activity_logs with about num_rows rows of past participants. A share of them completed the study
+    (their proposals count towards the cap); the others abandoned it more than a lease window ago.
+    Completed users are limited so that the seeded proposals use at most half of the catalog capacity.
+    """
+    recipe_ids = [recipe['id'] for recipe in server.recipe_catalog.get().recipes]
+    capacity_users = len(recipe_ids) * server.MAX_RECIPE_PROPOSALS // (2 * server.RECIPES_PER_PARTICIPANT)
+    num_users = num_rows // SEED_ROWS_PER_USER
+    max_completed = min(int(num_users * completed_share), capacity_users)
+    now = datetime.now()
+
+    cnx = server.create_db_connection(server.DB_NAME)
+    cursor = cnx.cursor()
+    rows = []
+
+    def flush():
+        if rows:
+            cursor.executemany(
+                "INSERT INTO activity_logs (user_id, activity_type, data, timestamp) VALUES (%s, %s, %s, %s)",
+                rows
+            )
+            cnx.commit()
+            rows.clear()
+
+    for i in range(num_users):
+        user_id = f"seed_{i}"
+        started = now - timedelta(minutes=random.randint(30, 60 * 24 * 30))
+        offset = iter(range(10_000))
+
+        def add(activity_type, data):
+            rows.append((user_id, activity_type, json.dumps(data), started + timedelta(seconds=5 * next(offset))))
+
+        add('study-started', {'language': 'en', 'fromProlific': True})
+        add('informed-consent-submitted', {'isAdult': True, 'agreedToStudy': True})
+        for _ in range(6):
+            add('focus-lost', {})
+            add('focus-regained', {})
+        add('static-context-submitted', {'text': 'I like quick vegetarian meals. ' * 20})
+        add('questionnaires-submitted', {'contextType': 'fcq', 'fcq': {}, 'jc': {}})
+        proposed = random.sample(recipe_ids, server.RECIPES_PER_PARTICIPANT)
+        add('recipes_fetched', {'recipe_ids': proposed})
+        for recipe_id in proposed[:3]:
+            add('directions-toggle', {'action': 'expand', 'recipeId': recipe_id})
+        if i < max_completed:
+            add('recipe-ratings-static-submitted',
+                {'ratings': [{'recipeId': r, 'rating': 3, 'review': 'ok'} for r in proposed]})
+            add('study_completed', {'status': 'completed'})
+        if len(rows) >= SEED_CHUNK:
+            flush()
+    flush()
+    cursor.close()
+    cnx.close()
+    return num_users
+
+
+def reset_database(server):
+    import migrate
+
+    cnx = server.create_db_connection(server.DB_NAME)
+    cursor = cnx.cursor()
+    cursor.execute(ACTIVITY_LOGS_DDL)
+    migrate.apply_migrations(cnx)
+    for table in ('activity_logs', 'activity_log_rollups', 'recipe_proposals', 'recipe_proposal_counts',
+                  'recipe_proposal_leases', 'recipe_proposal_completions'):
+        cursor.execute(f"DELETE FROM {table}")
+    cnx.commit()
+    cursor.close()
+    cnx.close()
+
+    # Forget the in-process proposal state so that the server initializes from the new history
+    server.proposal_store_ready = False
+    server.proposal_store_catalog_version = None
+    server.recipe_sampler.catalog_version = None
+    server.recipe_sampler_refreshed_at = None
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, elapsed, ok):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+class TestClientTransport:
+    """Calls the Flask app in-process (one test client per thread)"""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def _client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        return client
+
+    def get(self, path, params):
+        response = self._client().get(path, query_string=params)
+        return response.status_code, response.get_json(silent=True)
+
+    def post(self, path, body):
+        response = self._client().post(path, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpTransport:
+    """Calls a real server (e.g. the app served by waitress) over HTTP with one session per thread"""
+
+    def __init__(self, base_url):
+        import requests
+
+        self.requests = requests
+        self.base_url = base_url.rstrip('/')
+        self.local = threading.local()
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        return session
+
+    def get(self, path, params):
+        response = self._session().get(self.base_url + path, params=params, timeout=60)
+        return response.status_code, response.json()
+
+    def post(self, path, body):
+        response = self._session().post(self.base_url + path, json=body, timeout=60)
+        return response.status_code, response.json()
+
+
+def start_async_server(server, port):
+    """Serve the aiohttp variant from a background event loop thread"""
+    import asyncio
+
+    from aiohttp import web
+
+    import async_server
+
+    started = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(async_server.create_app(server), access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port, backlog=2048).start())
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="async-server", daemon=True).start()
+    started.wait()
+
+
+def run_participant(transport, recorder, user_id, focus_events, batch_focus):
+    """One participant, following the request sequence of the Vue client"""
+
+    def call(endpoint, method, path, payload):
+        start = time.perf_counter()
+        try:
+            if method == 'GET':
+                status, body = transport.get(path, payload)
+            else:
+                status, body = transport.post(path, payload)
+            ok = status == 200 and bool(body) and body.get('success', False)
+        except Exception:
+            body, ok = None, False
+        recorder.record(endpoint, time.perf_counter() - start, ok)
+        return body
+
+    def log(activity_type, data=None):
+        call('POST /logs', 'POST', '/server/api/logs', {'type': activity_type, 'user_id': user_id, **(data or {})})
+
+    log('study-started', {'language': 'en', 'fromProlific': True})
+    log('informed-consent-submitted', {'isAdult': True, 'agreedToStudy': True})
+    focus = [{'type': event_type, 'timestamp': int(time.time() * 1000)}
+             for _ in range(focus_events) for event_type in ('focus-lost', 'focus-regained')]
+    if batch_focus and focus:
+        call('POST /logs/batch', 'POST', '/server/api/logs/batch', {'user_id': user_id, 'events': focus})
+    else:
+        for event in focus:
+            log(event['type'])
+    log('static-context-submitted', {'text': 'I like quick vegetarian meals. ' * 20})
+    log('questionnaires-submitted', {'contextType': 'fcq', 'fcq': {}, 'jc': {}})
+
+    body = call('GET /recipes', 'GET', '/server/api/recipes', {'user_id': user_id, 'view': 'summary'})
+    recipes = (body or {}).get('recipes') or []
+    for recipe in recipes:
+        call('GET /recipes/<id>', 'GET', f"/server/api/recipes/{recipe['id']}", {})
+    for recipe in recipes[:3]:
+        log('directions-toggle', {'action': 'expand', 'recipeId': recipe['id'], 'recipeName': recipe['name']})
+    log('recipe-ratings-static-submitted',
+        {'ratings': [{'recipeId': recipe['id'], 'rating': 3, 'review': 'ok'} for recipe in recipes]})
+    call('POST /study/complete', 'POST', '/server/api/study/complete', {'user_id': user_id})
+
+
+def run_level(server, transport, concurrency, participants, focus_events, batch_focus, run_id):
+    from db_pool import query_stats
+
+    recorder = Recorder()
+    queries_before = query_stats.snapshot()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(run_participant, transport, recorder, f"bench_{run_id}_{i}", focus_events, batch_focus)
+            for i in range(participants)
+        ]
+        for future in futures:
+            future.result()
+    # Include the time the background writer and the spool replayer need to catch up with the logs
+    while server.activity_log_sink.depth() > 0 or (
+            server.log_spool_replayer is not None and server.log_spool_replayer.lag() > 0):
+        time.sleep(0.01)
+    wall_time = time.perf_counter() - start
+    queries_after = query_stats.snapshot()
+
+    endpoints = {}
+    total_requests = 0
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        latencies.sort()
+        total_requests += len(latencies)
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'errors': recorder.errors.get(endpoint, 0),
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p95_ms': 1000 * percentile(latencies, 95),
+            'p99_ms': 1000 * percentile(latencies, 99),
+            'max_ms': 1000 * latencies[-1],
+        }
+
+    queries = {}
+    for label, after in sorted(queries_after.items()):
+        before = queries_before.get(label, {'count': 0, 'total_ms': 0.0})
+        count = after['count'] - before['count']
+        if count:
+            queries[label] = {'count': count, 'total_ms': after['total_ms'] - before['total_ms']}
+
+    return {
+        'concurrency': concurrency,
+        'participants': participants,
+        'wall_time_s': wall_time,
+        'requests': total_requests,
+        'throughput_rps': total_requests / wall_time if wall_time else None,
+        'participants_per_s': participants / wall_time if wall_time else None,
+        'endpoints': endpoints,
+        'db_queries': queries,
+        'db_queries_per_participant': sum(q['count'] for q in queries.values()) / participants,
+    }
+
+
+def print_level(log_rows, level):
+    print(f"\nlog rows {log_rows}, concurrency {level['concurrency']}: "
+          f"{level['throughput_rps']:.1f} req/s, {level['participants_per_s']:.2f} participants/s, "
+          f"{level['db_queries_per_participant']:.1f} DB statements/participant")
+    for endpoint, stats in level['endpoints'].items():
+        print(f"  {endpoint:<20} n={stats['requests']:<6} err={stats['errors']:<4} "
+              f"p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the study server against a scratch database")
+    parser.add_argument("--mode", choices=["test-client", "waitress", "async"], default="waitress")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--log_rows", type=int, nargs="+", default=[0, 100000],
+                        help="activity_logs sizes to seed before each series of runs")
+    parser.add_argument("--participants", type=int, default=100, help="participants per concurrency level")
+    parser.add_argument("--focus_events", type=int, default=5, help="focus lost/regained pairs per participant")
+    parser.add_argument("--batch_focus", action="store_true", help="send focus events through /logs/batch")
+    parser.add_argument("--port", type=int, default=3051)
+    parser.add_argument("--out", type=str, default="bench_results.json")
+    parser.add_argument("--force", action="store_true", help="allow running against food_preferences_study")
+    args = parser.parse_args()
+
+    os.environ.setdefault("WAITRESS_THREADS", str(max(args.concurrency)))
+
+    import migrate
+    import production_server as server
+
+    if server.DB_NAME == "food_preferences_study" and not args.force:
+        sys.exit("Refusing to empty the study database; set DB_NAME to a scratch database")
+
+    if args.mode == "waitress":
+        from waitress import create_server
+
+        http_server = create_server(server.app, host='127.0.0.1', port=args.port, threads=server.WAITRESS_THREADS)
+        threading.Thread(target=http_server.run, daemon=True).start()
+        transport = HttpTransport(f"http://127.0.0.1:{args.port}")
+    elif args.mode == "async":
+        start_async_server(server, args.port)
+        transport = HttpTransport(f"http://127.0.0.1:{args.port}")
+    else:
+        transport = TestClientTransport(server.app)
+
+    results = {
+        'revision': git_revision(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'mode': args.mode,
+        'waitress_threads': server.WAITRESS_THREADS,
+        'db_pool_size': server.DB_POOL_SIZE,
+        'async_db_pool_size': int(os.getenv("ASYNC_DB_POOL_SIZE", 20)),
+        'focus_events': args.focus_events,
+        'batch_focus': args.batch_focus,
+        'runs': [],
+    }
+
+    for log_rows in args.log_rows:
+        reset_database(server)
+        seed_start = time.perf_counter()
+        seeded_users = seed_history(server, log_rows)
+        backfill_cnx = server.create_db_connection(server.DB_NAME)
+        try:
+            migrate.backfill_recipe_proposals(backfill_cnx)
+        finally:
+            backfill_cnx.close()
+        print(f"Seeded {log_rows} log rows ({seeded_users} past participants) "
+              f"in {time.perf_counter() - seed_start:.1f}s")
+
+        for run_index, concurrency in enumerate(args.concurrency):
+            level = run_level(server, transport, concurrency, args.participants,
+                              args.focus_events, args.batch_focus, f"{log_rows}_{run_index}")
+            level['log_rows'] = log_rows
+            results['runs'].append(level)
+            print_level(log_rows, level)
+
+    server.activity_log_sink.shutdown()
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+# The server modules import each other as top-level modules (python server/production_server.py);
+# pytest puts this directory on sys.path for the tests in tests/. The benchmark modules they import are
+# found through PYTHONPATH=../benchmarking when the server runs; the tests add that directory here.
+import os
+import sys
+
+BENCHMARKING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'benchmarking')
+if BENCHMARKING_DIR not in sys.path:
+    sys.path.append(BENCHMARKING_DIR)
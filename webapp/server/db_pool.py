@@ -0,0 +1,247 @@
+"""
+Bounded MySQL connection pool for the study server.
+
+mysql.connector.pooling fails immediately when every connection is checked out; this pool instead
+makes request threads wait (up to a timeout) for a free connection, pings connections that have
+been idle before handing them out, and records how long threads waited and how busy the pool is.
+Cursors of pooled connections also count and time every statement, grouped by verb and table.
+"""
+import functools
+import logging
+import queue
+import re
+import threading
+import time
+
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+
+_STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+`?(\w+)", re.IGNORECASE)
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(operation):
+    """'SELECT activity_logs', 'INSERT recipe_proposal_leases', ... for grouping query statistics"""
+    words = operation.split(None, 1)
+    verb = words[0].upper() if words else ''
+    table = _STATEMENT_TABLE.search(operation)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+class QueryStats:
+    """Number of statements and time spent in them, per statement label"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, label, elapsed):
+        with self._lock:
+            entry = self._stats.get(label)
+            if entry is None:
+                self._stats[label] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def snapshot(self):
+        with self._lock:
+            return {label: {'count': count, 'total_ms': 1000 * total} for label, (count, total) in self._stats.items()}
+
+
+query_stats = QueryStats()
+# Callables invoked as observer(label, elapsed_seconds) after every statement
+query_observers = []
+
+
+def _record_statement(operation, start):
+    label = statement_label(operation)
+    elapsed = time.perf_counter() - start
+    query_stats.record(label, elapsed)
+    for observer in query_observers:
+        observer(label, elapsed)
+
+
+class TimedCursor:
+    """Cursor proxy that records every execute/executemany in query_stats"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, operation, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, *args, **kwargs)
+        finally:
+            _record_statement(operation, start)
+
+    def executemany(self, operation, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, *args, **kwargs)
+        finally:
+            _record_statement(operation, start)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PooledConnection:
+    """Proxy around a pooled connection: close() gives it back to the pool instead of disconnecting"""
+
+    def __init__(self, pool, cnx):
+        self._pool = pool
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        if self._cnx is None:
+            raise AttributeError(f"Connection already returned to the pool ({name})")
+        return getattr(self._cnx, name)
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self.__getattr__('cursor')(*args, **kwargs))
+
+    def close(self):
+        if self._cnx is not None:
+            cnx, self._cnx = self._cnx, None
+            self._pool.release(cnx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, size, checkout_timeout=10.0, health_check_after=5.0, name="", **connect_kwargs):
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+        self.name = name
+        self.connect_kwargs = connect_kwargs
+
+        # LIFO so that the most recently used (and most likely alive) connection is reused first
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.health_check_failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _connect(self):
+        cnx = mysql.connector.connect(**self.connect_kwargs)
+        with self._stats_lock:
+            self.connects += 1
+        return cnx
+
+    def _checkout_idle(self):
+        """Take an idle connection that passes the health check, or None if there is none"""
+        while True:
+            try:
+                cnx, returned_at = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            if time.monotonic() - returned_at < self.health_check_after:
+                return cnx
+            try:
+                cnx.ping(reconnect=False)
+                return cnx
+            except Exception as e:
+                with self._stats_lock:
+                    self.health_check_failures += 1
+                logger.warning(f"Discarding broken pooled connection ({self.name}): {e}")
+                try:
+                    cnx.close()
+                except Exception:
+                    pass
+
+    def get_connection(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._stats_lock:
+                self.timeouts += 1
+            raise PoolExhaustedError(
+                f"No database connection available after {self.checkout_timeout}s (pool size {self.size})"
+            )
+        waited = time.perf_counter() - start
+
+        try:
+            cnx = self._checkout_idle() or self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return PooledConnection(self, cnx)
+
+    def prime(self, count):
+        """Open connections until `count` of them (at most the pool size) are idle, ahead of the first requests"""
+        connections = []
+        try:
+            for _ in range(min(count, self.size)):
+                connections.append(self.get_connection())
+        finally:
+            for cnx in connections:
+                cnx.close()
+        return len(connections)
+
+    def release(self, cnx):
+        try:
+            # Never hand out a connection with an open transaction (or a stale REPEATABLE READ snapshot)
+            if cnx.in_transaction:
+                cnx.rollback()
+            self._idle.put((cnx, time.monotonic()))
+        except Exception as e:
+            logger.warning(f"Dropping pooled connection that failed to reset ({self.name}): {e}")
+            try:
+                cnx.close()
+            except Exception:
+                pass
+        finally:
+            with self._stats_lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'idle': self._idle.qsize(),
+                'utilization': self.in_use / self.size if self.size else 0.0,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'health_check_failures': self.health_check_failures,
+                'avg_wait_ms': 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait_ms': 1000 * self.max_wait,
+            }
+
+    def close_all(self):
+        while True:
+            try:
+                cnx, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                cnx.close()
+            except Exception:
+                pass
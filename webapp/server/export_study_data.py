@@ -0,0 +1,406 @@
+"""
+Export the study dataset (the CSV files in data/) from activity_logs and activity_log_submissions, where the
+submissions of archived partitions are kept (see log_partitions.py).
+
+The submissions are streamed from MySQL with an unbuffered cursor, `chunk_size` logs at a time. Chunks are
+decoded in a process pool and the resulting rows are appended to the output files in log order, so memory
+use depends on the chunk size and not on the number of participants. Each run records a watermark (the last
+exported log id and the size of every output file) in `.export_state.json`; `--incremental` exports only
+the logs written since, and first truncates the files to the recorded sizes, so a run that was interrupted
+leaves no partial rows behind. Log ids are assigned at insert, so a slow transaction can commit a log below ids
+that are already visible; a run therefore stops `--margin_ids` ids short of the largest log id, and the logs
+past the watermark are exported by the next run (use `--margin_ids 0` once the server is stopped). With
+`--parquet`, the rows of every chunk are also written as Parquet parts
+(`parquet/<output>/part-<first log id>-<last log id>.parquet`).
+
+Only the first submission of each type per user is exported, and users whose id starts with one of
+`--exclude_prefix` (the load tests' synthetic participants) are skipped. A full export refuses to run while
+partitions archived before their submissions were kept exist, since it would rewrite the files without them.
+
+Usage:
+    python server/export_study_data.py --out_dir server/export
+    python server/export_study_data.py --out_dir server/export --incremental [--parquet] [--workers 4]
+"""
+import argparse
+import csv
+import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import simplejson as json
+
+import log_partitions
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = '.export_state.json'
+CHUNK_SIZE = 2000
+MARGIN_IDS = 1000
+EXCLUDE_PREFIXES = ('bench_', 'stress_')
+
+OUTPUTS = {
+    'context_submissions': ('user_id', 'context_text', 'char_count', 'word_count'),
+    'FCQ_gt_structured': ('user_id', 'category', 'questions', 'score'),
+    'JC_gt_structured': ('user_id', 'category', 'questions', 'answer'),
+    'recipe_ratings': ('user_id', 'recipe_id', 'recipe_name', 'score', 'review', 'review_length'),
+}
+
+# Integer columns of the Parquet parts (polars dtype names); the other columns are strings. The FCQ score is
+# a string because old submissions stored the answer labels.
+PARQUET_TYPES = {
+    'context_submissions': {'char_count': 'Int64', 'word_count': 'Int64'},
+    'recipe_ratings': {'score': 'Int64', 'review_length': 'Int64'},
+}
+
+EXPORTED_TYPES = ('static-context-submitted', 'questionnaires-submitted', 'recipe-ratings-static-submitted')
+
+FCQ_OPTIONS = ['Not important at all', 'Slightly important', 'Very important', 'Extremely important']
+FCQ_CATEGORIES = {
+    'i choose foods because they keep me healthy': 'Health',
+    'i choose foods that help me control my weight': 'Weight Control',
+    'i choose foods that are convenient to prepare': 'Convenience',
+    'i choose foods for their taste': 'Sensory Appeal',
+    'i choose foods for ecologicalsustainability reasons': 'Natural Content',
+    'i choose foods for ethical or religious reasons': 'Ethical Concern',
+    'i choose foods that are familiartraditional': 'Familiarity',
+    'i choose foods based on price': 'Price',
+    'i choose foods that improve my mood': 'Mood',
+}
+
+# (category, question, NutritionistQuestionnaire field, field holding the text of an 'other' choice)
+JC_FIELDS = (
+    ('Personal data', 'age', 'age', None),
+    ('Personal data', 'gender', 'gender', None),
+    ('Personal data', 'country of birth', 'birthCountry', None),
+    ('Personal data', 'region of birth', 'birthRegion', None),
+    ('Personal data', 'country of residence', 'residenceCountry', None),
+    ('Personal data', 'region of residence', 'residenceRegion', None),
+    ('Habitual food consumption', 'number of main meals', 'mealsPerDay', None),
+    ('Other food preferences and habits', 'breakfast', 'breakfast', None),
+    ('Physical activity', 'sport practiced', 'sport', None),
+    ('Other', 'no_sport', 'noSport', None),
+    ('Physical activity', 'level', 'sportLevel', None),
+    ('Physical activity', 'weekly frequency', 'sportFrequency', None),
+    ('Other', 'walking_time', 'walkingTime', None),
+    ('Other', 'work_activity', 'workActivity', None),
+    ('Allergies, intolerances and restrictions', 'religious or ethical restrictions', 'restrictions',
+     'otherRestriction'),
+    ('Allergies, intolerances and restrictions', 'known food allergies', 'allergies', None),
+    ('Allergies, intolerances and restrictions', 'intolerances', 'intolerances', None),
+    ('Other', 'disliked_foods', 'dislikedFoods', None),
+    ('Clinical history and current condition', 'drugs in use', 'medications', None),
+    ('Clinical history and current condition', 'diagnosed pathologies', 'conditions', 'otherCondition'),
+    ('Other', 'goals', 'goals', 'otherGoal'),
+    ('Habitual food consumption', 'meat', 'meat', None),
+    ('Habitual food consumption', 'fish', 'fish', None),
+    ('Habitual food consumption', 'dairy products', 'dairy', None),
+    ('Habitual food consumption', 'eggs', 'eggs', None),
+    ('Habitual food consumption', 'legumes', 'legumes', None),
+    ('Habitual food consumption', 'fruit and vegetables', 'fruitsVeggies', None),
+    ('Habitual food consumption', 'industrial sweetssnacks', 'sweets', None),
+    ('Other', 'sweet_drinks_frequency', 'sweetDrinks', None),
+    ('Drinks', 'coffeetea', 'coffee', None),
+    ('Drinks', 'alcohol', 'alcohol', None),
+    ('Other', 'quick_meal', 'quickMeal', None),
+    ('Other', 'stressed_food', 'stressedFood', None),
+    ('Other', 'low_sleep_breakfast', 'lowSleepBreakfast', None),
+    ('Other', 'vacation_lunch', 'vacationLunch', None),
+    ('Other', 'particular_habits', 'particularHabits', None),
+    ('Other', 'supplements', 'supplements', None),
+    ('Other food preferences and habits', 'motivation for change scale 1 to 5', 'motivationLevel', None),
+)
+
+
+def normalize_question(text):
+    return re.sub(r'[^a-z0-9 ]', '', text.lower()).strip()
+
+
+def jc_answer(answers, field, other_field):
+    value = answers.get(field)
+    if isinstance(value, list):
+        if other_field and answers.get(other_field):
+            value = [answers[other_field] if choice == 'other' else choice for choice in value]
+        return ", ".join(str(choice) for choice in value)
+    if value is None:
+        return ''
+    return str(value)
+
+
+def context_rows(user_id, data):
+    text = data.get('text') or ''
+    return {'context_submissions': [(user_id, text, data.get('charCount', len(text)),
+                                     data.get('wordCount', len(text.split())))]}
+
+
+def questionnaire_rows(user_id, data):
+    rows = {}
+    fcq = data.get('fcq')
+    if fcq:
+        rows['FCQ_gt_structured'] = [
+            (user_id, FCQ_CATEGORIES.get(normalize_question(question['text']), ''),
+             normalize_question(question['text']),
+             FCQ_OPTIONS.index(question['answer']) + 1 if question['answer'] in FCQ_OPTIONS else question['answer'])
+            for question in fcq.get('questions', []) if not question.get('isAttentionCheck')
+        ]
+    jc = data.get('jc')
+    if jc:
+        rows['JC_gt_structured'] = [(user_id, category, question, jc_answer(jc, field, other_field))
+                                    for category, question, field, other_field in JC_FIELDS]
+    return rows
+
+
+def rating_rows(user_id, data):
+    return {'recipe_ratings': [
+        (user_id, rating.get('recipeId'), rating.get('recipeName'), rating.get('score'),
+         rating.get('review') or '', len(rating.get('review') or ''))
+        for rating in data.get('ratings', [])
+    ]}
+
+
+DECODERS = {
+    'static-context-submitted': context_rows,
+    'questionnaires-submitted': questionnaire_rows,
+    'recipe-ratings-static-submitted': rating_rows,
+}
+
+
+def decode_chunk(logs):
+    """Output rows of (log_id, user_id, activity_type, data_json) logs; runs in a worker process"""
+    outputs = {name: [] for name in OUTPUTS}
+    for log_id, user_id, activity_type, data_json in logs:
+        try:
+            for name, rows in DECODERS[activity_type](user_id, json.loads(data_json)).items():
+                outputs[name].extend(rows)
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError) as e:
+            logger.warning(f"Skipping unreadable {activity_type} log {log_id}: {e}")
+    return outputs
+
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class Outputs:
+    """The CSV files of an export, appended to chunk by chunk, and optionally the Parquet parts"""
+
+    def __init__(self, out_dir, sizes, parquet):
+        self.out_dir = out_dir
+        self.parquet = parquet
+        self.files = {}
+        self.writers = {}
+        self.rows_written = {name: 0 for name in OUTPUTS}
+
+        for name, columns in OUTPUTS.items():
+            path = os.path.join(out_dir, f"{name}.csv")
+            f = open(path, 'a+', encoding='utf-8', newline='')
+            # Drop rows appended after the last recorded watermark
+            f.truncate(sizes.get(name, 0))
+            f.seek(0, os.SEEK_END)
+            self.files[name] = f
+            self.writers[name] = csv.writer(f)
+            if f.tell() == 0:
+                self.writers[name].writerow(columns)
+
+    def write(self, outputs, first_id, last_id):
+        for name, rows in outputs.items():
+            self.writers[name].writerows(rows)
+            self.rows_written[name] += len(rows)
+            if self.parquet and rows:
+                write_parquet_part(self.out_dir, name, rows, first_id, last_id)
+
+    def close(self):
+        """Make the files durable; returns their sizes for the watermark"""
+        sizes = {}
+        for name, f in self.files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            sizes[name] = f.tell()
+            f.close()
+        return sizes
+
+
+def write_parquet_part(out_dir, name, rows, first_id, last_id):
+    import polars as pl
+
+    columns = OUTPUTS[name]
+    types = PARQUET_TYPES.get(name, {})
+    schema = {column: getattr(pl, types.get(column, 'String')) for column in columns}
+    values = [[value if value is None or column in types else str(value) for column, value in zip(columns, row)]
+              for row in rows]
+
+    directory = os.path.join(out_dir, 'parquet', name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{first_id:012d}-{last_id:012d}.parquet")
+    pl.DataFrame(values, schema=schema, orient='row').write_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def remove_parquet_parts(out_dir, after_id=0):
+    """Delete the Parquet parts of logs after `after_id` (all of them for 0)"""
+    root = os.path.join(out_dir, 'parquet')
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        for part in os.listdir(os.path.join(root, name)):
+            match = re.match(r'part-(\d+)-\d+\.parquet', part)
+            if match is None or int(match.group(1)) > after_id:
+                os.remove(os.path.join(root, name, part))
+
+
+def max_log_id(cnx):
+    """The largest committed log id, 0 without logs"""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT GREATEST(COALESCE((SELECT MAX(id) FROM activity_logs), 0), "
+            "COALESCE((SELECT MAX(id) FROM activity_log_submissions), 0))"
+        )
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def stream_submissions(cnx, after_id, up_to_id, chunk_size):
+    """
+    Chunks of (id, user_id, activity_type, data_json) submission logs with after_id < id <= up_to_id, in id
+    order, from activity_logs and from the submissions kept when partitions were archived
+    """
+    cursor = cnx.cursor(buffered=False)
+    try:
+        placeholders = ", ".join(["%s"] * len(EXPORTED_TYPES))
+        cursor.execute(
+            f"""
+            SELECT id, user_id, activity_type, data FROM (
+                SELECT id, user_id, activity_type, data
+                FROM activity_logs
+                WHERE activity_type IN ({placeholders}) AND id > %s AND id <= %s
+                UNION ALL
+                SELECT s.id, s.user_id, s.activity_type, s.data
+                FROM activity_log_submissions s
+                WHERE s.activity_type IN ({placeholders}) AND s.id > %s AND s.id <= %s
+                    AND NOT EXISTS (SELECT 1 FROM activity_logs l WHERE l.id = s.id)
+            ) submissions
+            ORDER BY id
+            """,
+            EXPORTED_TYPES + (after_id, up_to_id) + EXPORTED_TYPES + (after_id, up_to_id)
+        )
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        cursor.close()
+
+
+def export(cnx, out_dir, incremental=False, parquet=False, workers=None, chunk_size=CHUNK_SIZE,
+           exclude_prefixes=EXCLUDE_PREFIXES, margin_ids=MARGIN_IDS):
+    """
+    Export the submission logs after the watermark (all logs unless incremental) to out_dir, up to margin_ids
+    ids short of the largest log id.
+
+    Returns:
+        dict: rows written per output
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(out_dir) if incremental else None
+    if state is None:
+        missing = log_partitions.archives_without_submissions(cnx)
+        if missing:
+            raise RuntimeError(
+                f"Partitions {', '.join(missing)} were archived without keeping their submissions; a full export "
+                f"would leave their participants out. Restore them from the archive files first."
+            )
+        # Full export: reset the watermark first, so that an interrupted run is resumed from scratch
+        state = {'last_id': 0, 'sizes': {}, 'exported': {activity_type: [] for activity_type in EXPORTED_TYPES}}
+        save_state(out_dir, state)
+    remove_parquet_parts(out_dir, state['last_id'])
+
+    exported = {activity_type: set(user_ids) for activity_type, user_ids in state['exported'].items()}
+    exclude_prefixes = tuple(exclude_prefixes)
+    up_to_id = max_log_id(cnx) - margin_ids
+    outputs = Outputs(out_dir, state['sizes'], parquet)
+    last_id = state['last_id']
+    logs = 0
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # At most two chunks per worker are in flight; results are written in log order
+            pending = deque()
+            for chunk in stream_submissions(cnx, state['last_id'], up_to_id, chunk_size):
+                logs += len(chunk)
+                selected = []
+                for log in chunk:
+                    _, user_id, activity_type, _ = log
+                    if (user_id and not user_id.startswith(exclude_prefixes)
+                            and user_id not in exported[activity_type]):
+                        exported[activity_type].add(user_id)
+                        selected.append(log)
+                pending.append((last_id + 1, chunk[-1][0], executor.submit(decode_chunk, selected)))
+                last_id = chunk[-1][0]
+                while len(pending) >= 2 * workers:
+                    first, last, future = pending.popleft()
+                    outputs.write(future.result(), first, last)
+            while pending:
+                first, last, future = pending.popleft()
+                outputs.write(future.result(), first, last)
+    finally:
+        sizes = outputs.close()
+
+    save_state(out_dir, {
+        'last_id': last_id,
+        'sizes': sizes,
+        'exported': {activity_type: sorted(user_ids) for activity_type, user_ids in exported.items()},
+        'exported_at': datetime.now().isoformat(timespec='seconds'),
+    })
+    logger.info(f"Exported {logs} submission logs up to id {last_id} in {time.perf_counter() - start:.1f}s")
+    return outputs.rows_written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the study CSV files from activity_logs")
+    parser.add_argument("--out_dir", type=str, default=os.path.join(os.path.dirname(__file__), 'export'))
+    parser.add_argument("--incremental", action="store_true", help="export only the logs since the last run")
+    parser.add_argument("--parquet", action="store_true", help="also write Parquet parts (needs polars)")
+    parser.add_argument("--workers", type=int, default=None, help="decoding processes (defaults to the CPU count)")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--margin_ids", type=int, default=MARGIN_IDS,
+                        help="stop this many ids short of the largest log id, for transactions still in flight")
+    parser.add_argument("--exclude_prefix", type=str, nargs='*', default=list(EXCLUDE_PREFIXES),
+                        help="skip users whose id starts with one of these prefixes")
+    args = parser.parse_args()
+
+    import migrate
+    import production_server
+
+    cnx = production_server.create_db_connection(production_server.DB_NAME)
+    try:
+        migrate.apply_migrations(cnx)
+        rows = export(cnx, args.out_dir, args.incremental, args.parquet, args.workers, args.chunk_size,
+                      args.exclude_prefix, args.margin_ids)
+    finally:
+        cnx.close()
+    for name, count in rows.items():
+        print(f"{count:>8} rows -> {os.path.join(args.out_dir, name)}.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+LLM ratings of recipes for the study server (/server/api/llm/rate-recipes-*).
+
+The prompts and the parsing of the model output are those of the benchmark
+(benchmarking/evaluation/recipe/evaluate_recipe.py), so the study and the offline runs rate recipes the same way.
+
+The benchmarking directory must be on the Python path (PYTHONPATH=../benchmarking from webapp).
+
+Each (user, context, recipe) triple is one model call, keyed by a hash of everything that goes into the prompt
+(the prompt includes the user id, as in the benchmark):
+- finished ratings are kept in an LRU cache, so repeated requests are answered without a model call;
+- a triple that is already being rated is not submitted again: concurrent requests share its future;
+- calls run on a few worker threads (at most `max_concurrency` calls reach the backend at once), never on
+  the request threads, and pending calls are taken round-robin per user, so a participant waits for their
+  own ratings only and not behind the ones queued by other participants;
+- at most `max_pending` ratings are queued or running; further submissions raise QueueFullError.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import simplejson as json
+
+from evaluation.recipe.evaluate_recipe import OPTIONS, build_messages, parse_response
+from prompts.prompt_R import prompt_recipe
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TYPES = tuple(prompt_recipe)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class OllamaBackend:
+    """Chat calls to an Ollama server"""
+
+    def __init__(self, model, host=None, timeout=120.0):
+        import ollama
+
+        self.model = model
+        self.client = ollama.Client(host=host, timeout=timeout)
+
+    def chat(self, messages, options):
+        response = self.client.chat(model=self.model, messages=messages, options=options)
+        return response['message']['content']
+
+
+class MockBackend:
+    """Deterministic ratings without a model server, for tests and load tests"""
+
+    def __init__(self, model='mock', latency=0.0):
+        self.model = model
+        self.latency = latency
+
+    def chat(self, messages, options):
+        time.sleep(self.latency)
+        digest = hashlib.sha256(json.dumps(messages).encode('utf-8')).digest()
+        return json.dumps({'score': digest[0] % 5 + 1, 'short_review': 'Mock review.'})
+
+
+def create_backend(name, model, host=None, timeout=120.0, mock_latency=0.0):
+    if name == 'ollama':
+        return OllamaBackend(model, host, timeout)
+    if name == 'mock':
+        return MockBackend(model, mock_latency)
+    raise ValueError(f"Unknown LLM backend: {name}")
+
+
+def recipe_text(recipe):
+    """(title, ingredients, instructions) of a catalog recipe, formatted like the benchmark's recipe texts"""
+    return recipe['name'], ', '.join(i.strip() for i in recipe['ingredients_list']), \
+        ' '.join(d.strip() for d in recipe['directions'])
+
+
+def rating_key(model, user_id, context_type, context_text, recipe_id, title, ingredients, instructions):
+    payload = json.dumps([model, OPTIONS, user_id, context_type, context_text, recipe_id, title, ingredients,
+                          instructions])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class FairQueue:
+    """Work queue served round-robin over its owners (users), holding at most `max_items` items"""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._queues = OrderedDict()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def put(self, owner, item):
+        with self._cond:
+            if self._size >= self.max_items:
+                raise QueueFullError(f"{self._size} items queued")
+            self._queues.setdefault(owner, deque()).append(item)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            while not self._queues:
+                self._cond.wait()
+            owner, items = next(iter(self._queues.items()))
+            item = items.popleft()
+            self._size -= 1
+            if items:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            return item
+
+    def __len__(self):
+        with self._cond:
+            return self._size
+
+
+class RecipeRater:
+    def __init__(self, backend, max_concurrency=4, cache_size=10000, max_pending=200):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.cache_size = cache_size
+        self.max_pending = max_pending
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._queue = FairQueue(max_pending)
+        self._workers = []
+
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.rated = 0
+        self.errors = 0
+        self.latency_observers = []
+
+    def _start_workers(self):
+        # under self._lock
+        while len(self._workers) < self.max_concurrency:
+            worker = threading.Thread(target=self._run, name=f"llm-rater-{len(self._workers)}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, user_id, context_type, context_text, recipe_id, title, ingredients, instructions):
+        """
+        Rate a recipe for a context in the background.
+
+        Returns:
+            Future: resolves to the parsed model output ({'score': ..., 'short_review': ...})
+        Raises:
+            QueueFullError: when `max_pending` ratings are already queued or running
+        """
+        messages = build_messages(user_id, context_text, context_type, recipe_id, title, ingredients, instructions)
+        key = rating_key(self.backend.model, user_id, context_type, context_text, recipe_id, title, ingredients,
+                         instructions)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                future = Future()
+                future.set_result(self._cache[key])
+                return future
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if len(self._inflight) >= self.max_pending:
+                self.rejected += 1
+                raise QueueFullError(f"{len(self._inflight)} ratings pending")
+            future = self._inflight[key] = Future()
+            self._start_workers()
+            # Under the lock, so that the queue never holds more than the pending ratings
+            self._queue.put(user_id, (key, future, messages))
+        return future
+
+    def _run(self):
+        while True:
+            key, future, messages = self._queue.get()
+            start = time.perf_counter()
+            try:
+                result = parse_response(self.backend.chat(messages, OPTIONS))
+            except Exception as e:
+                logger.warning(f"LLM rating failed: {e}")
+                with self._lock:
+                    self.errors += 1
+                    del self._inflight[key]
+                # Not cached: a later request calls the model again
+                future.set_exception(e)
+                continue
+            finally:
+                elapsed = time.perf_counter() - start
+                for observer in self.latency_observers:
+                    observer(elapsed)
+
+            with self._lock:
+                self.rated += 1
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                del self._inflight[key]
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': len(self._cache),
+                'in_flight': len(self._inflight),
+                'queued': len(self._queue),
+                'cache_hits': self.cache_hits,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'rated': self.rated,
+                'errors': self.errors,
+            }
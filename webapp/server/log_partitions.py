@@ -0,0 +1,498 @@
+"""
+Time-partitioned storage, rollups and archival for activity_logs.
+
+- partition: converts activity_logs to monthly RANGE partitions on timestamp (p202601 holds January 2026,
+  p_future catches everything after the last month). Rows of the current study wave then live in one small
+  partition, and queries bounded by timestamp only read the partitions of their range. The server adds the
+  partitions of the coming months at startup.
+- rollup: compacts completed users into one activity_log_rollups row each (proposed recipes, completion,
+  ratings, number of events per type) and deletes their high-volume events (focus changes, directions
+  toggles, ...). Submissions, proposals and completions are kept. Also forgets the ids of events
+  ingested more than EVENT_ID_RETENTION_DAYS ago (see log_sink.insert_activity_events).
+- archive: writes the rows of cold monthly partitions to gzipped JSON lines files, records them in
+  activity_log_archives and drops the partitions. Submissions (SUBMISSION_TYPES) are first copied to
+  activity_log_submissions, which is never archived, so the study data outlives the partition.
+
+Usage:
+    python server/log_partitions.py status
+    python server/log_partitions.py partition [--months_ahead 3]
+    python server/log_partitions.py rollup [--older_than_days 7] [--keep_events]
+    python server/log_partitions.py archive --before 2026-01 [--archive_dir server/archive]
+"""
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import time
+from collections import Counter
+from datetime import date, datetime
+
+import simplejson as json
+
+import log_sink
+import proposal_store
+
+logger = logging.getLogger(__name__)
+
+FUTURE_PARTITION = 'p_future'
+MONTHS_AHEAD = 3
+ROLLUP_BATCH_SIZE = 200
+ARCHIVE_FETCH_SIZE = 5000
+EVENT_ID_RETENTION_DAYS = int(os.getenv("EVENT_ID_RETENTION_DAYS", 30))
+ARCHIVE_DIR = os.getenv("ACTIVITY_LOG_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), 'archive'))
+
+# Events kept for completed users after a rollup; everything else is only counted in the rollup row
+ROLLUP_KEEP_TYPES = (
+    'study-started',
+    'informed-consent-submitted',
+    'static-context-submitted',
+    'questionnaires-submitted',
+    'recipes_fetched',
+    'recipe-ratings-static-submitted',
+    'study_completed',
+)
+
+# Participant submissions, copied to activity_log_submissions before their partition is dropped
+SUBMISSION_TYPES = (
+    'informed-consent-submitted',
+    'static-context-submitted',
+    'context-review-submitted',
+    'questionnaires-submitted',
+    'recipe-ratings-static-submitted',
+    'recipe-ratings-dynamic-submitted',
+    'rating-comparison-static-submitted',
+    'rating-comparison-dynamic-submitted',
+)
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS activity_log_rollups (
+        user_id VARCHAR(255) PRIMARY KEY,
+        first_seen DATETIME NOT NULL,
+        last_seen DATETIME NOT NULL,
+        completed_at DATETIME NULL,
+        recipe_ids JSON,
+        ratings JSON,
+        event_counts JSON,
+        rolled_up_at DATETIME NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS activity_log_archives (
+        partition_name VARCHAR(64) PRIMARY KEY,
+        file_path VARCHAR(1024) NOT NULL,
+        row_count INT NOT NULL,
+        sha256 CHAR(64) NOT NULL,
+        archived_at DATETIME NOT NULL
+    )
+    """,
+)
+
+
+SUBMISSIONS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS activity_log_submissions (
+        id INT PRIMARY KEY,
+        user_id VARCHAR(255) NOT NULL,
+        activity_type VARCHAR(100) NOT NULL,
+        data JSON,
+        timestamp DATETIME NOT NULL,
+        INDEX idx_user_id_activity_type (user_id, activity_type)
+    )
+"""
+
+
+def ensure_schema(cnx):
+    cursor = cnx.cursor()
+    try:
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def ensure_submissions_schema(cnx):
+    """activity_log_submissions, and activity_log_archives.submissions_kept (NULL for older archives)"""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(SUBMISSIONS_SCHEMA)
+        cursor.execute(
+            """
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = 'activity_log_archives'
+                AND column_name = 'submissions_kept'
+            """
+        )
+        if cursor.fetchone() is None:
+            cursor.execute("ALTER TABLE activity_log_archives ADD COLUMN submissions_kept INT NULL")
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def archives_without_submissions(cnx):
+    """Archived partitions whose submissions were not copied to activity_log_submissions"""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT partition_name FROM activity_log_archives WHERE submissions_kept IS NULL ORDER BY partition_name"
+        )
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def partition_month(name):
+    return date(int(name[1:5]), int(name[5:7]), 1)
+
+
+def _partition_clause(month):
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{add_months(month, 1).isoformat()}'))"
+
+
+def list_partitions(cnx):
+    """(name, estimated rows) of every activity_logs partition in range order; empty if not partitioned"""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("""
+            SELECT partition_name, table_rows
+            FROM information_schema.partitions
+            WHERE table_schema = DATABASE() AND table_name = 'activity_logs' AND partition_name IS NOT NULL
+            ORDER BY partition_ordinal_position
+        """)
+        return [(name, rows) for name, rows in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def partition_activity_logs(cnx, months_ahead=MONTHS_AHEAD):
+    """
+    Convert activity_logs to monthly partitions, from the month of its oldest row to months_ahead months
+    from now. MySQL requires the partitioning column in every unique key, so the primary key becomes
+    (id, timestamp); id stays AUTO_INCREMENT and unique. Rebuilds the table: run it between study waves.
+
+    Returns:
+        bool: False if the table was already partitioned
+    """
+    if list_partitions(cnx):
+        return False
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT MIN(timestamp) FROM activity_logs")
+        oldest = cursor.fetchone()[0] or datetime.now()
+        first = date(oldest.year, oldest.month, 1)
+        last = add_months(date.today().replace(day=1), months_ahead)
+        months = []
+        month = first
+        while month <= last:
+            months.append(month)
+            month = add_months(month, 1)
+
+        start = time.perf_counter()
+        cursor.execute("ALTER TABLE activity_logs DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)")
+        cursor.execute(
+            "ALTER TABLE activity_logs PARTITION BY RANGE (TO_DAYS(timestamp)) ("
+            + ", ".join(_partition_clause(month) for month in months)
+            + f", PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE)"
+        )
+        logger.info(f"Partitioned activity_logs into {len(months)} monthly partitions "
+                    f"in {time.perf_counter() - start:.1f}s")
+        return True
+    finally:
+        cursor.close()
+
+
+def ensure_future_partitions(cnx, months_ahead=MONTHS_AHEAD):
+    """
+    Split the monthly partitions up to months_ahead from now off p_future (normally empty, so this
+    is cheap). Does nothing if activity_logs is not partitioned.
+
+    Returns:
+        list: names of the partitions added
+    """
+    names = [name for name, _ in list_partitions(cnx) if name != FUTURE_PARTITION]
+    if not names:
+        return []
+
+    month = add_months(partition_month(names[-1]), 1)
+    last = add_months(date.today().replace(day=1), months_ahead)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    if not months:
+        return []
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            f"ALTER TABLE activity_logs REORGANIZE PARTITION {FUTURE_PARTITION} INTO ("
+            + ", ".join(_partition_clause(month) for month in months)
+            + f", PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE)"
+        )
+    finally:
+        cursor.close()
+    added = [partition_name(month) for month in months]
+    logger.info(f"Added activity_logs partitions {', '.join(added)}")
+    return added
+
+
+def _summarize(user_id, completed_at, rows):
+    event_counts = Counter()
+    recipe_ids = []
+    ratings = []
+    for activity_type, data_json, _ in rows:
+        event_counts[activity_type] += 1
+        try:
+            if activity_type == 'recipes_fetched':
+                recipe_ids = proposal_store.recipe_ids_from_log(data_json)
+            elif activity_type == 'recipe-ratings-static-submitted':
+                ratings = json.loads(data_json).get('ratings', [])
+        except (json.JSONDecodeError, AttributeError, TypeError) as e:
+            logger.warning(f"Unreadable {activity_type} payload of {user_id}: {e}")
+    timestamps = [timestamp for _, _, timestamp in rows]
+    return (
+        user_id,
+        min(timestamps),
+        max(timestamps),
+        completed_at,
+        json.dumps(recipe_ids),
+        json.dumps(ratings),
+        json.dumps(dict(event_counts)),
+    )
+
+
+def rollup_completed_users(cnx, older_than_days=7, batch_size=ROLLUP_BATCH_SIZE, delete_events=True):
+    """
+    Write one activity_log_rollups row per user who completed the study more than older_than_days ago
+    and has no rollup yet, then delete the user's events whose type is not in ROLLUP_KEEP_TYPES.
+    Works through the users batch_size at a time, one transaction per batch.
+
+    Returns:
+        tuple: (users rolled up, log rows deleted)
+    """
+    users_done = deleted = 0
+    while True:
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT c.user_id, c.completed_at
+                FROM recipe_proposal_completions c
+                LEFT JOIN activity_log_rollups r ON r.user_id = c.user_id
+                WHERE r.user_id IS NULL AND c.completed_at < NOW() - INTERVAL %s DAY
+                ORDER BY c.user_id
+                LIMIT %s
+                """,
+                (older_than_days, batch_size)
+            )
+            completed = dict(cursor.fetchall())
+            if not completed:
+                break
+
+            placeholders = ", ".join(["%s"] * len(completed))
+            cursor.execute(
+                f"""
+                SELECT user_id, activity_type, data, timestamp
+                FROM activity_logs
+                WHERE user_id IN ({placeholders})
+                ORDER BY timestamp, id
+                """,
+                list(completed)
+            )
+            rows_by_user = {}
+            for user_id, activity_type, data_json, timestamp in cursor.fetchall():
+                rows_by_user.setdefault(user_id, []).append((activity_type, data_json, timestamp))
+
+            summaries = []
+            for user_id, completed_at in completed.items():
+                rows = rows_by_user.get(user_id) or [('study_completed', None, completed_at)]
+                summaries.append(_summarize(user_id, completed_at, rows))
+            cursor.executemany(
+                """
+                INSERT IGNORE INTO activity_log_rollups
+                    (user_id, first_seen, last_seen, completed_at, recipe_ids, ratings, event_counts, rolled_up_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+                """,
+                summaries
+            )
+            if delete_events:
+                keep = ", ".join(["%s"] * len(ROLLUP_KEEP_TYPES))
+                cursor.execute(
+                    f"DELETE FROM activity_logs WHERE user_id IN ({placeholders}) AND activity_type NOT IN ({keep})",
+                    list(completed) + list(ROLLUP_KEEP_TYPES)
+                )
+                deleted += cursor.rowcount
+            cnx.commit()
+            users_done += len(completed)
+        except Exception:
+            cnx.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    logger.info(f"Rolled up {users_done} completed users, deleted {deleted} log rows")
+    return users_done, deleted
+
+
+def _unrolled_completions(cursor, name):
+    cursor.execute(
+        f"""
+        SELECT COUNT(DISTINCT l.user_id)
+        FROM activity_logs PARTITION ({name}) l
+        LEFT JOIN activity_log_rollups r ON r.user_id = l.user_id
+        WHERE l.activity_type = 'study_completed' AND r.user_id IS NULL
+        """
+    )
+    return cursor.fetchone()[0]
+
+
+def archive_partition(cnx, name, archive_dir=ARCHIVE_DIR, fetch_size=ARCHIVE_FETCH_SIZE):
+    """
+    Stream one partition to <archive_dir>/activity_logs_<name>.jsonl.gz, copy its submissions to
+    activity_log_submissions, then drop it. The file is written under a temporary name, fsynced and
+    renamed, and the copy is committed, before the partition is dropped.
+
+    Returns:
+        tuple: (file path, rows archived)
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"activity_logs_{name}.jsonl.gz")
+    tmp_path = path + ".tmp"
+
+    rows = 0
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(f"SELECT id, user_id, activity_type, data, timestamp FROM activity_logs PARTITION ({name})")
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as out:
+                while True:
+                    chunk = cursor.fetchmany(fetch_size)
+                    if not chunk:
+                        break
+                    for log_id, user_id, activity_type, data_json, timestamp in chunk:
+                        out.write((json.dumps({
+                            'id': log_id,
+                            'user_id': user_id,
+                            'activity_type': activity_type,
+                            'data': data_json,
+                            'timestamp': timestamp.isoformat(),
+                        }) + "\n").encode('utf-8'))
+                    rows += len(chunk)
+            raw.flush()
+            os.fsync(raw.fileno())
+    finally:
+        cursor.close()
+    os.replace(tmp_path, path)
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    cursor = cnx.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(SUBMISSION_TYPES))
+        cursor.execute(
+            f"""
+            INSERT IGNORE INTO activity_log_submissions (id, user_id, activity_type, data, timestamp)
+            SELECT id, user_id, activity_type, data, timestamp
+            FROM activity_logs PARTITION ({name})
+            WHERE activity_type IN ({placeholders})
+            """,
+            SUBMISSION_TYPES
+        )
+        submissions = cursor.rowcount
+        cursor.execute(
+            """
+            REPLACE INTO activity_log_archives
+                (partition_name, file_path, row_count, sha256, submissions_kept, archived_at)
+            VALUES (%s, %s, %s, %s, %s, NOW())
+            """,
+            (name, os.path.abspath(path), rows, digest.hexdigest(), submissions)
+        )
+        cnx.commit()
+        cursor.execute(f"ALTER TABLE activity_logs DROP PARTITION {name}")
+    finally:
+        cursor.close()
+    logger.info(f"Archived partition {name} ({rows} rows, {submissions} submissions kept) to {path}")
+    return path, rows
+
+
+def archive_partitions(cnx, before, archive_dir=ARCHIVE_DIR, force=False):
+    """
+    Archive every monthly partition whose month starts before `before` (a date).
+    A partition holding completions of users without a rollup row is skipped unless force is set:
+    their study_completed rows are still needed to rebuild the proposal counts.
+    """
+    archived = []
+    for name, _ in list_partitions(cnx):
+        if name == FUTURE_PARTITION or partition_month(name) >= before:
+            continue
+        cursor = cnx.cursor()
+        try:
+            missing = _unrolled_completions(cursor, name)
+        finally:
+            cursor.close()
+        if missing and not force:
+            logger.warning(f"Skipping partition {name}: {missing} completed users are not rolled up yet")
+            continue
+        archived.append(archive_partition(cnx, name, archive_dir))
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partition, roll up and archive activity_logs")
+    parser.add_argument("command", choices=["status", "partition", "rollup", "archive"])
+    parser.add_argument("--months_ahead", type=int, default=MONTHS_AHEAD)
+    parser.add_argument("--older_than_days", type=int, default=7, help="roll up users completed before this")
+    parser.add_argument("--keep_events", action="store_true", help="write rollups without deleting events")
+    parser.add_argument("--before", type=str, help="archive partitions of months before YYYY-MM")
+    parser.add_argument("--archive_dir", type=str, default=ARCHIVE_DIR)
+    parser.add_argument("--force", action="store_true", help="archive partitions with users not rolled up")
+    args = parser.parse_args()
+
+    import migrate
+    import production_server
+
+    cnx = production_server.create_db_connection(production_server.DB_NAME)
+    try:
+        migrate.apply_migrations(cnx)
+        if args.command == "status":
+            partitions = list_partitions(cnx)
+            if not partitions:
+                print("activity_logs is not partitioned")
+            for name, rows in partitions:
+                print(f"{name:<10} ~{rows} rows")
+        elif args.command == "partition":
+            if partition_activity_logs(cnx, args.months_ahead):
+                print("activity_logs is now partitioned by month")
+            else:
+                print(f"Already partitioned; added {ensure_future_partitions(cnx, args.months_ahead)}")
+        elif args.command == "rollup":
+            users, deleted = rollup_completed_users(cnx, args.older_than_days, delete_events=not args.keep_events)
+            print(f"Rolled up {users} users, deleted {deleted} log rows")
+            print(f"Forgot {log_sink.prune_event_ids(cnx, EVENT_ID_RETENTION_DAYS)} event ids")
+        else:
+            if not args.before:
+                parser.error("archive needs --before YYYY-MM")
+            before = datetime.strptime(args.before, "%Y-%m").date()
+            for path, rows in archive_partitions(cnx, before, args.archive_dir, args.force):
+                print(f"{rows:>9} rows -> {path}")
+    finally:
+        cnx.close()
+
+
+if __name__ == "__main__":
+    main()
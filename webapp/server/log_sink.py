@@ -0,0 +1,309 @@
+"""
+Background writer for activity_logs.
+
+Request handlers enqueue rows and return; a single writer thread inserts them with executemany in one
+transaction per batch, flushing when `batch_size` rows are queued or `flush_interval` seconds after the
+first queued row. When the queue is full, the calling thread writes its row synchronously, so memory stays
+bounded and no event is dropped because of back-pressure.
+
+Rows are (event_id, user_id, activity_type, data_json, timestamp) events. An event that carries an id is
+stored at most once: RecentEventIds turns away most repeats before they are queued, and the
+activity_log_event_ids ledger catches the rest (repeats after a restart, spool replays, other processes).
+"""
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import mysql.connector
+from mysql.connector import errorcode
+
+logger = logging.getLogger(__name__)
+
+INSERT_ACTIVITY_LOG = "INSERT INTO activity_logs (user_id, activity_type, data, timestamp) VALUES (%s, %s, %s, %s)"
+
+# Ids of the events already stored, for events that carry one (spooled events, client retries)
+EVENT_IDS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS activity_log_event_ids (
+        event_id VARCHAR(64) PRIMARY KEY,
+        claimed_by CHAR(32) NOT NULL,
+        created_at DATETIME NOT NULL,
+        INDEX idx_created_at (created_at)
+    )
+"""
+
+CLAIM_EVENT_ID = (
+    "INSERT IGNORE INTO activity_log_event_ids (event_id, claimed_by, created_at) VALUES (%s, %s, NOW())"
+)
+
+PRUNE_EVENT_IDS = "DELETE FROM activity_log_event_ids WHERE created_at < NOW() - INTERVAL %s DAY LIMIT %s"
+PRUNE_BATCH_SIZE = 10000
+
+# Errors caused by the values of a row (too long, wrong type or JSON, NULL in a NOT NULL column): writing
+# the row again cannot succeed, unlike a lost connection, a lock wait timeout or a deadlock
+ROW_DATA_ERRNOS = {
+    errorcode.ER_BAD_NULL_ERROR, errorcode.ER_WARN_DATA_OUT_OF_RANGE, errorcode.WARN_DATA_TRUNCATED,
+    errorcode.ER_TRUNCATED_WRONG_VALUE, errorcode.ER_TRUNCATED_WRONG_VALUE_FOR_FIELD, errorcode.ER_DATA_TOO_LONG,
+    errorcode.ER_INVALID_JSON_TEXT, errorcode.ER_INVALID_JSON_TEXT_IN_PARAM,
+}
+
+_STOP = object()
+
+
+def is_row_data_error(error):
+    """True if `error` was caused by the rows being written rather than by the database being unavailable"""
+    if isinstance(error, (mysql.connector.errors.DataError, mysql.connector.errors.IntegrityError)):
+        return True
+    if isinstance(error, mysql.connector.Error):
+        return error.errno in ROW_DATA_ERRNOS
+    # Values the driver cannot convert
+    return isinstance(error, (TypeError, ValueError))
+
+
+def select_claimed_ids(count):
+    placeholders = ", ".join(["%s"] * count)
+    return f"SELECT event_id FROM activity_log_event_ids WHERE event_id IN ({placeholders}) AND claimed_by = %s"
+
+
+def new_event_rows(events, claimed):
+    """The activity_logs rows of the events without an id and of the first copy of each claimed id"""
+    claimed = set(claimed)
+    rows = []
+    for event_id, *row in events:
+        if event_id is None:
+            rows.append(row)
+        elif event_id in claimed:
+            claimed.discard(event_id)
+            rows.append(row)
+    return rows
+
+
+def ensure_event_id_schema(cnx):
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(EVENT_IDS_SCHEMA)
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def insert_activity_events(cnx, events):
+    """
+    Insert (event_id, user_id, activity_type, data_json, timestamp) events in a single transaction,
+    skipping events whose event_id is already stored (or repeated within the batch). Events without an
+    event_id are always inserted.
+
+    The ids are claimed with INSERT IGNORE under a token unique to this call; the events whose id carries
+    the token are the new ones. A concurrent transaction claiming the same id waits on the primary key
+    until this one commits and then skips it.
+
+    Returns:
+        int: the number of rows inserted
+    """
+    cursor = cnx.cursor()
+    try:
+        ids = list(dict.fromkeys(event[0] for event in events if event[0] is not None))
+        claimed = []
+        if ids:
+            token = uuid.uuid4().hex
+            cursor.executemany(CLAIM_EVENT_ID, [(event_id, token) for event_id in ids])
+            cursor.execute(select_claimed_ids(len(ids)), ids + [token])
+            claimed = [row[0] for row in cursor.fetchall()]
+
+        rows = new_event_rows(events, claimed)
+        if rows:
+            cursor.executemany(INSERT_ACTIVITY_LOG, rows)
+        cnx.commit()
+        return len(rows)
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def prune_event_ids(cnx, older_than_days=30, batch_size=PRUNE_BATCH_SIZE, max_batches=None):
+    """
+    Forget event ids older than any realistic retry or spool replay, batch_size rows per transaction,
+    until none are left or max_batches batches were deleted.
+
+    Returns:
+        int: the number of ids deleted
+    """
+    deleted = batches = 0
+    cursor = cnx.cursor()
+    try:
+        while max_batches is None or batches < max_batches:
+            cursor.execute(PRUNE_EVENT_IDS, (older_than_days, batch_size))
+            cnx.commit()
+            deleted += cursor.rowcount
+            batches += 1
+            if cursor.rowcount < batch_size:
+                break
+        return deleted
+    finally:
+        cursor.close()
+
+
+class RecentEventIds:
+    """Bounded LRU of the event ids accepted by this process"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def claim(self, event_id):
+        """Remember event_id; False if it was accepted recently (the event is a repeat)"""
+        with self._lock:
+            if event_id in self._ids:
+                self._ids.move_to_end(event_id)
+                self.hits += 1
+                return False
+            self._ids[event_id] = None
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+            return True
+
+    def forget(self, event_ids):
+        """Release ids whose events were not stored, so that a retry is accepted"""
+        with self._lock:
+            for event_id in event_ids:
+                self._ids.pop(event_id, None)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class ActivityLogSink:
+    def __init__(self, connect, max_queue=10000, batch_size=200, flush_interval=0.5, put_timeout=0.05):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.enqueued = 0
+        self.written = 0
+        self.duplicates = 0
+        self.batches = 0
+        self.failed = 0
+        self.overflow_writes = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="activity-log-writer", daemon=True)
+                self._thread.start()
+
+    def _insert(self, rows):
+        cnx = self.connect()
+        try:
+            inserted = insert_activity_events(cnx, rows)
+        finally:
+            cnx.close()
+        self.written += inserted
+        self.duplicates += len(rows) - inserted
+
+    def write(self, rows):
+        """
+        Write rows now, on the calling thread. Returns True if every row was stored.
+
+        If MySQL rejects a row of the batch (see is_row_data_error), the rows are written one at a time, so
+        that only the rejected ones are dropped; the batch is one transaction, so none of it was stored.
+        """
+        try:
+            self._insert(rows)
+            return True
+        except Exception as e:
+            if len(rows) > 1 and is_row_data_error(e):
+                logger.warning(f"Activity log batch of {len(rows)} rows rejected, writing them one by one: {e}")
+                return self._write_each(rows)
+            self.failed += len(rows)
+            logger.error(f"Failed to log activity ({len(rows)} rows): {e}")
+            return False
+
+    def _write_each(self, rows):
+        stored = True
+        for i, row in enumerate(rows):
+            try:
+                self._insert([row])
+            except Exception as e:
+                stored = False
+                if is_row_data_error(e):
+                    self.failed += 1
+                    logger.error(f"Dropping activity log of user {row[1]} ({row[2]}) rejected by MySQL: {e}")
+                    continue
+                # The database became unavailable: the rest of the batch cannot be written either
+                self.failed += len(rows) - i
+                logger.error(f"Failed to log activity ({len(rows) - i} rows): {e}")
+                break
+        return stored
+
+    def submit(self, row):
+        """
+        Queue a row for the writer thread, or write it synchronously if the queue stays full.
+        Returns False if the synchronous write failed.
+        """
+        self.start()
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+            self.enqueued += 1
+            return True
+        except queue.Full:
+            self.overflow_writes += 1
+            return self.write([row])
+
+    def _next_batch(self):
+        """Block for the first row, then collect more until the batch is full or the interval has passed"""
+        first = self._queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                row = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is _STOP:
+                # Flush what we have, then stop on the next iteration
+                self._queue.put(_STOP)
+                break
+            batch.append(row)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if self.write(batch):
+                self.batches += 1
+
+    def shutdown(self, timeout=10.0):
+        """Drain the queue to the database and stop the writer thread"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        logger.info(f"Flushing {self._queue.qsize()} queued activity logs before shutdown")
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'duplicates': self.duplicates,
+            'batches': self.batches,
+            'failed': self.failed,
+            'overflow_writes': self.overflow_writes,
+        }
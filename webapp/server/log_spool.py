@@ -0,0 +1,413 @@
+"""
+Durable local spool for activity log events.
+
+Request threads append events to the current segment file and fsync it before they respond, so an event
+that was acknowledged survives a MySQL outage or a server restart. Concurrent appenders share fsyncs:
+the thread that syncs covers everything written before it took the file lock. A replayer thread drains
+the segments to MySQL in append order and records its position in a checkpoint file; each event carries
+an event id, so a batch that is replayed again after a crash between the commit and the checkpoint
+is skipped by the event id ledger (see log_sink.insert_activity_events).
+
+Segments are rotated at `segment_bytes` and deleted once replayed. When the spool holds `max_bytes`,
+appends fail with SpoolFullError and the caller writes to MySQL directly.
+
+`write_events` returns False while MySQL is unavailable, and the batch is retried. If it raises instead
+(an event MySQL rejects, e.g. a value too long for its column), the events of the batch are written one by
+one and those that still fail are moved to the dead-letter file, so that one bad event does not hold up
+the whole spool.
+
+Each line of a segment is `<crc32 hex> <json>`; a torn last line (crash during a write) is ignored.
+
+Usage:
+    python server/log_spool.py inspect [--dir DIR]
+    python server/log_spool.py replay [--dir DIR]
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+import simplejson as json
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock between processes sharing a spool directory
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+CHECKPOINT_FILE = 'checkpoint.json'
+LOCK_FILE = 'spool.lock'
+DEAD_LETTER_FILE = 'dead-letter.log'
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+class SpoolLockedError(Exception):
+    pass
+
+
+def encode_event(event, error=None):
+    event_id, user_id, activity_type, data_json, timestamp = event
+    record = {
+        'event_id': event_id,
+        'user_id': user_id,
+        'type': activity_type,
+        'data': data_json,
+        'timestamp': timestamp.isoformat(),
+    }
+    if error is not None:
+        record['error'] = error
+    payload = json.dumps(record).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def decode_line(line):
+    """The event of a complete segment line, or None if the line is corrupt"""
+    try:
+        crc, payload = line.rstrip(b'\n').split(b' ', 1)
+        if int(crc, 16) != zlib.crc32(payload):
+            return None
+        record = json.loads(payload)
+        return (record['event_id'], record['user_id'], record['type'], record['data'],
+                datetime.fromisoformat(record['timestamp']))
+    except (ValueError, KeyError):
+        return None
+
+
+class LogSpool:
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise SpoolLockedError(f"Spool {directory} is used by another process")
+
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self.appended = 0
+        self.full_errors = 0
+        self.dead_lettered = 0
+
+        # Appends always go to a new segment, opened on the first append: the tail of the previous
+        # segment may be a torn line
+        segments = self.segments()
+        self._index = self._segment_index(segments[-1]) + 1 if segments else 1
+        self._bytes = sum(os.path.getsize(self._path(name)) for name in segments)
+        self._file = None
+        self._file_size = 0
+
+    @staticmethod
+    def _segment_index(name):
+        return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open_segment(self):
+        self._file = open(self._path(f"{SEGMENT_PREFIX}{self._index:010d}{SEGMENT_SUFFIX}"), 'ab')
+        self._file_size = 0
+        # Make the new file's directory entry durable too
+        dir_fd = os.open(self.directory, os.O_RDONLY) if hasattr(os, 'O_DIRECTORY') else None
+        if dir_fd is not None:
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _rotate(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._synced = self._written
+        self._index += 1
+        self._open_segment()
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+    def active_segment(self):
+        with self._lock:
+            return os.path.basename(self._file.name) if self._file is not None else None
+
+    def append(self, events):
+        """Write (event_id, user_id, activity_type, data_json, timestamp) events durably; assigns missing ids"""
+        data = b''.join(encode_event((event_id or uuid.uuid4().hex, *rest)) for event_id, *rest in events)
+        with self._lock:
+            if self._bytes + len(data) > self.max_bytes:
+                self.full_errors += 1
+                raise SpoolFullError(f"Log spool is full ({self._bytes} bytes)")
+            if self._file is None:
+                self._open_segment()
+            elif self._file_size >= self.segment_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            self._file_size += len(data)
+            self._bytes += len(data)
+            self._written += 1
+            self.appended += len(events)
+            ticket = self._written
+
+        # Group commit: one fsync covers every append written before it
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return
+            with self._lock:
+                target = self._written
+                os.fsync(self._file.fileno())
+                self._synced = target
+
+    def load_checkpoint(self):
+        try:
+            with open(self._path(CHECKPOINT_FILE), 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            return checkpoint['segment'], checkpoint['offset']
+        except (OSError, ValueError, KeyError):
+            return None, 0
+
+    def save_checkpoint(self, segment, offset):
+        """Atomically record the replay position and delete the segments replayed completely"""
+        tmp_path = self._path(CHECKPOINT_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'segment': segment, 'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(CHECKPOINT_FILE))
+
+        for name in self.segments():
+            if name >= segment:
+                break
+            size = os.path.getsize(self._path(name))
+            os.remove(self._path(name))
+            with self._lock:
+                self._bytes -= size
+
+    def read(self, position, limit):
+        """
+        Up to `limit` events after `position` ((segment, offset) or (None, 0) for the start), in order.
+
+        Returns:
+            tuple: (events, position after the last returned event)
+        """
+        segment, offset = position
+        segments = self.segments()
+        if segment is None or segment not in segments:
+            # Start of the spool (or the checkpointed segment is gone): begin with the oldest segment
+            segment = next((name for name in segments if segment is None or name > segment), None)
+            offset = 0
+            if segment is None:
+                return [], position
+
+        active = self.active_segment()
+        events = []
+        while len(events) < limit:
+            with open(self._path(segment), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # A line still being written (active segment) or torn by a crash (older segment)
+                        break
+                    offset += len(line)
+                    event = decode_line(line)
+                    if event is None:
+                        logger.warning(f"Skipping corrupt line in spool segment {segment}")
+                        continue
+                    events.append(event)
+                    if len(events) >= limit:
+                        break
+            if len(events) >= limit or segment == active:
+                break
+            following = [name for name in segments if name > segment]
+            if not following:
+                break
+            segment, offset = following[0], 0
+        return events, (segment, offset)
+
+    def dead_letter(self, event, error):
+        """Durably set aside an event that cannot be written, with the reason, before the checkpoint passes it"""
+        with open(self._path(DEAD_LETTER_FILE), 'ab') as f:
+            f.write(encode_event(event, str(error)))
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self.dead_lettered += 1
+
+    def dead_letters(self):
+        """The events in the dead-letter file"""
+        try:
+            with open(self._path(DEAD_LETTER_FILE), 'rb') as f:
+                return [event for event in map(decode_line, f) if event is not None]
+        except FileNotFoundError:
+            return []
+
+    def pending_bytes(self):
+        with self._lock:
+            return self._bytes
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+        self._lock_file.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'bytes': self._bytes,
+                'segments': len(self.segments()),
+                'appended': self.appended,
+                'full_errors': self.full_errors,
+                'dead_lettered': self.dead_lettered,
+            }
+
+
+class SpoolReplayer:
+    """Drains a LogSpool to MySQL in order, retrying with backoff while the database is unavailable"""
+
+    def __init__(self, spool, write_events, batch_size=500, idle_interval=0.2, max_backoff=30.0):
+        self.spool = spool
+        self.write_events = write_events
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+        self._thread = None
+        self.replayed = 0
+        self.failures = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-spool-replayer", daemon=True)
+        self._thread.start()
+
+    def replay_once(self):
+        """Replay one batch. Returns the number of events replayed, or None if the write failed."""
+        position = self.spool.load_checkpoint()
+        events, next_position = self.spool.read(position, self.batch_size)
+        if not events:
+            if next_position != position:
+                self.spool.save_checkpoint(*next_position)
+            return 0
+        try:
+            written = self.write_events(events)
+        except Exception as e:
+            logger.warning(f"Spooled batch of {len(events)} events rejected, writing them one by one: {e}")
+            written = self._write_each(events)
+        if not written:
+            return None
+        self.spool.save_checkpoint(*next_position)
+        self.replayed += len(events)
+        return len(events)
+
+    def _write_each(self, events):
+        """Write events one at a time, dead-lettering those that are rejected; False if MySQL became unavailable"""
+        for event in events:
+            try:
+                if not self.write_events([event]):
+                    # Events written so far are skipped by the event id ledger when the batch is retried
+                    return False
+            except Exception as e:
+                logger.error(f"Moving spooled event {event[0]} to the dead-letter file: {e}")
+                self.spool.dead_letter(event, e)
+        return True
+
+    def lag(self):
+        """Events appended by this process that are not replayed yet"""
+        return max(self.spool.appended - self.replayed, 0)
+
+    def _run(self):
+        backoff = self.idle_interval
+        while True:
+            try:
+                replayed = self.replay_once()
+            except Exception as e:
+                logger.error(f"Log spool replay failed: {e}")
+                replayed = None
+
+            if replayed is None:
+                self.failures += 1
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                backoff = self.idle_interval
+            if replayed:
+                continue
+            if self._stop.is_set():
+                return
+            self._stop.wait(backoff)
+
+    def shutdown(self, timeout=10.0):
+        """Stop after draining what can be replayed within `timeout`; the rest stays on disk"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay the activity log spool")
+    parser.add_argument("command", choices=["inspect", "replay"])
+    parser.add_argument("--dir", type=str, default=None, help="spool directory (defaults to LOG_SPOOL_DIR)")
+    parser.add_argument("--batch_size", type=int, default=500)
+    args = parser.parse_args()
+
+    import production_server
+
+    directory = args.dir or production_server.LOG_SPOOL_DIR
+    try:
+        spool = LogSpool(directory)
+    except SpoolLockedError as e:
+        raise SystemExit(f"{e}; stop the server (its replayer is draining the spool) and retry")
+
+    try:
+        if args.command == "inspect":
+            checkpoint = spool.load_checkpoint()
+            print(f"Spool {directory}: {spool.pending_bytes()} bytes, checkpoint {checkpoint}")
+            for name in spool.segments():
+                print(f"  {name} {os.path.getsize(os.path.join(directory, name))} bytes")
+            events, _ = spool.read(checkpoint, 10 ** 9)
+            print(f"{len(events)} events waiting to be replayed")
+            if events:
+                print(f"  oldest {events[0][4].isoformat()} ({events[0][2]}), "
+                      f"newest {events[-1][4].isoformat()} ({events[-1][2]})")
+            dead_letters = spool.dead_letters()
+            if dead_letters:
+                print(f"{len(dead_letters)} events rejected by MySQL in {os.path.join(directory, DEAD_LETTER_FILE)}")
+        else:
+            replayer = SpoolReplayer(spool, production_server.write_spooled_events, args.batch_size)
+            start = time.perf_counter()
+            while True:
+                replayed = replayer.replay_once()
+                if not replayed:
+                    break
+            print(f"Replayed {replayer.replayed} events in {time.perf_counter() - start:.1f}s")
+            if spool.dead_lettered:
+                print(f"Moved {spool.dead_lettered} rejected events to {os.path.join(directory, DEAD_LETTER_FILE)}")
+            if replayed is None:
+                raise SystemExit("MySQL is unavailable, the remaining events stay in the spool")
+    finally:
+        spool.close()
+
+
+if __name__ == "__main__":
+    main()
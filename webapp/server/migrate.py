@@ -0,0 +1,214 @@
+"""
+Versioned schema migrations for the study database.
+
+Applied versions are recorded in schema_migrations. MySQL commits DDL implicitly, so every migration is
+written to be safe to re-run if it was interrupted before its version was recorded. The server applies
+pending migrations on its first database access; this script runs them by hand, and re-runs the
+recipe_proposals backfill, which streams activity_logs in keyset-paginated chunks.
+
+Usage:
+    python server/migrate.py status
+    python server/migrate.py up
+    python server/migrate.py backfill [--chunk_size 5000] [--after_id 0]
+"""
+import argparse
+import logging
+import time
+
+import simplejson as json
+
+import log_partitions
+import log_sink
+import proposal_store
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_LOCK = 'food_study_schema_migrations'
+BACKFILL_CHUNK_SIZE = 5000
+
+
+def _add_index(cursor, table, name, columns):
+    cursor.execute(
+        """
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+        """,
+        (table, name)
+    )
+    if cursor.fetchone() is None:
+        cursor.execute(f"ALTER TABLE {table} ADD INDEX {name} ({columns})")
+
+
+def add_activity_log_indexes(cnx):
+    """Composite indexes for the queries that filter on activity_type plus timestamp or user_id"""
+    cursor = cnx.cursor()
+    try:
+        _add_index(cursor, 'activity_logs', 'idx_activity_type_timestamp', 'activity_type, timestamp')
+        _add_index(cursor, 'activity_logs', 'idx_user_id_activity_type', 'user_id, activity_type')
+    finally:
+        cursor.close()
+
+
+def create_proposal_tables(cnx):
+    proposal_store.ensure_proposal_schema(cnx)
+
+
+def backfill_recipe_proposals(cnx, chunk_size=BACKFILL_CHUNK_SIZE, after_id=0):
+    """
+    Copy the recipe ids of recipes_fetched logs into recipe_proposals, chunk_size logs at a time.
+    Logs are read by increasing id (keyset pagination on the activity_type index), so memory use does not
+    depend on the history size and an interrupted run can resume with after_id. Rows that already exist
+    are skipped, which makes the backfill safe to repeat while the server is writing proposals.
+
+    Returns:
+        tuple: (logs read, proposal rows inserted)
+    """
+    logs = inserted = 0
+    last_id = after_id
+    start = time.perf_counter()
+    while True:
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT id, user_id, data, timestamp
+                FROM activity_logs
+                WHERE activity_type = 'recipes_fetched' AND id > %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (last_id, chunk_size)
+            )
+            chunk = cursor.fetchall()
+            if not chunk:
+                break
+
+            rows = []
+            for log_id, user_id, data_json, timestamp in chunk:
+                try:
+                    rows.extend((user_id, recipe_id, timestamp)
+                                for recipe_id in proposal_store.recipe_ids_from_log(data_json))
+                except (json.JSONDecodeError, AttributeError, TypeError) as e:
+                    logger.warning(f"Skipping unreadable recipes_fetched log {log_id}: {e}")
+            proposal_store.insert_recipe_proposals(cursor, rows)
+            inserted += max(cursor.rowcount, 0) if rows else 0
+            cnx.commit()
+        except Exception:
+            cnx.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        logs += len(chunk)
+        last_id = chunk[-1][0]
+        logger.info(f"Backfilled recipe proposals up to log {last_id} ({logs} logs)")
+
+    logger.info(f"Backfill read {logs} logs and inserted {inserted} recipe proposals "
+                f"in {time.perf_counter() - start:.1f}s")
+    return logs, inserted
+
+
+MIGRATIONS = (
+    (1, 'recipe proposal tables', create_proposal_tables),
+    (2, 'activity_logs composite indexes', add_activity_log_indexes),
+    (3, 'backfill recipe_proposals from recipes_fetched logs', backfill_recipe_proposals),
+    (4, 'activity log rollup and archive tables', log_partitions.ensure_schema),
+    (5, 'activity log event id ledger', log_sink.ensure_event_id_schema),
+    (6, 'archived activity log submissions table', log_partitions.ensure_submissions_schema),
+)
+
+
+def _ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL
+        )
+    """)
+
+
+def applied_versions(cnx):
+    cursor = cnx.cursor()
+    try:
+        _ensure_migrations_table(cursor)
+        cursor.execute("SELECT version FROM schema_migrations")
+        return set(row[0] for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def apply_migrations(cnx, lock_timeout=600):
+    """
+    Apply every pending migration in version order. A named lock keeps concurrent server processes
+    from migrating at the same time; the ones that wait find the migrations applied.
+
+    Returns:
+        list: the versions applied by this call
+    """
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATIONS_LOCK, lock_timeout))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError(f"Timed out waiting for the schema migration lock after {lock_timeout}s")
+    finally:
+        cursor.close()
+
+    applied = []
+    try:
+        done = applied_versions(cnx)
+        for version, name, migration in MIGRATIONS:
+            if version in done:
+                continue
+            start = time.perf_counter()
+            logger.info(f"Applying migration {version}: {name}")
+            migration(cnx)
+            cursor = cnx.cursor()
+            try:
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name, applied_at) VALUES (%s, %s, NOW())",
+                    (version, name)
+                )
+                cnx.commit()
+            finally:
+                cursor.close()
+            applied.append(version)
+            logger.info(f"Applied migration {version} in {time.perf_counter() - start:.1f}s")
+    finally:
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATIONS_LOCK,))
+            cursor.fetchall()
+        finally:
+            cursor.close()
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations to the study database")
+    parser.add_argument("command", choices=["status", "up", "backfill"])
+    parser.add_argument("--chunk_size", type=int, default=BACKFILL_CHUNK_SIZE)
+    parser.add_argument("--after_id", type=int, default=0, help="resume the backfill after this activity_logs id")
+    args = parser.parse_args()
+
+    import production_server
+
+    cnx = production_server.create_db_connection(production_server.DB_NAME)
+    try:
+        if args.command == "status":
+            done = applied_versions(cnx)
+            for version, name, _ in MIGRATIONS:
+                print(f"{version:>3} {'applied' if version in done else 'pending':<8} {name}")
+        elif args.command == "up":
+            applied = apply_migrations(cnx)
+            print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+        else:
+            logs, inserted = backfill_recipe_proposals(cnx, args.chunk_size, args.after_id)
+            print(f"Read {logs} recipes_fetched logs, inserted {inserted} recipe proposals")
+    finally:
+        cnx.close()
+
+
+if __name__ == "__main__":
+    main()
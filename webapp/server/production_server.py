@@ -1,27 +1,44 @@
+import argparse
+import atexit
+import hmac
 import logging
 import os
 import random
+import signal
 import sys
 import threading
 import time
-from collections import Counter
+from concurrent.futures import wait as wait_for_futures
+from contextlib import contextmanager
 from functools import wraps
-from random import shuffle
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import List, Literal, Optional, Union
 import string
-import csv
 
-import mysql.connector
-import requests
 import simplejson as json
 from dotenv import load_dotenv
-from flask import Flask, request, Response, stream_with_context
+from flask import Flask, g, request, Response, stream_with_context
 from flask import jsonify
-from pydantic import ValidationError
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 from waitress import serve
 
-def init_logger():
-    logger = logging.getLogger(__name__)
+import llm_rating
+import log_partitions
+import migrate
+import proposal_store
+import questionnaire_jobs
+from db_pool import ConnectionPool, query_observers
+from log_sink import (PRUNE_BATCH_SIZE, ActivityLogSink, RecentEventIds, insert_activity_events, is_row_data_error,
+                      prune_event_ids)
+from log_spool import LogSpool, SpoolFullError, SpoolLockedError, SpoolReplayer
+from metrics import Registry
+from recaptcha_client import GOOGLE_VERIFY_URL, RecaptchaVerifier
+from recipe_catalog import RecipeCatalog
+from response_compression import compress_response
+from recipe_sampler import RecipeSampler
+
+def init_logger(name=__name__):
+    logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)  # Changed from WARNING to INFO
     if not logger.handlers:  # Prevent duplicate handlers
         formatter = logging.Formatter(
@@ -37,12 +54,187 @@ def init_logger():
 load_dotenv()
 
 app = Flask(__name__)
-lock = threading.Lock()
 logger = init_logger()
+# Helper modules of the server log through the same stdout handler
+for module_name in ('db_pool', 'llm_rating', 'log_partitions', 'log_sink', 'log_spool', 'migrate',
+                    'proposal_store', 'questionnaire_jobs', 'recaptcha_client', 'recipe_catalog'):
+    init_logger(module_name)
 
 
 # Food study configuration
+DB_NAME = os.getenv("DB_NAME", "food_preferences_study")
 MAX_RECIPE_PROPOSALS = 3  # Maximum times a recipe can be proposed
+RECIPES_PER_PARTICIPANT = 10
+RESERVATION_SPARE_CANDIDATES = 20  # Extra candidates tried when concurrent fetches fill the first ones
+SAMPLER_REFRESH_SECONDS = float(os.getenv("SAMPLER_REFRESH_SECONDS", 5))
+PROPOSAL_LEASE_MINUTES = 10  # Proposals to users who have not completed count for this long
+RESERVATION_RETRY_AFTER_SECONDS = 5  # Retry-After of a fetch whose recipes could not be reserved
+RECIPES_CSV_PATH = os.path.join(os.path.dirname(__file__), 'new-recipes.csv')
+
+# Parsed once and shared by all waitress threads, reloaded only when the CSV changes
+recipe_catalog = RecipeCatalog(RECIPES_CSV_PATH)
+RECIPE_DETAIL_MAX_AGE = int(os.getenv("RECIPE_DETAIL_MAX_AGE", 3600))  # browser cache lifetime, in seconds
+
+# gzip (or brotli, if installed) for responses larger than COMPRESSION_MIN_BYTES
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", 500))
+
+proposal_store_lock = threading.Lock()
+proposal_store_ready = False
+proposal_store_catalog_version = None
+
+# Recipes bucketed by proposal count; kept in step with local reservations and re-synced from the
+# database every SAMPLER_REFRESH_SECONDS (expired leases, completions, other server processes)
+recipe_sampler = RecipeSampler(MAX_RECIPE_PROPOSALS)
+recipe_sampler_refresh_lock = threading.Lock()
+recipe_sampler_refreshed_at = None
+
+# Server and database pool configuration. Each waitress thread holds at most one connection at a time,
+# and so does each background thread that shares the pool: the activity log writer, the log spool replayer
+# and the startup warm-up. The pool defaults to one connection for each of them.
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", 8))
+BACKGROUND_DB_CONNECTIONS = 3
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", WAITRESS_THREADS + BACKGROUND_DB_CONNECTIONS))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # seconds to wait for a free connection
+DB_POOL_HEALTH_CHECK_AFTER = float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", 5))  # ping connections idle longer
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5))
+
+db_pools = {}
+db_pools_lock = threading.Lock()
+
+# Startup warm-up (see warm_up); /server/api/ready answers 200 only once it is done, and 503 again during
+# the SHUTDOWN_DRAIN_SECONDS after a SIGTERM, so that a load balancer moves participants to warm processes
+WARM_POOL_CONNECTIONS = int(os.getenv("WARM_POOL_CONNECTIONS", WAITRESS_THREADS))
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", 0))
+WARM_UP_RETRY_SECONDS = 5
+server_ready = threading.Event()
+shutting_down = False
+startup_phase = "starting"
+startup_timings = {}
+
+# Activity logs are written in batches by a background thread, except for these events,
+# which are committed before the request returns
+LOG_SINK_ENABLED = os.getenv("LOG_SINK_ENABLED", "true").lower() == "true"
+SYNC_ACTIVITY_TYPES = {
+    'study_completed',
+    'static-context-submitted',
+    'questionnaires-submitted',
+    'recipe-ratings-static-submitted',
+}
+
+# Clients may send an event_id with each event (a UUID reused when the request is retried); an event id
+# is stored once. The most recent ids are also kept in memory, so most retries skip the database.
+EVENT_ID_MAX_LENGTH = 48
+EVENT_ID_CACHE_SIZE = int(os.getenv("EVENT_ID_CACHE_SIZE", 100000))
+recent_event_ids = RecentEventIds(EVENT_ID_CACHE_SIZE)
+# The ledger of stored ids grows by one row per event: ids older than EVENT_ID_RETENTION_DAYS are deleted
+# when the proposal counts are refreshed, one batch per refresh, every EVENT_ID_PRUNE_MINUTES
+EVENT_ID_PRUNE_MINUTES = float(os.getenv("EVENT_ID_PRUNE_MINUTES", 60))
+event_ids_pruned_at = None
+
+# Durable local spool: events are fsynced to LOG_SPOOL_DIR and acknowledged, then replayed to MySQL
+# in order by a background thread. Takes precedence over the in-memory queue above.
+LOG_SPOOL_ENABLED = os.getenv("LOG_SPOOL_ENABLED", "true").lower() == "true"
+# The spool holds participant activity, so it defaults to a state directory outside the repository
+LOG_SPOOL_DIR = os.getenv("LOG_SPOOL_DIR", os.path.join(
+    os.getenv("XDG_STATE_HOME", os.path.expanduser(os.path.join('~', '.local', 'state'))), 'food-persona', 'log_spool'))
+LOG_SPOOL_SEGMENT_MB = int(os.getenv("LOG_SPOOL_SEGMENT_MB", 16))
+LOG_SPOOL_MAX_MB = int(os.getenv("LOG_SPOOL_MAX_MB", 1024))
+
+log_spool = None
+log_spool_replayer = None
+log_spool_unavailable = False
+log_spool_lock = threading.Lock()
+
+
+# reCAPTCHA verification: bounded upstream calls; a result is cached for RECAPTCHA_TOKEN_TTL seconds by the
+# token and the user it was sent with, so that retried requests are not verified twice
+recaptcha_verifier = RecaptchaVerifier(
+    secrets={'v3': os.getenv('RECAPTCHA_SECRET_V3'), 'v2': os.getenv('RECAPTCHA_SECRET_V2')},
+    verify_url=os.getenv('RECAPTCHA_VERIFY_URL', GOOGLE_VERIFY_URL),
+    connect_timeout=float(os.getenv('RECAPTCHA_CONNECT_TIMEOUT', 2)),
+    read_timeout=float(os.getenv('RECAPTCHA_READ_TIMEOUT', 3)),
+    token_ttl=float(os.getenv('RECAPTCHA_TOKEN_TTL', 120)),
+    pool_size=WAITRESS_THREADS
+)
+
+# LLM ratings of recipes (llm_rating.py). LLM_BACKEND=mock rates without a model server (tests, load tests).
+# Requests wait up to LLM_WAIT_SECONDS for their ratings, then get a 202 with the ratings done so far and
+# repeat the request: ratings in progress are not started again and finished ones are cached.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "ollama")
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5:32b")
+LLM_HOST = os.getenv("LLM_HOST")  # Ollama server, defaults to OLLAMA_HOST or localhost:11434
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 120))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 10000))
+LLM_MAX_PENDING = int(os.getenv("LLM_MAX_PENDING", 200))  # beyond this, requests get a 503
+LLM_WAIT_SECONDS = float(os.getenv("LLM_WAIT_SECONDS", 8))  # below the client timeout (10s)
+LLM_MOCK_LATENCY = float(os.getenv("LLM_MOCK_LATENCY", 0))
+LLM_RETRY_AFTER_SECONDS = 10
+MAX_LLM_RECIPES = 50
+MAX_LLM_CONTEXT_LENGTH = 20000
+
+recipe_rater = None
+recipe_rater_lock = threading.Lock()
+
+# Questionnaire generation (questionnaire_jobs.py) with the same backend and model: requests queue a job and
+# poll or stream its progress. Each model call answers QUESTIONNAIRE_BATCH_SIZE questions.
+QUESTIONNAIRE_WORKERS = int(os.getenv("QUESTIONNAIRE_WORKERS", 2))
+QUESTIONNAIRE_MAX_QUEUED = int(os.getenv("QUESTIONNAIRE_MAX_QUEUED", 50))
+QUESTIONNAIRE_BATCH_SIZE = int(os.getenv("QUESTIONNAIRE_BATCH_SIZE", 6))
+QUESTIONNAIRE_DIR = os.getenv("QUESTIONNAIRE_DIR")  # defaults to benchmarking/questionnaires
+QUESTIONNAIRE_DATASET = os.getenv("QUESTIONNAIRE_DATASET", "prolific")
+QUESTIONNAIRE_STREAM_SECONDS = 25  # a progress stream ends after this long, the client reconnects with ?after=
+
+questionnaire_job_queue = None
+questionnaire_job_queue_lock = threading.Lock()
+
+# Batched client events (/server/api/logs/batch)
+MAX_LOG_BATCH_EVENTS = int(os.getenv("MAX_LOG_BATCH_EVENTS", 500))
+MAX_CLIENT_EVENT_AGE = timedelta(hours=1)  # older client timestamps are replaced by the server time
+
+
+class LogEvent(BaseModel):
+    """One client event; any extra fields are stored in the log payload like on /logs"""
+    model_config = ConfigDict(extra='allow')
+
+    type: str = Field(min_length=1, max_length=100)
+    timestamp: Optional[datetime] = None  # ISO 8601 string or epoch (seconds or milliseconds)
+    event_id: Optional[str] = Field(default=None, min_length=1, max_length=EVENT_ID_MAX_LENGTH)
+
+
+class LogBatch(BaseModel):
+    user_id: str = Field(min_length=1, max_length=255)
+    events: List[LogEvent] = Field(min_length=1, max_length=MAX_LOG_BATCH_EVENTS)
+    recaptcha_token: Optional[str] = None
+    recaptcha_version: str = 'v3'
+
+
+class QuestionnaireRequest(BaseModel):
+    user_id: str = Field(min_length=1, max_length=255)
+    text: str = Field(min_length=1, max_length=MAX_LLM_CONTEXT_LENGTH)  # the participant's biography
+    questionnaires: List[Literal['FCQ', 'JC']] = Field(default=['FCQ', 'JC'], min_length=1, max_length=2)
+
+
+class LLMStaticRatingRequest(BaseModel):
+    user_id: str = Field(min_length=1, max_length=255)
+    recipes: List[Union[str, int, dict]] = Field(min_length=1, max_length=MAX_LLM_RECIPES)  # ids or recipes
+    context: str = Field(min_length=1, max_length=MAX_LLM_CONTEXT_LENGTH)
+    context_type: str = 'unstructured_context'
+
+
+class LLMDynamicRating(BaseModel):
+    """A recipe rated by the participant in a dynamic context; other fields (their rating) are ignored"""
+    model_config = ConfigDict(extra='allow')
+
+    recipe_id: Union[str, int]
+    context: str = Field(min_length=1, max_length=MAX_LLM_CONTEXT_LENGTH)
+    context_type: str = 'unstructured_context'
+
+
+class LLMDynamicRatingRequest(BaseModel):
+    user_id: str = Field(min_length=1, max_length=255)
+    ratings: List[LLMDynamicRating] = Field(min_length=1, max_length=MAX_LLM_RECIPES)
 
 
 def get_remote_address():
@@ -52,35 +244,334 @@ def get_remote_address():
         return request.environ.get('HTTP_X_FORWARDED_FOR').split(",")[0]
 
 
+def get_db_pool(db=""):
+    """One bounded connection pool per database, created on first use"""
+    pool = db_pools.get(db)
+    if pool is None:
+        with db_pools_lock:
+            pool = db_pools.get(db)
+            if pool is None:
+                pool = db_pools[db] = ConnectionPool(
+                    size=DB_POOL_SIZE,
+                    checkout_timeout=DB_POOL_TIMEOUT,
+                    health_check_after=DB_POOL_HEALTH_CHECK_AFTER,
+                    name=db,
+                    host=os.getenv("DB_HOST", "localhost"),
+                    user=os.getenv("DB_USER", "root"),
+                    password=os.getenv("DB_PWD"),
+                    database=db,
+                    connection_timeout=DB_CONNECT_TIMEOUT
+                )
+    return pool
+
+
 def create_db_connection(db=""):
-    return mysql.connector.connect(
-        host=os.getenv("DB_HOST", "localhost"),
-        user=os.getenv("DB_USER", "root"),
-        password=os.getenv("DB_PWD"),
-        database=db
-    )
-
-
-def log_to_activity_logs(user_id, activity_type, data, cnx=None):
-    """Log activity to the activity_logs table in food_preferences_study database"""
-    close_connection = False
-    if cnx is None:
-        cnx = create_db_connection("food_preferences_study")
-        close_connection = True
-
-    cursor = cnx.cursor()
+    """Check out a pooled connection; close() returns it to the pool"""
+    return get_db_pool(db).get_connection()
+
+
+activity_log_sink = ActivityLogSink(
+    lambda: create_db_connection(DB_NAME),
+    max_queue=int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+    batch_size=int(os.getenv("LOG_BATCH_SIZE", 200)),
+    flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", 0.5))
+)
+# Drain queued logs when the interpreter exits (Ctrl+C, or SIGTERM via the handler installed in __main__)
+atexit.register(activity_log_sink.shutdown)
+
+
+spool_replay_duplicates = 0
+
+
+def write_spooled_events(events):
+    """
+    Replay a batch of spooled events. Returns False so that the replayer retries while MySQL is unavailable;
+    errors caused by the events themselves are raised, so that the replayer sets the rejected events aside.
+    """
+    global spool_replay_duplicates
+    cnx = None
     try:
-        query = "INSERT INTO activity_logs (user_id, activity_type, data, timestamp) VALUES (%s, %s, %s, NOW())"
-        cursor.execute(query, (user_id, activity_type, json.dumps(data)))
-        cnx.commit()
+        cnx = create_db_connection(DB_NAME)
+        spool_replay_duplicates += len(events) - insert_activity_events(cnx, events)
+        return True
     except Exception as e:
-        logger.error(f"Failed to log activity: {e}")
-        cnx.rollback()
+        if is_row_data_error(e):
+            raise
+        logger.warning(f"Could not replay {len(events)} spooled activity logs: {e}")
+        return False
     finally:
-        cursor.close()
-        if close_connection:
+        if cnx is not None:
             cnx.close()
 
+
+def is_inside_repository(path):
+    repository_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    path = os.path.realpath(path)
+    return os.path.commonpath([repository_dir, path]) == repository_dir
+
+
+def get_log_spool():
+    """Open the spool and start its replayer on first use; None if the spool is disabled or unusable"""
+    global log_spool, log_spool_replayer, log_spool_unavailable
+    if log_spool is not None or not LOG_SPOOL_ENABLED or log_spool_unavailable:
+        return log_spool
+    with log_spool_lock:
+        if log_spool is None and not log_spool_unavailable:
+            if is_inside_repository(LOG_SPOOL_DIR):
+                logger.warning(f"LOG_SPOOL_DIR {LOG_SPOOL_DIR} is inside the repository working tree: "
+                               f"spooled participant activity must not be committed")
+            try:
+                spool = LogSpool(LOG_SPOOL_DIR, LOG_SPOOL_SEGMENT_MB * 1024 * 1024, LOG_SPOOL_MAX_MB * 1024 * 1024)
+            except (SpoolLockedError, OSError) as e:
+                logger.error(f"Log spool disabled, writing activity logs through the queue: {e}")
+                log_spool_unavailable = True
+                return None
+            log_spool_replayer = SpoolReplayer(spool, write_spooled_events)
+            log_spool_replayer.start()
+            atexit.register(log_spool_replayer.shutdown)
+            log_spool = spool
+    return log_spool
+
+
+def get_recipe_rater():
+    """The shared RecipeRater, created on first use (raises if the backend cannot be created)"""
+    global recipe_rater
+    if recipe_rater is None:
+        with recipe_rater_lock:
+            if recipe_rater is None:
+                backend = llm_rating.create_backend(LLM_BACKEND, LLM_MODEL, LLM_HOST, LLM_TIMEOUT, LLM_MOCK_LATENCY)
+                rater = llm_rating.RecipeRater(backend, LLM_MAX_CONCURRENCY, LLM_CACHE_SIZE, LLM_MAX_PENDING)
+                rater.latency_observers.append(llm_call_duration.observe)
+                recipe_rater = rater
+    return recipe_rater
+
+
+def get_questionnaire_jobs():
+    """The shared QuestionnaireJobs queue, created on first use"""
+    global questionnaire_job_queue
+    if questionnaire_job_queue is None:
+        with questionnaire_job_queue_lock:
+            if questionnaire_job_queue is None:
+                backend = questionnaire_jobs.create_backend(LLM_BACKEND, LLM_MODEL, QUESTIONNAIRE_DIR,
+                                                            QUESTIONNAIRE_DATASET, LLM_MOCK_LATENCY)
+                questionnaire_job_queue = questionnaire_jobs.QuestionnaireJobs(
+                    backend, QUESTIONNAIRE_WORKERS, QUESTIONNAIRE_MAX_QUEUED, QUESTIONNAIRE_BATCH_SIZE)
+    return questionnaire_job_queue
+
+
+def questionnaire_job_body(job):
+    body = job.snapshot()
+    body['success'] = True
+    return body, 200 if job.finished else 202
+
+
+def questionnaire_progress(job, after, max_seconds=QUESTIONNAIRE_STREAM_SECONDS):
+    """
+    NDJSON lines for a job's progress: one per answered question after the first `after`, then a final status
+    line. Ends after `max_seconds` so that a stream does not hold a server thread for the whole job.
+    """
+    deadline = time.monotonic() + max_seconds
+    index = after
+    while True:
+        events, finished = job.events_after(index, timeout=min(5.0, max(deadline - time.monotonic(), 0.0)))
+        for event in events:
+            yield json.dumps(dict(event, index=index)) + '\n'
+            index += 1
+        if finished or time.monotonic() >= deadline:
+            yield json.dumps({'status': job.status, 'done': index, 'total': job.total,
+                              'reconnect': not finished}) + '\n'
+            return
+        if not events:
+            yield '\n'  # keep-alive
+
+
+def submit_llm_ratings(user_id, items):
+    """
+    Start rating (context_type, context_text, recipe_id) items.
+
+    Returns:
+        list: (recipe_id, future) pairs in request order
+    Raises:
+        KeyError: for a recipe that is not in the catalog
+    """
+    rater = get_recipe_rater()
+    catalog = recipe_catalog.get()
+    submitted = []
+    for context_type, context_text, recipe_id in items:
+        recipe = catalog.by_id[recipe_id]
+        title, ingredients, instructions = llm_rating.recipe_text(recipe)
+        future = rater.submit(user_id, context_type, context_text, recipe_id, title, ingredients, instructions)
+        submitted.append((recipe_id, future))
+    return submitted
+
+
+def llm_ratings_body(submitted):
+    """Response body and status for submitted ratings: 202 with the finished ones while some are pending"""
+    ratings = []
+    pending = 0
+    for recipe_id, future in submitted:
+        if not future.done():
+            pending += 1
+            ratings.append({'recipe_id': recipe_id, 'pending': True})
+        elif future.exception() is not None:
+            ratings.append({'recipe_id': recipe_id, 'error': 'Rating failed'})
+        else:
+            result = future.result()
+            ratings.append({'recipe_id': recipe_id, 'score': result.get('score'),
+                            'short_review': result.get('short_review')})
+    return {'success': True, 'pending': pending > 0, 'ratings': ratings}, 202 if pending else 200
+
+
+def llm_rating_items(endpoint, data):
+    """
+    Validate a /llm/rate-recipes-* request body.
+
+    Returns:
+        tuple: (user_id, [(context_type, context_text, recipe_id)], error message or None)
+    """
+    try:
+        if endpoint == 'static':
+            body = LLMStaticRatingRequest.model_validate(data)
+            items = [(body.context_type, body.context, str(recipe.get('id') if isinstance(recipe, dict) else recipe))
+                     for recipe in body.recipes]
+        else:
+            body = LLMDynamicRatingRequest.model_validate(data)
+            items = [(rating.context_type, rating.context, str(rating.recipe_id)) for rating in body.ratings]
+    except ValidationError:
+        return None, None, 'Invalid rating request'
+    if any(context_type not in llm_rating.CONTEXT_TYPES for context_type, _, _ in items):
+        return None, None, 'Unknown context_type'
+    return body.user_id, items, None
+
+
+def append_to_spool(rows):
+    """Durably spool (event_id, user_id, activity_type, data_json, timestamp) rows; False if they were not spooled"""
+    spool = get_log_spool()
+    if spool is None:
+        return False
+    try:
+        spool.append(rows)
+        return True
+    except (SpoolFullError, OSError) as e:
+        logger.error(f"Could not spool {len(rows)} activity logs, writing them directly: {e}")
+        return False
+
+
+# Prometheus metrics (/server/api/metrics). Request, query and reCAPTCHA timings are recorded in
+# per-thread shards; everything else is read from the components when the endpoint is scraped.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # if set, required as ?token= or a Bearer token
+
+metrics = Registry()
+request_duration = metrics.histogram(
+    'study_http_request_duration_seconds', 'Request latency per route', ('route', 'method'))
+request_count = metrics.counter(
+    'study_http_requests_total', 'Requests per route and status code', ('route', 'method', 'status'))
+db_query_duration = metrics.histogram(
+    'study_db_query_duration_seconds', 'Database statement latency by verb and table', ('statement',))
+recaptcha_duration = metrics.histogram(
+    'study_recaptcha_verify_duration_seconds', 'Latency of reCAPTCHA verification requests to Google')
+llm_call_duration = metrics.histogram(
+    'study_llm_call_duration_seconds', 'Latency of model calls for recipe ratings',
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0))
+query_observers.append(lambda label, elapsed: db_query_duration.observe(elapsed, (label,)))
+recaptcha_verifier.latency_observers.append(recaptcha_duration.observe)
+
+
+def pool_metric(key):
+    return lambda: {(name or DB_NAME,): pool.stats()[key] for name, pool in list(db_pools.items())}
+
+
+metrics.callback('study_activity_log_queue_depth', 'Activity log rows waiting for the writer thread',
+                 activity_log_sink.depth)
+metrics.callback('study_activity_log_rows_written_total', 'Activity log rows written by the writer thread',
+                 lambda: activity_log_sink.stats()['written'], kind='counter')
+metrics.callback('study_activity_log_rows_failed_total', 'Activity log rows the writer thread failed to write',
+                 lambda: activity_log_sink.stats()['failed'], kind='counter')
+metrics.callback('study_log_duplicate_events_total', 'Repeated events (same event_id) that were not stored again',
+                 lambda: {('cache',): recent_event_ids.hits,
+                          ('ledger',): activity_log_sink.stats()['duplicates'] + spool_replay_duplicates},
+                 ('caught_by',), kind='counter')
+metrics.callback('study_log_spool_bytes', 'Bytes of activity logs in the spool, replayed or not',
+                 lambda: log_spool.pending_bytes() if log_spool is not None else 0)
+metrics.callback('study_log_spool_replayed_total', 'Spooled activity logs replayed to MySQL',
+                 lambda: log_spool_replayer.replayed if log_spool_replayer is not None else 0, kind='counter')
+metrics.callback('study_log_spool_dead_lettered_total', 'Spooled activity logs rejected by MySQL and set aside',
+                 lambda: log_spool.dead_lettered if log_spool is not None else 0, kind='counter')
+metrics.callback('study_recipes_by_proposal_count', 'Catalog recipes per proposal count (the last one is full)',
+                 lambda: {(str(count),): size for count, size in recipe_sampler.bucket_sizes().items()},
+                 ('proposals',))
+metrics.callback('study_db_pool_size', 'Connections allowed per pool', pool_metric('size'), ('database',))
+metrics.callback('study_db_pool_in_use', 'Connections checked out per pool', pool_metric('in_use'), ('database',))
+metrics.callback('study_db_pool_checkout_timeouts_total', 'Checkouts that gave up waiting for a connection',
+                 pool_metric('timeouts'), ('database',), kind='counter')
+metrics.callback('study_recipe_catalog_reloads_total', 'Times the recipes CSV was parsed',
+                 lambda: recipe_catalog.stats()['reloads'], kind='counter')
+metrics.callback('study_llm_ratings_total', 'Recipe ratings requested, by how they were answered',
+                 lambda: {(source,): recipe_rater.stats()[source] if recipe_rater is not None else 0
+                          for source in ('cache_hits', 'coalesced', 'rejected', 'rated', 'errors')},
+                 ('source',), kind='counter')
+metrics.callback('study_llm_ratings_queued', 'Recipe ratings waiting for a model call',
+                 lambda: recipe_rater.stats()['queued'] if recipe_rater is not None else 0)
+metrics.callback('study_questionnaire_jobs_total', 'Questionnaire generation requests, by how they were handled',
+                 lambda: {(outcome,): questionnaire_job_queue.stats()[outcome]
+                                     if questionnaire_job_queue is not None else 0
+                          for outcome in ('submitted', 'cache_hits', 'coalesced', 'rejected')},
+                 ('outcome',), kind='counter')
+metrics.callback('study_questionnaire_jobs_queued', 'Questionnaire jobs waiting for a worker',
+                 lambda: questionnaire_job_queue.stats()['queued'] if questionnaire_job_queue is not None else 0)
+metrics.callback('study_recaptcha_upstream_errors_total', 'reCAPTCHA verification requests that failed',
+                 lambda: recaptcha_verifier.stats()['upstream_errors'], kind='counter')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started_at = g.get('request_started_at')
+    if started_at is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_duration.observe(time.perf_counter() - started_at, (route, request.method))
+        request_count.inc(1, (route, request.method, response.status_code))
+    return response
+
+
+@app.after_request
+def compress(response):
+    if COMPRESSION_ENABLED:
+        compress_response(response, request.headers.get('Accept-Encoding'), COMPRESSION_MIN_BYTES)
+    return response
+
+
+def log_to_activity_logs(user_id, activity_type, data, cnx=None, sync=False, timestamp=None, event_id=None):
+    """
+    Log activity to the activity_logs table in food_preferences_study database.
+    Events go to the durable spool when it is enabled. Otherwise they are queued for the background
+    writer unless they must be durable before the caller responds (sync=True, an explicit connection,
+    or an activity type in SYNC_ACTIVITY_TYPES). An event whose event_id is already stored is skipped.
+    Raises if the event could not be stored.
+    """
+    row = (event_id, user_id, activity_type, json.dumps(data), timestamp or datetime.now())
+
+    if cnx is not None:
+        insert_activity_events(cnx, [row])
+        return
+
+    if append_to_spool([row]):
+        return
+
+    if LOG_SINK_ENABLED and not sync and activity_type not in SYNC_ACTIVITY_TYPES:
+        stored = activity_log_sink.submit(row)
+    else:
+        stored = activity_log_sink.write([row])
+    if not stored:
+        # Raised so that the request fails and releases its event id: the client's retry must not be
+        # taken for a duplicate of an event that was never stored
+        raise RuntimeError(f"Could not store the {activity_type} activity log")
+
+
 def should_skip_checks():
     """Determine if captcha and focus checks should be skipped"""
     return request.args.get('beta_testing_passkey') == 'beta-testing-passkey-study'
@@ -100,33 +591,9 @@ def handle_cors(f):
     return wrapper
 
 
-def verify_recaptcha(token, version='v3'):
-    V3_SECRET_KEY = os.getenv('RECAPTCHA_SECRET_V3')
-    V2_SECRET_KEY = os.getenv('RECAPTCHA_SECRET_V2')
-
-    secret_key = V3_SECRET_KEY if version == 'v3' else V2_SECRET_KEY
-    verification_url = 'https://www.google.com/recaptcha/api/siteverify'
-
-    response = requests.post(verification_url, data={
-        'secret': secret_key,
-        'response': token
-    })
-
-    result = response.json()
-
-    if version == 'v3':
-        score = result.get('score', 0)
-        return {
-            'success': result.get('success', False),
-            'score': score,
-            'requireV2': score < 0.5  # Threshold for requiring v2 verification
-        }
-    else:
-        return {
-            'success': result.get('success', False),
-            'requireV2': False
-        }
-
+def verify_recaptcha(token, version='v3', user_id=None):
+    """Verify a reCAPTCHA token through the shared client (keep-alive session, timeouts, caches)"""
+    return recaptcha_verifier.verify(token, version, user_id)
 
 
 def validate_recaptcha_if_needed(data):
@@ -140,7 +607,7 @@ def validate_recaptcha_if_needed(data):
     if not token:
         return {'error': 'reCAPTCHA token required', 'requireV2Verification': False}
 
-    verification = verify_recaptcha(token, version)
+    verification = verify_recaptcha(token, version, data.get('user_id'))
 
     if version == 'v3' and verification['requireV2']:
         return {'requireV2Verification': True}
@@ -158,118 +625,203 @@ def generate_user_id():
     return f'user_{timestamp}_{random_str}'
 
 
-def get_recipe_proposal_counts(cnx=None):
+def init_proposal_store(cnx):
+    """Apply pending schema migrations and build the proposal counts the first time (once per process)"""
+    global proposal_store_ready
+    if proposal_store_ready:
+        return
+    with proposal_store_lock:
+        if proposal_store_ready:
+            return
+        migrate.apply_migrations(cnx)
+        try:
+            # No-op unless activity_logs was partitioned with log_partitions.py
+            log_partitions.ensure_future_partitions(cnx)
+        except Exception as e:
+            logger.warning(f"Could not add upcoming activity_logs partitions: {e}")
+        if not proposal_store.is_initialized(cnx):
+            proposal_store.rebuild_proposal_counts(cnx, PROPOSAL_LEASE_MINUTES)
+        proposal_store_ready = True
+
+
+@contextmanager
+def timed_phase(name):
+    """Record and log the duration of a startup phase"""
+    global startup_phase
+    startup_phase = name
+    start = time.perf_counter()
+    yield
+    startup_timings[name] = round(time.perf_counter() - start, 3)
+    logger.info(f"Startup phase {name} took {startup_timings[name]:.3f}s")
+
+
+def warm_up(pool_connections=WARM_POOL_CONNECTIONS):
     """
-    Get count of how many times each recipe has been proposed.
-    Counts both completed users and recent incomplete users (within 10 minutes).
-
-    Returns:
-        dict: Dictionary mapping recipe_id to proposal count
+    Do the work that the first requests would otherwise pay for: start the log spool, parse the recipe
+    catalog, open pooled connections, apply migrations and build the proposal counts, and load the
+    sampler buckets. Raises if the database is unavailable; repeating it is cheap.
     """
-    close_connection = False
-    if cnx is None:
-        cnx = create_db_connection("food_preferences_study")
-        close_connection = True
+    with timed_phase('log_spool'):
+        get_log_spool()
+    with timed_phase('recipe_catalog'):
+        catalog = recipe_catalog.get()
+    with timed_phase('db_pool'):
+        get_db_pool(DB_NAME).prime(pool_connections)
+
+    cnx = create_db_connection(DB_NAME)
+    try:
+        with timed_phase('proposal_store'):
+            init_proposal_store(cnx)
+            sync_proposal_catalog(cnx, catalog)
+        with timed_phase('recipe_sampler'):
+            refresh_recipe_sampler(cnx, catalog)
+            if recipe_sampler_refreshed_at is None:
+                raise RuntimeError("Could not load the recipe proposal counts")
+    finally:
+        cnx.close()
+
+
+def warm_up_until_ready():
+    """Retry the warm-up until it succeeds (e.g. once MySQL is reachable), then report ready"""
+    start = time.perf_counter()
+    while not shutting_down:
+        try:
+            warm_up()
+        except Exception as e:
+            logger.error(f"Startup phase {startup_phase} failed, retrying in {WARM_UP_RETRY_SECONDS}s: {e}")
+            time.sleep(WARM_UP_RETRY_SECONDS)
+            continue
+        startup_timings['total'] = round(time.perf_counter() - start, 3)
+        server_ready.set()
+        logger.info(f"Server warm after {startup_timings['total']:.3f}s")
+        return
+
+
+def begin_shutdown(signum, frame):
+    """SIGTERM: report not ready, keep serving during the drain period, then exit (flushing the log queue)"""
+    global shutting_down
+    if shutting_down or SHUTDOWN_DRAIN_SECONDS <= 0:
+        sys.exit(0)
+    shutting_down = True
+    logger.info(f"Shutdown requested, draining for {SHUTDOWN_DRAIN_SECONDS}s")
+    threading.Timer(SHUTDOWN_DRAIN_SECONDS, os.kill, (os.getpid(), signal.SIGTERM)).start()
+
+
+def sync_proposal_catalog(cnx, catalog):
+    """Make sure every recipe of the current catalog has a count row that reservations can update"""
+    global proposal_store_catalog_version
+    if proposal_store_catalog_version == catalog.digest:
+        return
+    with proposal_store_lock:
+        if proposal_store_catalog_version != catalog.digest:
+            proposal_store.ensure_recipe_rows(cnx, catalog.by_id.keys())
+            proposal_store_catalog_version = catalog.digest
+
+
+def refresh_recipe_sampler(cnx, catalog):
+    """Rebuild the sampler when the catalog changes and re-sync its buckets with the database when due"""
+    global recipe_sampler_refreshed_at
+    catalog_changed = recipe_sampler.catalog_version != catalog.digest
+    due = (recipe_sampler_refreshed_at is None
+           or time.monotonic() - recipe_sampler_refreshed_at >= SAMPLER_REFRESH_SECONDS)
+    if not (catalog_changed or (due and cnx is not None)):
+        return
+
+    # Only one thread refreshes; the others keep drawing from the current buckets
+    if not recipe_sampler_refresh_lock.acquire(blocking=catalog_changed):
+        return
+    try:
+        if recipe_sampler.catalog_version != catalog.digest:
+            recipe_sampler.reset(catalog.by_id.keys(), catalog.digest)
+            recipe_sampler_refreshed_at = None
+        if cnx is None:
+            return
+        if recipe_sampler_refreshed_at is not None and \
+                time.monotonic() - recipe_sampler_refreshed_at < SAMPLER_REFRESH_SECONDS:
+            return
+        try:
+            expired = proposal_store.expire_proposal_leases(cnx)
+            recipe_sampler.sync(proposal_store.read_proposal_counts(cnx))
+            recipe_sampler_refreshed_at = time.monotonic()
+            if expired:
+                logger.info(f"Released {expired} expired recipe leases")
+        except Exception as e:
+            logger.error(f"Error refreshing recipe proposal counts: {e}")
+        try:
+            if event_id_prune_due():
+                record_event_id_prune(prune_event_ids(cnx, log_partitions.EVENT_ID_RETENTION_DAYS, max_batches=1))
+        except Exception as e:
+            logger.error(f"Error pruning the event id ledger: {e}")
+    finally:
+        recipe_sampler_refresh_lock.release()
 
-    cursor = cnx.cursor()
-    proposal_counts = {}
 
-    try:
-        # Get all users who completed the study
-        cursor.execute("""
-            SELECT user_id
-            FROM activity_logs
-            WHERE activity_type = 'study_completed'
-        """)
-        completed_users = set(row[0] for row in cursor.fetchall())
-
-        # Get users who fetched recipes recently (within 10 minutes) but haven't completed
-        cursor.execute("""
-            SELECT DISTINCT user_id, MAX(timestamp) as last_fetch
-            FROM activity_logs
-            WHERE activity_type = 'recipes_fetched'
-            AND timestamp >= NOW() - INTERVAL 10 MINUTE
-            GROUP BY user_id
-        """)
-        recent_incomplete_users = set(
-            row[0] for row in cursor.fetchall()
-            if row[0] not in completed_users
-        )
+def event_id_prune_due():
+    return event_ids_pruned_at is None or time.monotonic() - event_ids_pruned_at >= EVENT_ID_PRUNE_MINUTES * 60
 
-        # Combine both sets of users
-        all_users = completed_users | recent_incomplete_users
-
-        if all_users:
-            # Get recipe proposals for all relevant users
-            placeholders = ','.join(['%s'] * len(all_users))
-            query = f"""
-                SELECT data
-                FROM activity_logs
-                WHERE activity_type = 'recipes_fetched'
-                AND user_id IN ({placeholders})
-            """
-            cursor.execute(query, tuple(all_users))
-
-            for (data_json,) in cursor.fetchall():
-                try:
-                    data = json.loads(data_json)
-                    recipe_ids = data.get('recipe_ids', [])
-                    for recipe_id in recipe_ids:
-                        proposal_counts[str(recipe_id)] = proposal_counts.get(str(recipe_id), 0) + 1
-                except (json.JSONDecodeError, KeyError) as e:
-                    logger.warning(f"Error parsing recipe data: {e}")
-                    continue
 
-        logger.info(f"Counted proposals from {len(completed_users)} completed users "
-                   f"+ {len(recent_incomplete_users)} recent incomplete users")
+def record_event_id_prune(deleted):
+    """After a full batch, the next refresh deletes another one; otherwise the ledger is caught up"""
+    global event_ids_pruned_at
+    if deleted < PRUNE_BATCH_SIZE:
+        event_ids_pruned_at = time.monotonic()
+    if deleted:
+        logger.info(f"Forgot {deleted} event ids older than {log_partitions.EVENT_ID_RETENTION_DAYS} days")
+
 
+def record_proposal_event(update, *args):
+    """Apply a proposal store update, logging instead of failing the request"""
+    cnx = None
+    try:
+        cnx = create_db_connection(DB_NAME)
+        init_proposal_store(cnx)
+        update(cnx, *args)
     except Exception as e:
-        logger.error(f"Error getting recipe proposal counts: {e}")
+        logger.error(f"Failed to update proposal counts: {e}")
     finally:
-        cursor.close()
-        if close_connection:
+        if cnx is not None:
             cnx.close()
 
-    return proposal_counts
-
 
 def load_recipes_from_csv():
     """
-    Load recipes from CSV file
+    Load recipes from CSV file.
+    Served from the in-memory catalog; new-recipes.csv is only re-parsed when its content changes.
     """
-    recipes = []
-    csv_path = os.path.join(os.path.dirname(__file__), 'new-recipes.csv')
+    return recipe_catalog.get().recipes
+
+
+def check_log_recaptcha(data):
+    """Verify the optional reCAPTCHA token of a log request. Returns an error response, or None if it passed."""
+    token = data.get('recaptcha_token')
+    version = data.get('recaptcha_version', 'v3')
+
+    if token:
+        verification = verify_recaptcha(token, version, data.get('user_id'))
+
+        if version == 'v3' and verification['requireV2']:
+            return jsonify({'success': False, 'requireV2Verification': True}), 200
+
+        if not verification['success']:
+            return jsonify({'success': False, 'error': 'reCAPTCHA verification failed'}), 403
+
+    return None
+
+
+def event_timestamp(client_timestamp, now):
+    """Server-local row timestamp for a batched event: the client time unless it is in the future or too old"""
+    if client_timestamp is None:
+        return now
+    if client_timestamp.tzinfo is not None:
+        client_timestamp = client_timestamp.astimezone().replace(tzinfo=None)
+    if client_timestamp > now or now - client_timestamp > MAX_CLIENT_EVENT_AGE:
+        return now
+    return client_timestamp
 
-    try:
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-
-                # Parse ingredients_list, directions, and tags (separated by |)
-                ingredients_list = row.get('ingredients_list', '').split('|') if row.get('ingredients_list') else []
-                directions = row.get('directions', '').split('|') if row.get('directions') else []
-                tags = row.get('tags', '').split('|') if row.get('tags') else []
-
-                recipe = {
-                    'id': row['recipe_id'],
-                    'name': row['title'],
-                    'recipe_url': row['recipe_url'],
-                    'image': row['image_url'],
-                    'ingredients_list': ingredients_list,
-                    'directions': directions,
-                    'tags': tags,
-                    'interactions': row['# Interactions']
-                }
-                recipes.append(recipe)
-    except FileNotFoundError:
-        logger.error(f"Warning: new-recipes.csv not found at {csv_path}")
-        recipes = []
-    except Exception as e:
-        logger.error(f"Error loading recipes from CSV: {e}")
-        recipes = []
 
-    logger.info(f"Loaded {len(recipes)} recipes")
-    return recipes
+def completion_event_id(event_id):
+    """Id of the study_completed event logged along with a recipe-ratings-static-submitted event"""
+    return f"{event_id}:study_completed" if event_id is not None else None
 
 
 # ===== FOOD PREFERENCES STUDY ENDPOINTS =====
@@ -285,33 +837,39 @@ def food_log_activity():
         data = request.get_json(force=True)
         user_id = data.get('user_id')
         activity_type = data.get('type')
+        event_id = data.get('event_id')
+        if event_id is not None and (not isinstance(event_id, str) or not 0 < len(event_id) <= EVENT_ID_MAX_LENGTH):
+            return jsonify({'success': False, 'error': 'Invalid event_id'}), 400
 
         # Validate reCAPTCHA only if token is provided (optional like /llm-log)
-        token = data.get('recaptcha_token')
-        version = data.get('recaptcha_version', 'v3')
+        recaptcha_error = check_log_recaptcha(data)
+        if recaptcha_error:
+            return recaptcha_error
 
-        if token:
-            verification = verify_recaptcha(token, version)
-
-            if version == 'v3' and verification['requireV2']:
-                return jsonify({'success': False, 'requireV2Verification': True}), 200
-
-            if not verification['success']:
-                return jsonify({'success': False, 'error': 'reCAPTCHA verification failed'}), 403
+        # A retry of an event that was already accepted gets the original response without a second write
+        if event_id is not None and not recent_event_ids.claim(event_id):
+            return jsonify({'success': True, 'message': 'Log recorded successfully'}), 200
 
         # Remove recaptcha tokens before storing
         data.pop('recaptcha_token', None)
         data.pop('recaptcha_version', None)
 
-        # Log to activity_logs
-        log_to_activity_logs(user_id, activity_type, data)
-
-        # For this study, when recipe ratings are submitted, the study is completed
-        # Automatically log study completion
-        if activity_type == 'recipe-ratings-static-submitted':
-            completion_data = {'status': 'completed'}
-            log_to_activity_logs(user_id, 'study_completed', completion_data)
-            logger.info(f"User {user_id} completed the study (recipe ratings submitted)")
+        try:
+            # Log to activity_logs
+            log_to_activity_logs(user_id, activity_type, data, event_id=event_id)
+
+            # For this study, when recipe ratings are submitted, the study is completed
+            # Automatically log study completion
+            if activity_type == 'recipe-ratings-static-submitted':
+                completion_data = {'status': 'completed'}
+                log_to_activity_logs(user_id, 'study_completed', completion_data,
+                                     event_id=completion_event_id(event_id))
+                record_proposal_event(proposal_store.record_study_completed, user_id)
+                logger.info(f"User {user_id} completed the study (recipe ratings submitted)")
+        except Exception:
+            if event_id is not None:
+                recent_event_ids.forget([event_id])
+            raise
 
         return jsonify({'success': True, 'message': 'Log recorded successfully'}), 200
 
@@ -320,50 +878,135 @@ def food_log_activity():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-@app.route('/server/api/recipes', methods=['GET', 'OPTIONS'], strict_slashes=False)
+@app.route('/server/api/logs/batch', methods=['POST', 'OPTIONS'], strict_slashes=False)
 @handle_cors
-def food_get_recipes():
-    """Get recipes for rating (static context phase)"""
+def food_log_activity_batch():
+    """Log several client events of one user with a single request and a single multi-row insert"""
     if request.method == 'OPTIONS':
         return Response(status=204)
 
     try:
-        user_id = request.args.get('user_id')
-
-        all_recipes = load_recipes_from_csv()
-        proposal_counts = get_recipe_proposal_counts()
-        available_recipes = [
-            r for r in all_recipes
-            if proposal_counts.get(r['id'], 0) < MAX_RECIPE_PROPOSALS
-        ]
+        data = request.get_json(force=True)
+        try:
+            batch = LogBatch.model_validate(data)
+        except ValidationError as e:
+            return jsonify({'success': False, 'error': 'Invalid log batch',
+                            'details': e.errors(include_url=False, include_context=False)}), 400
+
+        recaptcha_error = check_log_recaptcha(data)
+        if recaptcha_error:
+            return recaptcha_error
+
+        user_id = batch.user_id
+        now = datetime.now()
+        rows = []
+        claimed_ids = []
+        completed = False
+        for event in batch.events:
+            # Events of a retried batch that were already accepted are not stored again
+            if event.event_id is not None:
+                if not recent_event_ids.claim(event.event_id):
+                    continue
+                claimed_ids.append(event.event_id)
+
+            event_data = event.model_dump(mode='json', exclude={'type', 'timestamp'}, exclude_none=True)
+            event_data.update(type=event.type, user_id=user_id)
+            if event.timestamp is not None:
+                event_data['client_timestamp'] = event.timestamp.isoformat()
+            rows.append((event.event_id, user_id, event.type, json.dumps(event_data),
+                         event_timestamp(event.timestamp, now)))
+
+            # Same side effect as /logs: submitting the recipe ratings completes the study
+            if event.type == 'recipe-ratings-static-submitted':
+                rows.append((completion_event_id(event.event_id), user_id, 'study_completed',
+                             json.dumps({'status': 'completed'}), now))
+                completed = True
+
+        sync = completed or any(row[2] in SYNC_ACTIVITY_TYPES for row in rows)
+        if not rows or append_to_spool(rows):
+            stored = True
+        elif LOG_SINK_ENABLED and not sync:
+            # Rows stored before a failed overflow write are skipped by the event id ledger when the client retries
+            stored = all([activity_log_sink.submit(row) for row in rows])
+        else:
+            stored = activity_log_sink.write(rows)
+        if not stored:
+            recent_event_ids.forget(claimed_ids)
+            return jsonify({'success': False, 'error': 'Failed to store log batch'}), 500
+
+        if completed:
+            record_proposal_event(proposal_store.record_study_completed, user_id)
+            logger.info(f"User {user_id} completed the study (recipe ratings submitted)")
 
-        recipes_with_2 = [r for r in available_recipes if proposal_counts.get(r['id'], 0) == 2]
-        recipes_with_1 = [r for r in available_recipes if proposal_counts.get(r['id'], 0) == 1]
-        recipes_with_0 = [r for r in available_recipes if proposal_counts.get(r['id'], 0) == 0]
+        return jsonify({'success': True, 'message': 'Logs recorded successfully', 'count': len(batch.events)}), 200
 
-        logger.info(f"Total recipes: {len(all_recipes)}, "
-                   f"Available recipes (not maxed out): {len(available_recipes)}, "
-                   f"2-rating: {len(recipes_with_2)}, 1-rating: {len(recipes_with_1)}, 0-rating: {len(recipes_with_0)}")
+    except Exception as e:
+        logger.error(f"Error logging activity batch: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        selected_recipes = []
 
-        if recipes_with_2:
-            selected_recipes.extend(random.sample(recipes_with_2, min(10, len(recipes_with_2))))
+def reservation_unavailable():
+    response = jsonify({'success': False, 'error': 'Recipes could not be reserved, retry later'})
+    response.headers['Retry-After'] = str(RESERVATION_RETRY_AFTER_SECONDS)
+    return response, 503
 
-        if len(selected_recipes) < 10 and recipes_with_1:
-            num_needed = 10 - len(selected_recipes)
-            selected_recipes.extend(random.sample(recipes_with_1, min(num_needed, len(recipes_with_1))))
 
-        if len(selected_recipes) < 10 and recipes_with_0:
-            num_needed = 10 - len(selected_recipes)
-            selected_recipes.extend(random.sample(recipes_with_0, min(num_needed, len(recipes_with_0))))
+@app.route('/server/api/recipes', methods=['GET', 'OPTIONS'], strict_slashes=False)
+@handle_cors
+def food_get_recipes():
+    """Get recipes for rating (static context phase)"""
+    if request.method == 'OPTIONS':
+        return Response(status=204)
 
-        random_recipes = selected_recipes
+    try:
+        user_id = request.args.get('user_id')
+        if not user_id:
+            return jsonify({'success': False, 'error': 'user_id is required'}), 400
+
+        catalog = recipe_catalog.get()
+
+        # Recipes are only served once they are reserved: an unreserved sample has no recipe_proposals
+        # rows, so it would not count towards MAX_RECIPE_PROPOSALS
+        cnx = None
+        try:
+            cnx = create_db_connection(DB_NAME)
+            init_proposal_store(cnx)
+            sync_proposal_catalog(cnx, catalog)
+            refresh_recipe_sampler(cnx, catalog)
+
+            # Candidates in priority order (fullest non-full bucket first). The buckets may lag behind
+            # the database, so a few spare candidates cover recipes that concurrent requests fill up first.
+            candidate_ids = recipe_sampler.draw(RECIPES_PER_PARTICIPANT + RESERVATION_SPARE_CANDIDATES)
+
+            # Shared by the recipes_fetched log and the recipe_proposals rows (whole seconds, like the DATETIME columns)
+            fetched_at = datetime.now().replace(microsecond=0)
+            selected_ids = proposal_store.reserve_recipes(
+                cnx, user_id, candidate_ids,
+                RECIPES_PER_PARTICIPANT, MAX_RECIPE_PROPOSALS, PROPOSAL_LEASE_MINUTES, fetched_at
+            )
+        except Exception as e:
+            logger.error(f"Error reserving recipes for {user_id}: {e}")
+            return reservation_unavailable()
+        finally:
+            if cnx is not None:
+                cnx.close()
+
+        recipe_sampler.add(selected_ids)
+        # Candidates tried before the last reserved one but not reserved were full in the database
+        tried = candidate_ids[:candidate_ids.index(selected_ids[-1]) + 1] if selected_ids else candidate_ids
+        recipe_sampler.mark_full(set(tried) - set(selected_ids))
+
+        # view=summary leaves out directions, tags and links, which the client fetches per recipe
+        recipes_by_id = catalog.summaries if request.args.get('view') == 'summary' else catalog.by_id
+        random_recipes = [recipes_by_id[recipe_id] for recipe_id in selected_ids if recipe_id in recipes_by_id]
+
+        logger.info(f"Total recipes: {len(catalog.recipes)}, selected: {len(random_recipes)}, "
+                    f"recipes per proposal count: {recipe_sampler.bucket_sizes()}")
 
         log_data = {
             'recipe_ids': [r['id'] for r in random_recipes]
         }
-        log_to_activity_logs(user_id, 'recipes_fetched', log_data)
+        log_to_activity_logs(user_id, 'recipes_fetched', log_data, timestamp=fetched_at)
 
         return jsonify({
             'success': True,
@@ -375,6 +1018,118 @@ def food_get_recipes():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/server/api/recipes/<recipe_id>', methods=['GET', 'OPTIONS'], strict_slashes=False)
+@handle_cors
+def food_get_recipe_detail(recipe_id):
+    """Full recipe (directions, tags, ...), cached by the browser and revalidated with its ETag"""
+    if request.method == 'OPTIONS':
+        return Response(status=204)
+
+    catalog = recipe_catalog.get()
+    recipe = catalog.by_id.get(recipe_id)
+    if recipe is None:
+        return jsonify({'success': False, 'error': 'Recipe not found'}), 404
+
+    etag = catalog.etag(recipe_id)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({'success': True, 'recipe': recipe})
+    # Weak, so that the gzip and brotli encodings of the recipe share it
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = f'public, max-age={RECIPE_DETAIL_MAX_AGE}'
+    return response
+
+
+
+
+@app.route('/server/api/llm/rate-recipes-<endpoint>', methods=['POST', 'OPTIONS'], strict_slashes=False)
+@handle_cors
+def food_llm_rate_recipes(endpoint):
+    """LLM ratings of recipes for the participant's static context or for their dynamic contexts"""
+    if request.method == 'OPTIONS':
+        return Response(status=204)
+    if endpoint not in ('static', 'dynamic'):
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+
+    try:
+        user_id, items, error = llm_rating_items(endpoint, request.get_json(force=True))
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        try:
+            submitted = submit_llm_ratings(user_id, items)
+        except KeyError as e:
+            return jsonify({'success': False, 'error': f'Recipe not found: {e.args[0]}'}), 404
+        except llm_rating.QueueFullError as e:
+            logger.warning(f"Rejected LLM ratings of user {user_id}: {e}")
+            response = jsonify({'success': False, 'error': 'Too many ratings in progress, retry later'})
+            response.headers['Retry-After'] = str(LLM_RETRY_AFTER_SECONDS)
+            return response, 503
+
+        # The request thread only waits; the model calls run on the rater's own threads
+        wait_for_futures([future for _, future in submitted], timeout=LLM_WAIT_SECONDS)
+        body, status = llm_ratings_body(submitted)
+        return jsonify(body), status
+
+    except Exception as e:
+        logger.error(f"Error rating recipes with the LLM: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/server/api/llm/generate-questionnaires', methods=['POST', 'OPTIONS'], strict_slashes=False)
+@handle_cors
+def food_generate_questionnaires():
+    """Queue the compilation of the FCQ and JC questionnaires from the participant's biography"""
+    if request.method == 'OPTIONS':
+        return Response(status=204)
+
+    try:
+        try:
+            body = QuestionnaireRequest.model_validate(request.get_json(force=True))
+        except ValidationError:
+            return jsonify({'success': False, 'error': 'Invalid questionnaire request'}), 400
+        try:
+            job = get_questionnaire_jobs().submit(body.user_id, body.text, tuple(body.questionnaires))
+        except questionnaire_jobs.QueueFullError as e:
+            logger.warning(f"Rejected questionnaire job of user {body.user_id}: {e}")
+            response = jsonify({'success': False, 'error': 'Too many questionnaire jobs, retry later'})
+            response.headers['Retry-After'] = '30'
+            return response, 503
+
+        body, status = questionnaire_job_body(job)
+        return jsonify(body), status
+
+    except Exception as e:
+        logger.error(f"Error generating questionnaires: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/server/api/llm/generate-questionnaires/<job_id>', methods=['GET', 'OPTIONS'], strict_slashes=False)
+@handle_cors
+def food_questionnaire_job(job_id):
+    """Status and answers so far of a questionnaire job (200 once finished, 202 while running)"""
+    if request.method == 'OPTIONS':
+        return Response(status=204)
+    job = get_questionnaire_jobs().get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    body, status = questionnaire_job_body(job)
+    return jsonify(body), status
+
+
+@app.route('/server/api/llm/generate-questionnaires/<job_id>/stream', methods=['GET', 'OPTIONS'],
+           strict_slashes=False)
+@handle_cors
+def food_questionnaire_job_stream(job_id):
+    """Progress of a questionnaire job as NDJSON, one line per answered question"""
+    if request.method == 'OPTIONS':
+        return Response(status=204)
+    job = get_questionnaire_jobs().get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    after = max(request.args.get('after', 0, type=int), 0)
+    return Response(stream_with_context(questionnaire_progress(job, after)), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/server/api/study/complete', methods=['POST', 'OPTIONS'], strict_slashes=False)
@@ -392,6 +1147,7 @@ def food_complete_study():
             'status': 'completed'
         }
         log_to_activity_logs(user_id, 'study_completed', log_data)
+        record_proposal_event(proposal_store.record_study_completed, user_id)
 
         return jsonify({
             'success': True,
@@ -403,7 +1159,45 @@ def food_complete_study():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/server/api/ready', methods=['GET'], strict_slashes=False)
+def food_ready():
+    """Readiness probe: 200 once the startup warm-up is done, 503 before and while draining for shutdown"""
+    if shutting_down:
+        return jsonify({'ready': False, 'phase': 'draining'}), 503
+    if not server_ready.is_set():
+        return jsonify({'ready': False, 'phase': startup_phase}), 503
+    return jsonify({'ready': True, 'startup_seconds': startup_timings}), 200
+
+
+@app.route('/server/api/metrics', methods=['GET'], strict_slashes=False)
+def food_metrics():
+    """Prometheus text exposition of the server metrics"""
+    if METRICS_TOKEN:
+        supplied = request.args.get('token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+            return Response(status=403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == "__main__":
-    # waitress_logger = logging.getLogger('waitress')
-    # waitress_logger.setLevel(logging.INFO)
-    serve(app, host='0.0.0.0', port=3050)
+    parser = argparse.ArgumentParser(description="Food preferences study server")
+    parser.add_argument("--mode", choices=["waitress", "async"], default=os.getenv("SERVER_MODE", "waitress"),
+                        help="waitress: Flask app on a thread pool; async: aiohttp + aiomysql event loop")
+    parser.add_argument("--port", type=int, default=3050)
+    args = parser.parse_args()
+
+    if args.mode == "async":
+        import async_server
+
+        init_logger('async_server')
+        init_logger('async_proposal_store')
+        # The handlers share this module's catalog, sampler and configuration
+        async_server.run(sys.modules[__name__], host='0.0.0.0', port=args.port)
+    else:
+        # waitress_logger = logging.getLogger('waitress')
+        # waitress_logger.setLevel(logging.INFO)
+        # Turn SIGTERM into a normal exit (after the drain period) so that atexit handlers flush the log queue
+        signal.signal(signal.SIGTERM, begin_shutdown)
+        # Warm up in the background while waitress already accepts connections; /ready reports when done
+        threading.Thread(target=warm_up_until_ready, name="warm-up", daemon=True).start()
+        serve(app, host='0.0.0.0', port=args.port, threads=WAITRESS_THREADS)
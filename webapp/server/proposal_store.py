@@ -0,0 +1,375 @@
+"""
+Incrementally maintained recipe proposal counts.
+
+A recipe proposal counts towards MAX_RECIPE_PROPOSALS if the user it was proposed to completed the study,
+or if it was proposed less than `lease_minutes` ago (a lease held by a participant still rating).
+Instead of rescanning activity_logs on every request, the counts are kept in three tables:
+
+- recipe_proposal_counts: per recipe, proposals to completed users and currently active leases
+- recipe_proposal_leases: proposals to users who have not completed yet (active or expired)
+- recipe_proposal_completions: users whose proposals were already moved to the completed counts
+
+Fetching recipes reserves them with a compare-and-increment and adds leases, completing the study turns
+all leases of the user into completed proposals, and expired leases are released with an indexed range
+query on expires_at. Every proposal is also kept as a row of recipe_proposals (user_id, recipe_id,
+fetched_at), the normalized form of the recipes_fetched log payloads, so that the counts can be rebuilt
+with indexed GROUP BY queries instead of decoding JSON.
+"""
+import logging
+from collections import Counter
+from datetime import datetime
+
+import mysql.connector
+import simplejson as json
+from mysql.connector import errorcode
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS recipe_proposal_counts (
+        recipe_id VARCHAR(32) PRIMARY KEY,
+        completed INT NOT NULL DEFAULT 0,
+        leased INT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS recipe_proposal_leases (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id VARCHAR(255) NOT NULL,
+        recipe_id VARCHAR(32) NOT NULL,
+        expires_at DATETIME NOT NULL,
+        active TINYINT(1) NOT NULL DEFAULT 1,
+        INDEX idx_user_id (user_id),
+        INDEX idx_active_expires_at (active, expires_at)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS recipe_proposals (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id VARCHAR(255) NOT NULL,
+        recipe_id VARCHAR(32) NOT NULL,
+        fetched_at DATETIME NOT NULL,
+        UNIQUE KEY uq_user_recipe_fetched_at (user_id, recipe_id, fetched_at),
+        INDEX idx_recipe_id (recipe_id),
+        INDEX idx_fetched_at (fetched_at)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS recipe_proposal_completions (
+        user_id VARCHAR(255) PRIMARY KEY,
+        completed_at DATETIME NOT NULL
+    )
+    """,
+)
+
+
+# Statements of the operations run while serving requests, shared with async_proposal_store
+ADD_COUNTS = {
+    column: f"""
+        INSERT INTO recipe_proposal_counts (recipe_id, {column}) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE {column} = {column} + VALUES({column})
+    """
+    for column in ('completed', 'leased')
+}
+RELEASE_LEASES = "UPDATE recipe_proposal_counts SET leased = GREATEST(leased - %s, 0) WHERE recipe_id = %s"
+INSERT_RECIPE_ROW = "INSERT IGNORE INTO recipe_proposal_counts (recipe_id) VALUES (%s)"
+SELECT_COMPLETION = "SELECT 1 FROM recipe_proposal_completions WHERE user_id = %s"
+# The compare-and-increment of a reservation
+RESERVE = {
+    column: f"""
+        UPDATE recipe_proposal_counts SET {column} = {column} + 1
+        WHERE recipe_id = %s AND completed + leased < %s
+    """
+    for column in ('completed', 'leased')
+}
+INSERT_LEASES = """
+    INSERT INTO recipe_proposal_leases (user_id, recipe_id, expires_at)
+    VALUES (%s, %s, NOW() + INTERVAL %s MINUTE)
+"""
+INSERT_PROPOSALS = "INSERT IGNORE INTO recipe_proposals (user_id, recipe_id, fetched_at) VALUES (%s, %s, %s)"
+INSERT_COMPLETION = "INSERT IGNORE INTO recipe_proposal_completions (user_id, completed_at) VALUES (%s, NOW())"
+SELECT_USER_LEASES = "SELECT recipe_id, active FROM recipe_proposal_leases WHERE user_id = %s FOR UPDATE"
+DELETE_USER_LEASES = "DELETE FROM recipe_proposal_leases WHERE user_id = %s"
+SELECT_EXPIRED_LEASES = """
+    SELECT id, recipe_id
+    FROM recipe_proposal_leases
+    WHERE active = 1 AND expires_at <= NOW()
+    FOR UPDATE
+"""
+DEACTIVATE_LEASE = "UPDATE recipe_proposal_leases SET active = 0 WHERE id = %s"
+SELECT_PROPOSAL_COUNTS = """
+    SELECT recipe_id, completed + leased
+    FROM recipe_proposal_counts
+    WHERE completed + leased > 0
+"""
+
+# Lock conflicts after which a reservation is retried
+LOCK_CONFLICT_ERRNOS = (errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT)
+
+
+class Reservation:
+    """The candidates a reservation tries and the ones it got, for the sync and async reserve_recipes"""
+
+    def __init__(self, candidate_ids, k):
+        self.candidate_ids = [str(recipe_id) for recipe_id in candidate_ids]
+        self.k = k
+        self.reserved = set()
+
+    def rounds(self):
+        """
+        Candidates to try, in rounds of the places still free, each round in recipe_id order (the lock order).
+        Add the recipes that were reserved to `reserved` before taking the next round.
+        """
+        position = 0
+        while len(self.reserved) < self.k and position < len(self.candidate_ids):
+            round_ids = self.candidate_ids[position:position + self.k - len(self.reserved)]
+            position += len(round_ids)
+            yield sorted(round_ids)
+
+    def reserved_ids(self):
+        """The reserved recipe ids, in candidate order"""
+        return [recipe_id for recipe_id in self.candidate_ids if recipe_id in self.reserved]
+
+
+def reservation_column(completed):
+    """Proposals made after completion count immediately, like in rebuild_proposal_counts"""
+    return 'completed' if completed else 'leased'
+
+
+def count_params(counts):
+    return [(recipe_id, amount) for recipe_id, amount in counts.items()]
+
+
+def release_params(counts):
+    return [(amount, recipe_id) for recipe_id, amount in counts.items()]
+
+
+def completion_counts(leases):
+    """(completed, released) counts per recipe for a completing user's (recipe_id, active) leases"""
+    completed = Counter()
+    released = Counter()
+    for recipe_id, active in leases:
+        completed[recipe_id] += 1
+        if active:
+            released[recipe_id] += 1
+    return completed, released
+
+
+def ensure_proposal_schema(cnx):
+    """Create the proposal tables if they do not exist"""
+    cursor = cnx.cursor()
+    try:
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def _add_counts(cursor, column, counts):
+    """Add per-recipe amounts to the completed or leased column"""
+    if counts:
+        cursor.executemany(ADD_COUNTS[column], count_params(counts))
+
+
+def _release_leases(cursor, counts):
+    """Subtract released leases from the leased column"""
+    if counts:
+        cursor.executemany(RELEASE_LEASES, release_params(counts))
+
+
+def is_initialized(cnx):
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM recipe_proposal_counts LIMIT 1")
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+
+
+def rebuild_proposal_counts(cnx, lease_minutes):
+    """
+    Rebuild the count, lease and completion tables from recipe_proposals and the study completions.
+    Runs once, when the counts are empty; every step is an indexed INSERT ... SELECT, GROUP BY.
+    """
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("DELETE FROM recipe_proposal_counts")
+        cursor.execute("DELETE FROM recipe_proposal_leases")
+        cursor.execute("DELETE FROM recipe_proposal_completions")
+
+        # Completions of archived log partitions survive in the rollup rows
+        cursor.execute("""
+            INSERT INTO recipe_proposal_completions (user_id, completed_at)
+            SELECT user_id, MIN(completed_at)
+            FROM (
+                SELECT user_id, timestamp AS completed_at
+                FROM activity_logs
+                WHERE activity_type = 'study_completed'
+                UNION ALL
+                SELECT user_id, completed_at
+                FROM activity_log_rollups
+                WHERE completed_at IS NOT NULL
+            ) completions
+            GROUP BY user_id
+        """)
+        completed_users = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO recipe_proposal_counts (recipe_id, completed)
+            SELECT p.recipe_id, COUNT(*)
+            FROM recipe_proposals p
+            JOIN recipe_proposal_completions c ON c.user_id = p.user_id
+            GROUP BY p.recipe_id
+        """)
+
+        cursor.execute("""
+            INSERT INTO recipe_proposal_leases (user_id, recipe_id, expires_at, active)
+            SELECT p.user_id, p.recipe_id, p.fetched_at + INTERVAL %s MINUTE, p.fetched_at + INTERVAL %s MINUTE > NOW()
+            FROM recipe_proposals p
+            LEFT JOIN recipe_proposal_completions c ON c.user_id = p.user_id
+            WHERE c.user_id IS NULL
+        """, (lease_minutes, lease_minutes))
+        leases = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO recipe_proposal_counts (recipe_id, leased)
+            SELECT recipe_id, COUNT(*)
+            FROM recipe_proposal_leases
+            WHERE active = 1
+            GROUP BY recipe_id
+            ON DUPLICATE KEY UPDATE leased = VALUES(leased)
+        """)
+        cnx.commit()
+
+        logger.info(f"Rebuilt proposal counts from {completed_users} completed users "
+                    f"and {leases} leased proposals")
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def recipe_ids_from_log(data_json):
+    """Recipe ids of a recipes_fetched payload, as strings"""
+    return [str(recipe_id) for recipe_id in json.loads(data_json).get('recipe_ids', [])]
+
+
+def insert_recipe_proposals(cursor, rows):
+    """Insert (user_id, recipe_id, fetched_at) rows; proposals that are already recorded are skipped"""
+    if rows:
+        cursor.executemany(INSERT_PROPOSALS, rows)
+
+
+def ensure_recipe_rows(cnx, recipe_ids):
+    """Create zero count rows for catalog recipes, so that every reservation can lock an existing row"""
+    cursor = cnx.cursor()
+    try:
+        cursor.executemany(INSERT_RECIPE_ROW, [(str(recipe_id),) for recipe_id in recipe_ids])
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def reserve_recipes(cnx, user_id, candidate_ids, k, max_proposals, lease_minutes, fetched_at=None, attempts=3):
+    """
+    Reserve up to k recipes for a user, trying candidates in the given priority order.
+
+    Each reservation is a compare-and-increment on the recipe's count row
+    (UPDATE ... WHERE completed + leased < max_proposals), so concurrent fetches from any thread or
+    process can never push a recipe past max_proposals. The increments and the lease rows are committed
+    in one transaction, together with the recipe_proposals rows stamped with fetched_at (pass the timestamp
+    of the matching recipes_fetched log, so that a later backfill recognizes them). Candidates are locked in
+    recipe_id order within each round of k to make deadlocks between concurrent reservations unlikely;
+    a deadlocked transaction is retried.
+
+    Returns:
+        list: the reserved recipe ids, in candidate order
+    """
+    fetched_at = fetched_at or datetime.now().replace(microsecond=0)
+
+    for attempt in range(attempts):
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(SELECT_COMPLETION, (user_id,))
+            column = reservation_column(cursor.fetchone() is not None)
+
+            reservation = Reservation(candidate_ids, k)
+            for round_ids in reservation.rounds():
+                for recipe_id in round_ids:
+                    cursor.execute(RESERVE[column], (recipe_id, max_proposals))
+                    if cursor.rowcount == 1:
+                        reservation.reserved.add(recipe_id)
+
+            reserved_ids = reservation.reserved_ids()
+            if reserved_ids and column == 'leased':
+                cursor.executemany(INSERT_LEASES, [(user_id, recipe_id, lease_minutes) for recipe_id in reserved_ids])
+            insert_recipe_proposals(cursor, [(user_id, recipe_id, fetched_at) for recipe_id in reserved_ids])
+            cnx.commit()
+            return reserved_ids
+        except mysql.connector.Error as e:
+            cnx.rollback()
+            if e.errno not in LOCK_CONFLICT_ERRNOS or attempt == attempts - 1:
+                raise
+            logger.warning(f"Retrying recipe reservation for {user_id} after lock conflict: {e}")
+        except Exception:
+            cnx.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+def record_study_completed(cnx, user_id):
+    """Turn every proposal made to the user into a completed proposal (once per user)"""
+    if not user_id:
+        return
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(INSERT_COMPLETION, (user_id,))
+        if cursor.rowcount == 0:
+            # Completion already recorded (e.g. both the ratings submission and /study/complete fired)
+            cnx.commit()
+            return
+
+        cursor.execute(SELECT_USER_LEASES, (user_id,))
+        completed_counts, released_counts = completion_counts(cursor.fetchall())
+        _add_counts(cursor, 'completed', completed_counts)
+        _release_leases(cursor, released_counts)
+        cursor.execute(DELETE_USER_LEASES, (user_id,))
+        cnx.commit()
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def expire_proposal_leases(cnx):
+    """Release leases older than the lease window. Only touches the leases that expired since the last call."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(SELECT_EXPIRED_LEASES)
+        expired = cursor.fetchall()
+        if expired:
+            cursor.executemany(DEACTIVATE_LEASE, [(lease_id,) for lease_id, _ in expired])
+            _release_leases(cursor, Counter(recipe_id for _, recipe_id in expired))
+        cnx.commit()
+        return len(expired)
+    except Exception:
+        cnx.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def read_proposal_counts(cnx):
+    """Current proposal count per recipe: completed proposals plus active leases"""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(SELECT_PROPOSAL_COUNTS)
+        return {recipe_id: int(count) for recipe_id, count in cursor.fetchall()}
+    finally:
+        cursor.close()
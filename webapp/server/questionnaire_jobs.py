@@ -0,0 +1,317 @@
+"""
+Questionnaire generation jobs for the study server (/server/api/llm/generate-questionnaires).
+
+Compiling the FCQ and JC questionnaires from a participant's biography takes one model call per batch of
+questions (benchmarking/extraction/compile_questionnaire.py), minutes for a whole questionnaire. Requests
+therefore only submit a job to a bounded queue and return its id; a few worker threads run the jobs and
+record each answered question, which clients poll or stream.
+
+Results are cached by a hash of the biography (and of the model and questionnaires), so resubmitting the
+same text returns the cached answers, and a biography that is already being compiled is not queued twice.
+"""
+import csv
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import simplejson as json
+
+from utils import text_utils
+from utils.text_utils import normalize_text
+
+logger = logging.getLogger(__name__)
+
+QUESTIONNAIRE_TYPES = ('FCQ', 'JC')
+# benchmarking/questionnaires, next to the benchmark modules
+DEFAULT_QUESTIONNAIRE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(text_utils.__file__))),
+                                         'questionnaires')
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def questionnaire_file(questionnaire_dir, questionnaire_type, dataset):
+    """Same file choice as preprocessing/preprocess_questionnaire.py"""
+    filename = f"questionnaire_{questionnaire_type}"
+    if dataset == "prolific" and questionnaire_type == "FCQ":
+        filename += "_revisited"
+    return os.path.join(questionnaire_dir, filename + ".csv")
+
+
+def load_questions(questionnaire_dir, questionnaire_type, dataset):
+    """Normalized questions of a questionnaire, in order"""
+    with open(questionnaire_file(questionnaire_dir, questionnaire_type, dataset), encoding='utf-8') as f:
+        return [normalize_text(row['questions']) for row in csv.DictReader(f)]
+
+
+class LangExtractBackend:
+    """Answers batches of questions with compile_questionnaire (langextract on an Ollama model)"""
+
+    def __init__(self, model, questionnaire_dir=None, dataset='prolific'):
+        self.model = model
+        self.questionnaire_dir = questionnaire_dir or DEFAULT_QUESTIONNAIRE_DIR
+        self.dataset = dataset
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+    def questions(self, questionnaire_type):
+        return load_questions(self.questionnaire_dir, questionnaire_type, self.dataset)
+
+    def _prompt(self, questionnaire_type):
+        # preprocess_questionnaire converts the shared examples in place, so it runs once per type
+        with self._lock:
+            if questionnaire_type not in self._prompts:
+                from preprocessing.preprocess_questionnaire import preprocess_questionnaire
+
+                prompt, examples, _ = preprocess_questionnaire(questionnaire_type, self.dataset,
+                                                               self.questionnaire_dir)
+                self._prompts[questionnaire_type] = prompt, examples
+            return self._prompts[questionnaire_type]
+
+    def answer(self, questionnaire_type, user_id, text, questions):
+        """Answers ({normalized question: answer}, with `<question>_other` keys for JC) for a batch of questions"""
+        from extraction.compile_questionnaire import compile_questionnaire
+
+        prompt, examples = self._prompt(questionnaire_type)
+        document = compile_questionnaire(user_id, text, prompt, examples, self.model, specific_questions=questions)
+        answers = {}
+        for extraction in document.extractions or ():
+            if extraction.extraction_class == "questionnaire" and extraction.attributes:
+                answers.update({normalize_text(k): v for k, v in extraction.attributes.items()})
+        return answers
+
+
+class MockBackend:
+    """Deterministic answers without a model server, for tests and load tests"""
+
+    def __init__(self, model='mock', questionnaire_dir=None, dataset='prolific', latency=0.0, questions=None):
+        self.model = model
+        self.questionnaire_dir = questionnaire_dir or DEFAULT_QUESTIONNAIRE_DIR
+        self.dataset = dataset
+        self.latency = latency
+        self._questions = questions
+
+    def questions(self, questionnaire_type):
+        if self._questions is not None:
+            return list(self._questions[questionnaire_type])
+        return load_questions(self.questionnaire_dir, questionnaire_type, self.dataset)
+
+    def answer(self, questionnaire_type, user_id, text, questions):
+        time.sleep(self.latency)
+        answers = {}
+        for question in questions:
+            digest = hashlib.sha256(f"{text}|{question}".encode('utf-8')).digest()
+            answers[question] = str(digest[0] % 4 + 1) if questionnaire_type == 'FCQ' else 'Unknown'
+        return answers
+
+
+class Job:
+    def __init__(self, job_id, key, user_id, text, questionnaires, total):
+        self.id = job_id
+        self.key = key
+        self.user_id = user_id
+        self.text = text
+        self.questionnaires = questionnaires
+        self.total = total
+        self.status = 'queued'
+        self.answers = {questionnaire_type: {} for questionnaire_type in questionnaires}
+        self.progress = []  # one event per answered (or failed) question, in order
+        self.errors = 0
+        self._cond = threading.Condition()
+
+    def record(self, events, status=None):
+        with self._cond:
+            for event in events:
+                self.progress.append(event)
+                if 'answer' in event:
+                    answers = self.answers[event['questionnaire']]
+                    answers[event['question']] = event['answer']
+                    if 'answer_other' in event:
+                        answers[f"{event['question']}_other"] = event['answer_other']
+                else:
+                    self.errors += 1
+            if status is not None:
+                self.status = status
+            self._cond.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def events_after(self, index, timeout=0.0):
+        """Progress events after the first `index` ones, waiting up to `timeout` seconds for new ones"""
+        with self._cond:
+            if timeout and len(self.progress) <= index and not self.finished:
+                self._cond.wait(timeout)
+            return self.progress[index:], self.finished
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'done': len(self.progress),
+                'total': self.total,
+                'errors': self.errors,
+                'answers': {name: dict(answers) for name, answers in self.answers.items()},
+            }
+
+
+class QuestionnaireJobs:
+    def __init__(self, backend, workers=2, max_queued=50, batch_size=6, cache_size=1000, retain_jobs=1000):
+        self.backend = backend
+        self.workers = workers
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.retain_jobs = retain_jobs
+        self._queue = queue.Queue(max_queued)
+        self._jobs = OrderedDict()
+        self._active = {}  # cache key -> unfinished job
+        self._cache = OrderedDict()
+        self._questions = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+        self.submitted = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.model_calls = 0
+
+    def questions(self, questionnaire_type):
+        with self._lock:
+            if questionnaire_type not in self._questions:
+                self._questions[questionnaire_type] = self.backend.questions(questionnaire_type)
+            return self._questions[questionnaire_type]
+
+    def _key(self, text, questionnaires):
+        payload = json.dumps([self.backend.model, getattr(self.backend, 'dataset', None), list(questionnaires),
+                              self.batch_size, ' '.join(text.split())])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _start_workers(self):
+        # under self._lock
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name=f"questionnaire-job-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _retain(self, job):
+        # under self._lock; forget the oldest finished jobs
+        self._jobs[job.id] = job
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.retain_jobs:
+                break
+            if self._jobs[job_id].finished:
+                del self._jobs[job_id]
+
+    def submit(self, user_id, text, questionnaires=QUESTIONNAIRE_TYPES):
+        """
+        Queue the compilation of questionnaires from a biography.
+
+        Returns:
+            Job: a new job, the job already compiling the same biography, or a finished job built from the cache
+        Raises:
+            QueueFullError: when max_queued jobs are waiting
+        """
+        questions = {name: self.questions(name) for name in questionnaires}
+        total = sum(len(q) for q in questions.values())
+        key = self._key(text, questionnaires)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                job = Job(uuid.uuid4().hex, key, user_id, text, questionnaires, total)
+                job.record(cached, 'done')
+                self._retain(job)
+                return job
+
+            job = self._active.get(key)
+            if job is not None:
+                self.coalesced += 1
+                return job
+
+            job = Job(uuid.uuid4().hex, key, user_id, text, questionnaires, total)
+            try:
+                self._queue.put_nowait((job, questions))
+            except queue.Full:
+                self.rejected += 1
+                raise QueueFullError(f"{self._queue.maxsize} questionnaire jobs are already waiting")
+            self.submitted += 1
+            self._active[key] = job
+            self._retain(job)
+            self._start_workers()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self):
+        while True:
+            job, questions = self._queue.get()
+            try:
+                self._compile(job, questions)
+            except Exception as e:
+                logger.error(f"Questionnaire job {job.id} failed: {e}")
+                job.record([], 'failed')
+            with self._lock:
+                self._active.pop(job.key, None)
+                if job.status == 'done' and not job.errors:
+                    self._cache[job.key] = list(job.progress)
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+    def _compile(self, job, questions):
+        job.record([], 'running')
+        start = time.perf_counter()
+        for questionnaire_type, type_questions in questions.items():
+            for i in range(0, len(type_questions), self.batch_size):
+                batch = type_questions[i:i + self.batch_size]
+                try:
+                    answers = self.backend.answer(questionnaire_type, job.user_id, job.text, batch)
+                    events = [{'questionnaire': questionnaire_type, 'question': question,
+                               'answer': answers.get(question, 'Unknown')} for question in batch]
+                    # JC 'Other' answers come with the text of the participant's own option
+                    for event in events:
+                        other = answers.get(f"{event['question']}_other")
+                        if other is not None:
+                            event['answer_other'] = other
+                except Exception as e:
+                    logger.warning(f"Questionnaire job {job.id}: {questionnaire_type} batch failed: {e}")
+                    events = [{'questionnaire': questionnaire_type, 'question': question, 'error': str(e)}
+                              for question in batch]
+                with self._lock:
+                    self.model_calls += 1
+                job.record(events)
+        job.record([], 'done')
+        logger.info(f"Questionnaire job {job.id} compiled {job.total} questions in "
+                    f"{time.perf_counter() - start:.1f}s ({job.errors} failed)")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'active': len(self._active),
+                'cached': len(self._cache),
+                'submitted': self.submitted,
+                'cache_hits': self.cache_hits,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'model_calls': self.model_calls,
+            }
+
+
+def create_backend(name, model, questionnaire_dir=None, dataset='prolific', mock_latency=0.0):
+    if name == 'ollama':
+        return LangExtractBackend(model, questionnaire_dir, dataset)
+    if name == 'mock':
+        return MockBackend(model, questionnaire_dir, dataset, mock_latency)
+    raise ValueError(f"Unknown LLM backend: {name}")
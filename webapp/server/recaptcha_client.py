@@ -0,0 +1,161 @@
+"""
+reCAPTCHA verification client for the study server.
+
+Verification requests go through one keep-alive requests.Session with strict connect/read timeouts,
+so a slow upstream cannot hold a waitress thread for long. Results are cached for a short time by a hash of
+the token and the user id it was sent with, so a request that the client retries is not sent to Google twice,
+while any other token, or the same token sent for another user, is verified upstream. The verification URL is
+configurable, so the client can be pointed at a local stub server.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RecaptchaVerifier:
+    def __init__(self, secrets, verify_url=GOOGLE_VERIFY_URL, connect_timeout=2.0, read_timeout=3.0,
+                 token_ttl=120, cache_size=10000, v3_threshold=0.5, pool_size=8):
+        self.secrets = secrets
+        self.verify_url = verify_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.v3_threshold = v3_threshold
+        self._tokens = TTLCache(token_ttl, cache_size)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._stats_lock = threading.Lock()
+        self.upstream_requests = 0
+        self.upstream_errors = 0
+        self.upstream_latency_total = 0.0
+        self.upstream_latency_max = 0.0
+        self.token_cache_hits = 0
+        self.latency_observers = []
+
+    @staticmethod
+    def cache_key(token, version, user_id):
+        return version, hashlib.sha256(token.encode('utf-8')).hexdigest(), user_id
+
+    def _call_upstream(self, token, version):
+        start = time.perf_counter()
+        failed = False
+        try:
+            response = self.session.post(self.verify_url, data={
+                'secret': self.secrets.get(version),
+                'response': token
+            }, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            failed = True
+            logger.warning(f"reCAPTCHA {version} verification request failed: {e}")
+            return None
+        finally:
+            self.record_latency(time.perf_counter() - start, failed)
+
+    def lookup(self, token, version, user_id=None):
+        """Cached result of the same token sent for the same user, else None"""
+        cached = self._tokens.get(self.cache_key(token, version, user_id))
+        if cached is not None:
+            with self._stats_lock:
+                self.token_cache_hits += 1
+        return cached
+
+    def record_result(self, token, version, user_id, result):
+        """Turn a siteverify response (None if the call failed) into a verification result and cache it"""
+        if result is None:
+            # Upstream failures are not cached: the client may retry the same token
+            if version == 'v3':
+                return {'success': False, 'score': 0, 'requireV2': True}
+            return {'success': False, 'requireV2': False}
+
+        if version == 'v3':
+            score = result.get('score', 0)
+            verification = {
+                'success': result.get('success', False),
+                'score': score,
+                'requireV2': score < self.v3_threshold  # Threshold for requiring v2 verification
+            }
+        else:
+            verification = {
+                'success': result.get('success', False),
+                'requireV2': False
+            }
+
+        self._tokens.set(self.cache_key(token, version, user_id), verification)
+        return verification
+
+    def record_latency(self, elapsed, failed=False):
+        with self._stats_lock:
+            self.upstream_requests += 1
+            self.upstream_errors += int(failed)
+            self.upstream_latency_total += elapsed
+            self.upstream_latency_max = max(self.upstream_latency_max, elapsed)
+        for observer in self.latency_observers:
+            observer(elapsed)
+
+    def verify(self, token, version='v3', user_id=None):
+        """
+        Verify a token. Returns the same dict as before the client existed:
+        {'success', 'score', 'requireV2'} for v3 and {'success', 'requireV2'} for v2.
+        If Google cannot be reached in time, a v3 check asks for the v2 challenge and a v2 check fails.
+        """
+        verification = self.lookup(token, version, user_id)
+        if verification is not None:
+            return verification
+        return self.record_result(token, version, user_id, self._call_upstream(token, version))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'upstream_requests': self.upstream_requests,
+                'upstream_errors': self.upstream_errors,
+                'upstream_latency_avg_ms': (1000 * self.upstream_latency_total / self.upstream_requests
+                                            if self.upstream_requests else 0.0),
+                'upstream_latency_max_ms': 1000 * self.upstream_latency_max,
+                'token_cache_hits': self.token_cache_hits,
+                'cached_tokens': len(self._tokens),
+            }
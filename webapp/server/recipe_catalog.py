@@ -0,0 +1,147 @@
+import csv
+import hashlib
+import logging
+import os
+import threading
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+# Fields of the lightweight recipe list (GET /recipes?view=summary); the rest is fetched per recipe
+SUMMARY_FIELDS = ('id', 'name', 'image', 'ingredients_list')
+
+
+class CatalogSnapshot:
+    """Immutable view of the recipe catalog as parsed from one version of the CSV file"""
+
+    __slots__ = ('recipes', 'by_id', 'summaries', 'mtime_ns', 'size', 'digest')
+
+    def __init__(self, recipes, mtime_ns=None, size=None, digest=None):
+        self.recipes = tuple(recipes)
+        self.by_id = MappingProxyType({r['id']: r for r in self.recipes})
+        self.summaries = MappingProxyType({r['id']: {field: r[field] for field in SUMMARY_FIELDS}
+                                           for r in self.recipes})
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+
+    def etag(self, recipe_id):
+        """ETag value of a recipe, which changes with the catalog version"""
+        return f"{(self.digest or 'none')[:16]}-{recipe_id}"
+
+
+def file_digest(path):
+    """SHA-256 of a file, read in chunks"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def parse_recipes_csv(csv_path):
+    """
+    Parse new-recipes.csv into recipe dicts.
+    List fields (ingredients_list, directions, tags) are pipe separated in the CSV and
+    are returned as tuples so that cached recipes cannot be modified by request handlers.
+    """
+    recipes = []
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+
+            # Parse ingredients_list, directions, and tags (separated by |)
+            ingredients_list = tuple(row['ingredients_list'].split('|')) if row.get('ingredients_list') else ()
+            directions = tuple(row['directions'].split('|')) if row.get('directions') else ()
+            tags = tuple(row['tags'].split('|')) if row.get('tags') else ()
+
+            recipe = {
+                'id': row['recipe_id'],
+                'name': row['title'],
+                'recipe_url': row['recipe_url'],
+                'image': row['image_url'],
+                'ingredients_list': ingredients_list,
+                'directions': directions,
+                'tags': tags,
+                'interactions': row['# Interactions']
+            }
+            recipes.append(recipe)
+    return recipes
+
+
+class RecipeCatalog:
+    """
+    Recipe catalog loaded once and shared by all server threads.
+
+    Every get() stats the CSV file; the file is hashed only when its mtime or size changed,
+    and re-parsed only when the hash changed too. Readers never take the lock on the fast path:
+    they get the current snapshot, which is replaced atomically after a reload.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.reload_errors = 0
+
+    def _is_current(self, snapshot, stat):
+        return (snapshot is not None
+                and snapshot.mtime_ns == stat.st_mtime_ns
+                and snapshot.size == stat.st_size)
+
+    def get(self):
+        """Return the current CatalogSnapshot, reloading the CSV if it changed on disk"""
+        snapshot = self._snapshot
+        try:
+            stat = os.stat(self.csv_path)
+        except OSError as e:
+            self.misses += 1
+            if snapshot is None:
+                logger.error(f"Warning: new-recipes.csv not found at {self.csv_path}: {e}")
+                snapshot = self._snapshot = CatalogSnapshot([])
+            return snapshot
+
+        if self._is_current(snapshot, stat):
+            self.hits += 1
+            return snapshot
+
+        with self._lock:
+            # Another thread may have reloaded while we were waiting for the lock
+            snapshot = self._snapshot
+            if self._is_current(snapshot, stat):
+                self.hits += 1
+                return snapshot
+
+            self.misses += 1
+            try:
+                digest = file_digest(self.csv_path)
+                if snapshot is not None and snapshot.digest == digest:
+                    # Touched but unchanged: keep the parsed recipes, remember the new mtime
+                    snapshot = CatalogSnapshot(snapshot.recipes, stat.st_mtime_ns, stat.st_size, digest)
+                else:
+                    snapshot = CatalogSnapshot(parse_recipes_csv(self.csv_path), stat.st_mtime_ns, stat.st_size, digest)
+                    self.reloads += 1
+                    logger.info(f"Loaded {len(snapshot.recipes)} recipes (catalog version {digest[:12]})")
+            except Exception as e:
+                self.reload_errors += 1
+                logger.error(f"Error loading recipes from CSV: {e}")
+                # Keep serving the previous catalog and do not retry until the file changes again
+                snapshot = CatalogSnapshot(snapshot.recipes if snapshot is not None else [],
+                                           stat.st_mtime_ns, stat.st_size,
+                                           snapshot.digest if snapshot is not None else None)
+            self._snapshot = snapshot
+        return snapshot
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'reload_errors': self.reload_errors,
+            'recipes': len(snapshot.recipes) if snapshot is not None else 0,
+            'version': snapshot.digest if snapshot is not None else None,
+        }
@@ -0,0 +1,91 @@
+import random
+import threading
+
+
+class RecipeSampler:
+    """
+    Recipes bucketed by their current proposal count, for drawing candidates in O(k).
+
+    Bucket c holds the recipes proposed c times; the last bucket (c == max_proposals) holds full recipes,
+    which are never drawn. Each recipe knows its position inside its bucket, so moving it to another bucket
+    is a swap-remove plus an append. draw() fills from the fullest non-full bucket down to bucket 0,
+    which generalizes the "bucket 2, then 1, then 0" priority to any MAX_RECIPE_PROPOSALS.
+
+    The buckets mirror the proposal counts in the database and may lag behind them: the database
+    reservation stays the authority on the cap, the sampler only decides which recipes to try first.
+    """
+
+    def __init__(self, max_proposals):
+        self.max_proposals = max_proposals
+        self.catalog_version = None
+        self._lock = threading.Lock()
+        self._buckets = [[] for _ in range(max_proposals + 1)]
+        self._position = {}  # recipe_id -> (bucket, index in bucket)
+
+    def _bucket_for(self, count):
+        return min(max(count, 0), self.max_proposals)
+
+    def _move(self, recipe_id, bucket):
+        old_bucket, index = self._position[recipe_id]
+        if old_bucket == bucket:
+            return
+        old = self._buckets[old_bucket]
+        last = old.pop()
+        if last != recipe_id:
+            old[index] = last
+            self._position[last] = (old_bucket, index)
+        new = self._buckets[bucket]
+        self._position[recipe_id] = (bucket, len(new))
+        new.append(recipe_id)
+
+    def reset(self, recipe_ids, version=None, counts=None):
+        """Replace the catalog; recipes start in the bucket of their count (0 if unknown)"""
+        counts = counts or {}
+        with self._lock:
+            self._buckets = [[] for _ in range(self.max_proposals + 1)]
+            self._position = {}
+            for recipe_id in recipe_ids:
+                bucket = self._bucket_for(counts.get(recipe_id, 0))
+                self._position[recipe_id] = (bucket, len(self._buckets[bucket]))
+                self._buckets[bucket].append(recipe_id)
+            self.catalog_version = version
+
+    def sync(self, counts):
+        """Align every recipe with a full {recipe_id: count} snapshot (recipes missing from it have count 0)"""
+        with self._lock:
+            for recipe_id, (bucket, _) in list(self._position.items()):
+                target = self._bucket_for(counts.get(recipe_id, 0))
+                if target != bucket:
+                    self._move(recipe_id, target)
+
+    def add(self, recipe_ids, delta=1):
+        """Shift the given recipes by delta proposals, O(1) each"""
+        with self._lock:
+            for recipe_id in recipe_ids:
+                position = self._position.get(recipe_id)
+                if position is not None:
+                    self._move(recipe_id, self._bucket_for(position[0] + delta))
+
+    def mark_full(self, recipe_ids):
+        with self._lock:
+            for recipe_id in recipe_ids:
+                if recipe_id in self._position:
+                    self._move(recipe_id, self.max_proposals)
+
+    def draw(self, n):
+        """Up to n distinct recipe ids in priority order: random within a bucket, fullest non-full bucket first"""
+        selected = []
+        with self._lock:
+            for bucket in reversed(self._buckets[:self.max_proposals]):
+                needed = n - len(selected)
+                if needed <= 0:
+                    break
+                # Sampling positions from a range is O(needed), independent of the bucket size
+                for index in random.sample(range(len(bucket)), min(needed, len(bucket))):
+                    selected.append(bucket[index])
+        return selected
+
+    def bucket_sizes(self):
+        """Number of recipes per proposal count, full recipes included"""
+        with self._lock:
+            return {count: len(bucket) for count, bucket in enumerate(self._buckets)}
@@ -0,0 +1,67 @@
+"""
+gzip / brotli compression of API responses.
+
+The encoding is picked from the request's Accept-Encoding: brotli when the optional `brotli` package is
+installed and the client accepts it, gzip otherwise. Small bodies, streamed responses and types that do
+not compress well are sent as they are.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/csv')
+
+
+def choose_encoding(accept_encoding):
+    """'br', 'gzip' or None for an Accept-Encoding header"""
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:] in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, gzip_level=6, brotli_quality=5):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    # mtime=0 keeps the output identical for identical bodies
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+def compress_body(data, accept_encoding, min_size=500):
+    """
+    Returns:
+        tuple: (body, encoding), with encoding None when the body is left uncompressed
+    """
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None or len(data) < min_size:
+        return data, None
+    return compress(data, encoding), encoding
+
+
+def compressible(content_type, status):
+    return content_type in COMPRESSIBLE_TYPES and 200 <= status and status not in (204, 206, 304)
+
+
+def compress_response(response, accept_encoding, min_size=500):
+    """Compress a Flask response in place when it is worth it; returns the response"""
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or not compressible(response.mimetype, response.status_code)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body, encoding = compress_body(response.get_data(), accept_encoding, min_size)
+    if encoding is not None:
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+    return response
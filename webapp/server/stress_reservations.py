@@ -0,0 +1,159 @@
+"""
+Stress check for the recipe reservation path.
+
+Runs hundreds of simultaneous GET /server/api/recipes requests (threads in one or more processes, each
+process with its own connection pool) against a scratch MySQL database, on a reduced catalog so that the
+MAX_RECIPE_PROPOSALS cap is actually reached, and then checks that no recipe was proposed more often than
+the cap allows.
+
+The proposal tables of the target database are emptied first, so point DB_NAME at a scratch database:
+
+    DB_NAME=food_study_stress python server/stress_reservations.py --processes 4 --threads 64 --fetches 400
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ACTIVITY_LOGS_DDL = """
+    CREATE TABLE IF NOT EXISTS activity_logs (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id VARCHAR(255) NOT NULL,
+        activity_type VARCHAR(100) NOT NULL,
+        data JSON,
+        timestamp DATETIME NOT NULL,
+        INDEX idx_user_id (user_id),
+        INDEX idx_activity_type (activity_type),
+        INDEX idx_timestamp (timestamp)
+    )
+"""
+
+
+def write_reduced_catalog(source_path, num_recipes):
+    """Copy the first num_recipes rows of the recipe CSV to a temporary file"""
+    handle, path = tempfile.mkstemp(suffix='.csv', prefix='stress-recipes-')
+    with open(source_path, encoding='utf-8') as src, os.fdopen(handle, 'w', encoding='utf-8', newline='') as dst:
+        reader = csv.DictReader(src)
+        writer = csv.DictWriter(dst, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for i, row in enumerate(reader):
+            if i >= num_recipes:
+                break
+            writer.writerow(row)
+    return path
+
+
+def run_worker(worker_id, catalog_path, threads, fetches):
+    """Fetch recipes for `fetches` distinct users from `threads` threads; returns the proposed recipe ids"""
+    import production_server
+    from recipe_catalog import RecipeCatalog
+
+    production_server.recipe_catalog = RecipeCatalog(catalog_path)
+    client = production_server.app.test_client()
+
+    def fetch(i):
+        response = client.get('/server/api/recipes', query_string={'user_id': f'stress_{worker_id}_{i}'})
+        body = response.get_json()
+        if response.status_code != 200 or not body.get('success'):
+            return None
+        return [recipe['id'] for recipe in body['recipes']]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(fetch, range(fetches)))
+    production_server.activity_log_sink.shutdown()
+
+    failed = sum(1 for result in results if result is None)
+    proposed = [recipe_id for result in results if result for recipe_id in result]
+    return proposed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent recipe reservation stress check")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=50, help="concurrent requests per process")
+    parser.add_argument("--fetches", type=int, default=200, help="participants per process")
+    parser.add_argument("--catalog_size", type=int, default=100,
+                        help="recipes in the reduced catalog; keep it below fetches * 10 / MAX_RECIPE_PROPOSALS")
+    parser.add_argument("--force", action="store_true", help="allow running against food_preferences_study")
+    args = parser.parse_args()
+
+    # Pool sizing for the worker processes is read when production_server is imported
+    os.environ.setdefault("WAITRESS_THREADS", str(args.threads))
+
+    import migrate
+    import production_server
+
+    if production_server.DB_NAME == "food_preferences_study" and not args.force:
+        sys.exit("Refusing to reset the proposal tables of the study database; set DB_NAME to a scratch database")
+
+    cnx = production_server.create_db_connection(production_server.DB_NAME)
+    cursor = cnx.cursor()
+    cursor.execute(ACTIVITY_LOGS_DDL)
+    migrate.apply_migrations(cnx)
+    for table in ('recipe_proposal_counts', 'recipe_proposal_leases', 'recipe_proposal_completions'):
+        cursor.execute(f"DELETE FROM {table}")
+    cursor.execute("DELETE FROM recipe_proposals WHERE user_id LIKE 'stress\\_%'")
+    cursor.execute("DELETE FROM activity_logs WHERE user_id LIKE 'stress\\_%'")
+    cnx.commit()
+    cursor.close()
+    cnx.close()
+
+    catalog_path = write_reduced_catalog(production_server.RECIPES_CSV_PATH, args.catalog_size)
+    try:
+        with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+            results = pool.starmap(
+                run_worker,
+                [(worker_id, catalog_path, args.threads, args.fetches) for worker_id in range(args.processes)]
+            )
+    finally:
+        os.remove(catalog_path)
+
+    proposed = Counter(recipe_id for worker_proposed, _ in results for recipe_id in worker_proposed)
+    failed = sum(worker_failed for _, worker_failed in results)
+    cap = production_server.MAX_RECIPE_PROPOSALS
+    capacity = args.catalog_size * cap
+    print(f"{args.processes * args.fetches} fetches, {failed} failed, "
+          f"{sum(proposed.values())} proposals for a capacity of {capacity}")
+
+    over_cap = {recipe_id: count for recipe_id, count in proposed.items() if count > cap}
+
+    cnx = production_server.create_db_connection(production_server.DB_NAME)
+    cursor = cnx.cursor()
+    cursor.execute("SELECT recipe_id, completed + leased FROM recipe_proposal_counts WHERE completed + leased > %s",
+                   (cap,))
+    db_over_cap = cursor.fetchall()
+    cursor.execute("""
+        SELECT c.recipe_id, c.leased, COUNT(l.id)
+        FROM recipe_proposal_counts c
+        LEFT JOIN recipe_proposal_leases l ON l.recipe_id = c.recipe_id AND l.active = 1
+        GROUP BY c.recipe_id, c.leased
+        HAVING c.leased <> COUNT(l.id)
+    """)
+    inconsistent = cursor.fetchall()
+    cursor.close()
+    cnx.close()
+
+    ok = True
+    if over_cap:
+        ok = False
+        print(f"FAIL: {len(over_cap)} recipes proposed more than {cap} times: {sorted(over_cap.items())[:10]}")
+    if db_over_cap:
+        ok = False
+        print(f"FAIL: {len(db_over_cap)} count rows above the cap: {db_over_cap[:10]}")
+    if inconsistent:
+        ok = False
+        print(f"FAIL: {len(inconsistent)} recipes whose leased count does not match their active leases")
+    if sum(proposed.values()) > capacity:
+        ok = False
+        print("FAIL: more proposals than the catalog capacity")
+
+    print("OK: the proposal cap held under concurrent fetches" if ok else "Stress check failed")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pymysql
+
+from async_server import AsyncActivityLogSink, is_row_data_error
+
+TIMESTAMP = datetime(2025, 3, 1, 12, 30, 5)
+
+
+class FakeCursor:
+    def __init__(self, cnx):
+        self.cnx = cnx
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def executemany(self, operation, params):
+        if operation.startswith('INSERT INTO activity_logs'):
+            if any(len(user_id) > 255 for user_id, *_ in params):
+                raise pymysql.err.DataError(1406, "Data too long for column 'user_id' at row 1")
+            self.cnx.pending.extend(params)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.rows = []
+        self.pending = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    async def commit(self):
+        self.rows.extend(self.pending)
+        self.pending = []
+
+    async def rollback(self):
+        self.pending = []
+
+
+class FakePool:
+    def __init__(self, cnx=None):
+        self.cnx = cnx
+        self.acquired = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.acquired += 1
+        if self.cnx is None:
+            raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server")
+        yield self.cnx
+
+
+def rows(*user_ids):
+    return [(None, user_id, 'page_view', '{}', TIMESTAMP) for user_id in user_ids]
+
+
+def test_rows_of_a_rejected_batch_are_written_one_by_one():
+    cnx = FakeConnection()
+    sink = AsyncActivityLogSink()
+    sink.pool = FakePool(cnx)
+
+    assert not asyncio.run(sink.write(rows('a', 'x' * 300, 'b')))
+
+    assert [row[0] for row in cnx.rows] == ['a', 'b']
+    assert (sink.written, sink.failed) == (2, 1)
+
+
+def test_an_unavailable_database_fails_the_batch_once():
+    sink = AsyncActivityLogSink()
+    sink.pool = FakePool()
+
+    assert not asyncio.run(sink.write(rows('a', 'b')))
+    assert sink.failed == 2
+    assert sink.pool.acquired == 1
+
+
+def test_pymysql_row_data_errors():
+    assert is_row_data_error(pymysql.err.DataError(1406, 'Data too long'))
+    assert is_row_data_error(pymysql.err.InternalError(3140, 'Invalid JSON text'))
+    assert not is_row_data_error(pymysql.err.OperationalError(2013, 'Lost connection'))
+    assert not is_row_data_error(pymysql.err.OperationalError(1213, 'Deadlock found'))
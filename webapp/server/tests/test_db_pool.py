@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+from db_pool import ConnectionPool, PoolExhaustedError
+
+
+class FakeConnection:
+    def __init__(self):
+        self.in_transaction = False
+        self.closed = False
+        self.alive = True
+        self.rollbacks = 0
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            raise OSError('server has gone away')
+
+    def rollback(self):
+        self.in_transaction = False
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+    """ConnectionPool that opens fake connections instead of MySQL ones"""
+
+    def __init__(self, size, **kwargs):
+        super().__init__(size, **kwargs)
+        self.opened = []
+
+    def _connect(self):
+        cnx = FakeConnection()
+        self.opened.append(cnx)
+        with self._stats_lock:
+            self.connects += 1
+        return cnx
+
+
+def test_connections_are_reused_after_close():
+    pool = FakePool(2)
+
+    first = pool.get_connection()
+    first.close()
+    first.close()  # a second close does not release the slot twice
+    with pool.get_connection() as second:
+        assert second._cnx is pool.opened[0]
+        assert pool.stats()['in_use'] == 1
+
+    assert pool.stats()['connects'] == 1
+    assert pool.stats()['in_use'] == 0
+    with pytest.raises(AttributeError):
+        first.cursor()
+
+
+def test_checkout_fails_when_every_connection_is_in_use():
+    pool = FakePool(2, checkout_timeout=0.05)
+    held = [pool.get_connection(), pool.get_connection()]
+
+    with pytest.raises(PoolExhaustedError):
+        pool.get_connection()
+    assert pool.stats()['timeouts'] == 1
+
+    held.pop().close()
+    pool.get_connection().close()
+
+
+def test_waiting_checkout_gets_the_released_connection():
+    pool = FakePool(1, checkout_timeout=5)
+    held = pool.get_connection()
+    timer = threading.Timer(0.05, held.close)
+    timer.start()
+
+    with pool.get_connection() as cnx:
+        assert cnx._cnx is pool.opened[0]
+    timer.join()
+    assert pool.stats()['max_wait_ms'] > 0
+
+
+def test_open_transactions_are_rolled_back_on_release():
+    pool = FakePool(1)
+    cnx = pool.get_connection()
+    cnx._cnx.in_transaction = True
+    cnx.close()
+
+    assert pool.opened[0].rollbacks == 1
+    assert not pool.opened[0].in_transaction
+
+
+def test_broken_idle_connections_are_replaced():
+    pool = FakePool(1, health_check_after=0)
+    pool.get_connection().close()
+    pool.opened[0].alive = False
+
+    with pool.get_connection() as cnx:
+        assert cnx._cnx is pool.opened[1]
+    assert pool.opened[0].closed
+    assert pool.stats()['health_check_failures'] == 1
+
+
+def test_prime_opens_at_most_the_pool_size():
+    pool = FakePool(3)
+
+    assert pool.prime(5) == 3
+    assert pool.stats()['idle'] == 3
+    assert pool.stats()['in_use'] == 0
+
+    pool.close_all()
+    assert all(cnx.closed for cnx in pool.opened)
@@ -0,0 +1,85 @@
+import csv
+import json
+
+import export_study_data
+
+
+class FakeLogDatabase:
+    """activity_logs in memory; only committed logs are visible to the export"""
+
+    def __init__(self):
+        self.logs = {}
+
+    def insert(self, log_id, user_id, text):
+        self.logs[log_id] = (log_id, user_id, 'static-context-submitted', json.dumps({'text': text}))
+
+    def cursor(self, buffered=True):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self._rows = []
+
+    def execute(self, operation, params=()):
+        statement = ' '.join(operation.split())
+        if statement.startswith('SELECT GREATEST('):
+            self._rows = [(max(self.db.logs, default=0),)]
+        elif statement.startswith('SELECT partition_name FROM activity_log_archives'):
+            self._rows = []
+        elif statement.startswith('SELECT id, user_id, activity_type, data FROM'):
+            after_id, up_to_id = params[len(export_study_data.EXPORTED_TYPES):][:2]
+            self._rows = [self.db.logs[log_id] for log_id in sorted(self.db.logs) if after_id < log_id <= up_to_id]
+        else:
+            raise AssertionError(statement)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchmany(self, size):
+        chunk, self._rows = self._rows[:size], self._rows[size:]
+        return chunk
+
+    def close(self):
+        pass
+
+
+def exported_users(out_dir):
+    with open(out_dir / 'context_submissions.csv', encoding='utf-8', newline='') as f:
+        return [row[0] for row in list(csv.reader(f))[1:]]
+
+
+def test_a_log_committed_behind_later_ids_is_exported_by_the_next_run(tmp_path):
+    db = FakeLogDatabase()
+    for log_id in range(1, 11):
+        if log_id != 8:  # log 8 is inserted by a transaction that has not committed yet
+            db.insert(log_id, f'user-{log_id}', 'text')
+
+    export_study_data.export(db, tmp_path, workers=1, chunk_size=3, margin_ids=3)
+    assert exported_users(tmp_path) == [f'user-{i}' for i in range(1, 8)]
+
+    db.insert(8, 'user-8', 'text')
+    for log_id in range(11, 15):
+        db.insert(log_id, f'user-{log_id}', 'text')
+    export_study_data.export(db, tmp_path, incremental=True, workers=1, chunk_size=3, margin_ids=3)
+
+    assert exported_users(tmp_path) == [f'user-{i}' for i in range(1, 12)]
+    assert export_study_data.load_state(tmp_path)['last_id'] == 11
+
+
+def test_margin_zero_exports_every_committed_log(tmp_path):
+    db = FakeLogDatabase()
+    for log_id in range(1, 6):
+        db.insert(log_id, f'user-{log_id}', 'text')
+    db.insert(6, 'bench_user', 'text')
+    db.insert(7, 'user-1', 'a later submission')
+
+    rows = export_study_data.export(db, tmp_path, workers=1, margin_ids=0)
+
+    assert rows['context_submissions'] == 5
+    assert exported_users(tmp_path) == [f'user-{i}' for i in range(1, 6)]
+    assert export_study_data.load_state(tmp_path)['last_id'] == 7
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import async_server
+import llm_rating
+import production_server
+
+RECIPE = ('recipe-1', 'Pasta', 'pasta, tomato', 'Boil the pasta.')
+
+
+class BlockingBackend:
+    """Counts the model calls; each call waits until `release` is set"""
+
+    def __init__(self):
+        self.model = 'blocking'
+        self.release = threading.Event()
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def chat(self, messages, options):
+        with self._lock:
+            self.calls += 1
+        self.release.wait(5)
+        return '{"score": 4, "short_review": "Looks good."}'
+
+
+def test_ratings_are_shared_by_a_user_and_not_across_users():
+    backend = BlockingBackend()
+    backend.release.set()
+    rater = llm_rating.RecipeRater(backend, max_concurrency=2)
+
+    first = rater.submit('user-a', 'unstructured_context', 'I like pasta', *RECIPE).result(5)
+    again = rater.submit('user-a', 'unstructured_context', 'I like pasta', *RECIPE).result(5)
+    other_user = rater.submit('user-b', 'unstructured_context', 'I like pasta', *RECIPE).result(5)
+
+    assert first == again == other_user == {'score': 4, 'short_review': 'Looks good.'}
+    assert backend.calls == 2
+    assert rater.stats()['cache_hits'] == 1
+
+
+def test_submissions_beyond_max_pending_are_refused():
+    backend = BlockingBackend()
+    rater = llm_rating.RecipeRater(backend, max_concurrency=1, max_pending=2)
+    try:
+        futures = [rater.submit('user', 'unstructured_context', f'context {i}', *RECIPE) for i in range(2)]
+        with pytest.raises(llm_rating.QueueFullError):
+            rater.submit('other', 'unstructured_context', 'context 2', *RECIPE)
+        # A rating that is already pending is still shared
+        assert rater.submit('user', 'unstructured_context', 'context 0', *RECIPE) is futures[0]
+        assert rater.stats()['rejected'] == 1
+    finally:
+        backend.release.set()
+
+    for future in futures:
+        future.result(5)
+    rater.submit('other', 'unstructured_context', 'context 2', *RECIPE).result(5)
+
+
+def test_fair_queue_is_bounded_and_round_robin():
+    queue = llm_rating.FairQueue(3)
+    queue.put('a', 1)
+    queue.put('a', 2)
+    queue.put('b', 3)
+    with pytest.raises(llm_rating.QueueFullError):
+        queue.put('b', 4)
+
+    assert [queue.get() for _ in range(3)] == [1, 3, 2]
+    assert len(queue) == 0
+
+
+@pytest.fixture
+def rater_full(monkeypatch):
+    def submit_llm_ratings(user_id, items):
+        raise llm_rating.QueueFullError('200 ratings pending')
+
+    monkeypatch.setattr(production_server, 'submit_llm_ratings', submit_llm_ratings)
+
+
+RATING_REQUEST = {'user_id': 'user', 'recipes': ['1'], 'context': 'I like pasta'}
+
+
+def test_a_full_rater_answers_503_with_retry_after(rater_full):
+    response = production_server.app.test_client().post('/server/api/llm/rate-recipes-static', json=RATING_REQUEST)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(production_server.LLM_RETRY_AFTER_SECONDS)
+    assert response.get_json()['success'] is False
+
+
+def test_async_server_answers_503_when_the_rater_is_full(rater_full):
+    async def rate():
+        client = TestClient(TestServer(async_server.create_app(production_server)))
+        await client.start_server()
+        try:
+            response = await client.post('/server/api/llm/rate-recipes-static', json=RATING_REQUEST)
+            return response.status, response.headers.get('Retry-After')
+        finally:
+            await client.close()
+
+    assert asyncio.run(rate()) == (503, str(production_server.LLM_RETRY_AFTER_SECONDS))
@@ -0,0 +1,176 @@
+from datetime import datetime
+
+import pytest
+from mysql.connector.errors import InterfaceError, get_mysql_exception
+
+from db_pool import PoolExhaustedError
+from log_sink import (PRUNE_BATCH_SIZE, ActivityLogSink, RecentEventIds, insert_activity_events, is_row_data_error,
+                      new_event_rows, prune_event_ids)
+
+TIMESTAMP = datetime(2025, 3, 1, 12, 30, 5)
+
+
+def event(event_id, activity_type='page_view', user_id='user'):
+    return event_id, user_id, activity_type, '{}', TIMESTAMP
+
+
+class FakeCursor:
+    """Just enough of a MySQL cursor for the event id ledger and the activity_logs inserts"""
+
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = 0
+        self._rows = []
+
+    def executemany(self, operation, params):
+        if operation.startswith('INSERT IGNORE INTO activity_log_event_ids'):
+            for event_id, token in params:
+                if event_id not in self.db.ids:
+                    self.db.pending_ids.setdefault(event_id, token)
+        elif operation.startswith('INSERT INTO activity_logs'):
+            if any(len(user_id) > 255 for user_id, *_ in params):
+                raise get_mysql_exception(1406, "Data too long for column 'user_id'", '22001')
+            self.db.pending_rows.extend(params)
+        else:
+            raise AssertionError(operation)
+
+    def execute(self, operation, params=()):
+        if operation.startswith('SELECT event_id FROM activity_log_event_ids'):
+            *ids, token = params
+            ids_by_token = {**self.db.ids, **self.db.pending_ids}
+            self._rows = [(event_id,) for event_id in ids if ids_by_token.get(event_id) == token]
+        elif operation.startswith('DELETE FROM activity_log_event_ids'):
+            self.rowcount = min(self.db.prunable, params[1])
+            self.db.prunable -= self.rowcount
+        else:
+            raise AssertionError(operation)
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, fail_insert=False):
+        self.ids, self.rows = {}, []
+        self.pending_ids, self.pending_rows = {}, []
+        self.prunable = 0
+        self.commits = 0
+        self.fail_insert = fail_insert
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        if self.fail_insert and self.pending_rows:
+            raise RuntimeError('lost connection')
+        self.ids.update(self.pending_ids)
+        self.rows.extend(self.pending_rows)
+        self.pending_ids, self.pending_rows = {}, []
+        self.commits += 1
+
+    def rollback(self):
+        self.pending_ids, self.pending_rows = {}, []
+
+    def close(self):
+        self.rollback()
+
+
+def test_new_event_rows_keeps_unidentified_events_and_first_claimed_copies():
+    events = [event(None), event('a', 'first'), event('b'), event('a', 'repeat'), event(None), event('c')]
+
+    rows = new_event_rows(events, ['a', 'c'])
+
+    assert [row[1] for row in rows] == ['page_view', 'first', 'page_view', 'page_view']
+    assert all(len(row) == 4 for row in rows)
+
+
+def test_insert_activity_events_skips_stored_and_repeated_ids():
+    cnx = FakeConnection()
+
+    assert insert_activity_events(cnx, [event('a'), event('b'), event('a'), event(None)]) == 3
+    # A replay of the same batch (crash between commit and checkpoint) only inserts the unidentified event
+    assert insert_activity_events(cnx, [event('a'), event('b'), event(None)]) == 1
+    assert insert_activity_events(cnx, [event('c')]) == 1
+
+    assert len(cnx.rows) == 5
+    assert sorted(cnx.ids) == ['a', 'b', 'c']
+
+
+def test_insert_activity_events_rolls_back_the_claims_of_a_failed_batch():
+    cnx = FakeConnection(fail_insert=True)
+
+    with pytest.raises(RuntimeError):
+        insert_activity_events(cnx, [event('a')])
+
+    assert cnx.ids == {} and cnx.rows == []
+
+
+def test_prune_event_ids_deletes_in_batches():
+    cnx = FakeConnection()
+    cnx.prunable = 25
+
+    assert prune_event_ids(cnx, batch_size=10) == 25
+    assert cnx.commits == 3
+
+    cnx.prunable = 2 * PRUNE_BATCH_SIZE + 1
+    assert prune_event_ids(cnx, max_batches=1) == PRUNE_BATCH_SIZE
+
+
+def test_recent_event_ids_turn_away_repeats_until_forgotten():
+    recent = RecentEventIds(max_size=2)
+
+    assert recent.claim('a')
+    assert not recent.claim('a')
+    assert recent.hits == 1
+
+    recent.forget(['a'])
+    assert recent.claim('a')
+
+    # The least recently seen id is dropped beyond max_size
+    recent.claim('b')
+    recent.claim('a')
+    recent.claim('c')
+    assert len(recent) == 2
+    assert recent.claim('b')
+    assert not recent.claim('c')
+
+
+def test_row_data_errors_are_told_apart_from_an_unavailable_database():
+    # Data too long, incorrect value, NULL in a NOT NULL column
+    assert is_row_data_error(get_mysql_exception(1406, 'Data too long for column', '22001'))
+    assert is_row_data_error(get_mysql_exception(1366, 'Incorrect string value', 'HY000'))
+    assert is_row_data_error(get_mysql_exception(1048, 'Column cannot be null', '23000'))
+    # Lost connection, deadlock, missing table, no connection available
+    assert not is_row_data_error(get_mysql_exception(2013, 'Lost connection', 'HY000'))
+    assert not is_row_data_error(get_mysql_exception(1213, 'Deadlock found', '40001'))
+    assert not is_row_data_error(get_mysql_exception(1146, "Table doesn't exist", '42S02'))
+    assert not is_row_data_error(InterfaceError('Not connected'))
+    assert not is_row_data_error(PoolExhaustedError('No database connection available'))
+
+
+def test_sink_drops_only_the_rows_mysql_rejects():
+    cnx = FakeConnection()
+    sink = ActivityLogSink(lambda: cnx)
+
+    assert not sink.write([event('a'), event('b', user_id='x' * 300), event(None), event('c')])
+
+    assert [row[0] for row in cnx.rows] == ['user'] * 3
+    assert sorted(cnx.ids) == ['a', 'c']
+    assert (sink.written, sink.failed) == (3, 1)
+
+
+def test_sink_does_not_retry_row_by_row_while_mysql_is_unavailable():
+    connects = []
+
+    def connect():
+        connects.append(1)
+        raise InterfaceError('Not connected')
+
+    sink = ActivityLogSink(connect)
+
+    assert not sink.write([event('a'), event('b')])
+    assert sink.failed == 2
+    assert len(connects) == 1
@@ -0,0 +1,211 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from log_spool import LogSpool, SpoolFullError, SpoolLockedError, SpoolReplayer, fcntl
+
+TIMESTAMP = datetime(2025, 3, 1, 12, 30, 5)
+
+
+def make_events(start, count):
+    return [(f'event-{i}', f'user-{i % 3}', 'recipe_viewed', '{"recipe_id": %d}' % i, TIMESTAMP)
+            for i in range(start, start + count)]
+
+
+def test_appended_events_read_back_in_order(tmp_path):
+    spool = LogSpool(str(tmp_path))
+    try:
+        events = make_events(0, 5)
+        spool.append(events[:2])
+        spool.append(events[2:])
+
+        read, position = spool.read(spool.load_checkpoint(), 100)
+
+        assert read == events
+        assert position == (spool.segments()[0], spool.pending_bytes())
+        assert spool.read(position, 100) == ([], position)
+    finally:
+        spool.close()
+
+
+def test_missing_event_ids_are_assigned(tmp_path):
+    spool = LogSpool(str(tmp_path))
+    try:
+        spool.append([(None, 'user', 'page_view', '{}', TIMESTAMP)])
+        (event,), _ = spool.read((None, 0), 10)
+    finally:
+        spool.close()
+
+    assert len(event[0]) == 32
+    assert event[1:] == ('user', 'page_view', '{}', TIMESTAMP)
+
+
+def test_segments_rotate_and_are_deleted_once_replayed(tmp_path):
+    spool = LogSpool(str(tmp_path), segment_bytes=300)
+    try:
+        for i in range(10):
+            spool.append(make_events(i, 1))
+        segments = spool.segments()
+        assert len(segments) > 2
+
+        # A read crosses segment boundaries
+        events, position = spool.read((None, 0), 10)
+        assert [event[0] for event in events] == [f'event-{i}' for i in range(10)]
+        assert position[0] == segments[-1]
+
+        remaining = spool.pending_bytes() - sum(os.path.getsize(tmp_path / name) for name in segments[:-1])
+        spool.save_checkpoint(*position)
+        assert spool.segments() == [segments[-1]]
+        assert spool.pending_bytes() == remaining
+        assert spool.load_checkpoint() == position
+    finally:
+        spool.close()
+
+
+def test_reopened_spool_skips_a_torn_line_and_appends_to_a_new_segment(tmp_path):
+    spool = LogSpool(str(tmp_path))
+    spool.append(make_events(0, 2))
+    segment = spool.active_segment()
+    spool.close()
+    with open(tmp_path / segment, 'ab') as f:
+        f.write(b'0000abcd {"event_id": "torn')
+
+    spool = LogSpool(str(tmp_path))
+    try:
+        spool.append(make_events(2, 1))
+        assert spool.active_segment() > segment
+
+        events, _ = spool.read((None, 0), 10)
+        assert [event[0] for event in events] == ['event-0', 'event-1', 'event-2']
+    finally:
+        spool.close()
+
+
+def test_corrupt_lines_are_skipped(tmp_path):
+    spool = LogSpool(str(tmp_path))
+    try:
+        spool.append(make_events(0, 1))
+        with open(tmp_path / spool.active_segment(), 'ab') as f:
+            f.write(b'00000000 {"event_id": "bad crc"}\n')
+        spool.append(make_events(1, 1))
+
+        events, _ = spool.read((None, 0), 10)
+        assert [event[0] for event in events] == ['event-0', 'event-1']
+    finally:
+        spool.close()
+
+
+def test_full_spool_rejects_appends(tmp_path):
+    spool = LogSpool(str(tmp_path), max_bytes=400)
+    try:
+        spool.append(make_events(0, 2))
+        with pytest.raises(SpoolFullError):
+            spool.append(make_events(2, 2))
+        assert spool.stats()['full_errors'] == 1
+    finally:
+        spool.close()
+
+
+@pytest.mark.skipif(fcntl is None, reason="no lock between spool users on this platform")
+def test_spool_directory_is_locked(tmp_path):
+    spool = LogSpool(str(tmp_path))
+    try:
+        with pytest.raises(SpoolLockedError):
+            LogSpool(str(tmp_path))
+    finally:
+        spool.close()
+
+
+def test_replayer_retries_a_failed_batch_and_checkpoints_after_writing(tmp_path):
+    spool = LogSpool(str(tmp_path), segment_bytes=300)
+    written = []
+    available = [False]
+
+    def write_events(events):
+        if not available[0]:
+            return False
+        written.extend(events)
+        return True
+
+    try:
+        spool.append(make_events(0, 7))
+        replayer = SpoolReplayer(spool, write_events, batch_size=3)
+
+        assert replayer.replay_once() is None
+        assert spool.load_checkpoint() == (None, 0)
+
+        available[0] = True
+        while replayer.replay_once():
+            pass
+
+        assert written == make_events(0, 7)
+        assert replayer.replayed == 7
+        assert replayer.lag() == 0
+        assert replayer.replay_once() == 0
+    finally:
+        spool.close()
+
+
+def test_replay_resumes_from_the_checkpoint_after_a_restart(tmp_path):
+    spool = LogSpool(str(tmp_path), segment_bytes=300)
+    spool.append(make_events(0, 6))
+    first = []
+    SpoolReplayer(spool, lambda events: first.extend(events) or True, batch_size=4).replay_once()
+    spool.close()
+
+    spool = LogSpool(str(tmp_path), segment_bytes=300)
+    try:
+        spool.append(make_events(6, 2))
+        rest = []
+        replayer = SpoolReplayer(spool, lambda events: rest.extend(events) or True, batch_size=4)
+        while replayer.replay_once():
+            pass
+    finally:
+        spool.close()
+
+    assert first + rest == make_events(0, 8)
+
+
+def test_a_rejected_event_is_dead_lettered_and_replay_moves_past_it(tmp_path):
+    spool = LogSpool(str(tmp_path))
+    written = []
+
+    def write_events(events):
+        if any(event[0] == 'event-2' for event in events):
+            raise ValueError('Data too long for column user_id')
+        written.extend(events)
+        return True
+
+    try:
+        spool.append(make_events(0, 5))
+        replayer = SpoolReplayer(spool, write_events, batch_size=10)
+
+        assert replayer.replay_once() == 5
+        assert [event[0] for event in written] == ['event-0', 'event-1', 'event-3', 'event-4']
+        assert spool.dead_letters() == make_events(2, 1)
+        assert spool.stats()['dead_lettered'] == 1
+        assert replayer.replay_once() == 0
+    finally:
+        spool.close()
+
+
+def test_an_outage_during_the_one_by_one_retry_keeps_the_checkpoint(tmp_path):
+    spool = LogSpool(str(tmp_path))
+    calls = []
+
+    def write_events(events):
+        calls.append(len(events))
+        if len(events) > 1:
+            raise ValueError('rejected batch')
+        return len(calls) < 3  # MySQL goes away after the first event
+
+    try:
+        spool.append(make_events(0, 3))
+        replayer = SpoolReplayer(spool, write_events, batch_size=10)
+
+        assert replayer.replay_once() is None
+        assert spool.load_checkpoint() == (None, 0)
+        assert spool.dead_letters() == []
+    finally:
+        spool.close()
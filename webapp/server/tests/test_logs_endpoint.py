@@ -0,0 +1,81 @@
+import asyncio
+import uuid
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import async_server
+import production_server
+
+
+@pytest.fixture
+def flaky_writes(monkeypatch):
+    """Spool off and a log writer whose writes fail while `available` is False; returns the written rows"""
+    state = {'available': False, 'written': []}
+
+    def write(rows):
+        if not state['available']:
+            return False
+        state['written'].extend(rows)
+        return True
+
+    monkeypatch.setattr(production_server, 'append_to_spool', lambda rows: False)
+    monkeypatch.setattr(production_server.activity_log_sink, 'write', write)
+    return state
+
+
+def event(activity_type='static-context-submitted'):
+    return {'user_id': 'user', 'type': activity_type, 'event_id': uuid.uuid4().hex, 'text': 'I cook at home'}
+
+
+def test_a_failed_write_is_reported_and_its_retry_stored(flaky_writes):
+    client = production_server.app.test_client()
+    body = event()
+
+    assert client.post('/server/api/logs', json=body).status_code == 500
+
+    flaky_writes['available'] = True
+    assert client.post('/server/api/logs', json=body).status_code == 200
+    assert [row[0] for row in flaky_writes['written']] == [body['event_id']]
+
+
+def test_a_failed_overflow_write_is_reported(flaky_writes, monkeypatch):
+    monkeypatch.setattr(production_server.activity_log_sink, 'submit', lambda row: False)
+    client = production_server.app.test_client()
+    body = event('recipe_viewed')
+
+    assert client.post('/server/api/logs', json=body).status_code == 500
+    # The event id was released, so the retry is not taken for a duplicate
+    assert production_server.recent_event_ids.claim(body['event_id'])
+
+
+def test_async_server_reports_a_failed_write(monkeypatch):
+    available = [False]
+    written = []
+
+    async def write(rows):
+        if available[0]:
+            written.extend(rows)
+        return available[0]
+
+    async def append_to_spool(state, rows):
+        return False
+
+    monkeypatch.setattr(async_server, 'append_to_spool', append_to_spool)
+    body = event()
+
+    async def post_twice():
+        app = async_server.create_app(production_server)
+        monkeypatch.setattr(app['state'].log_sink, 'write', write)
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            statuses = [(await client.post('/server/api/logs', json=body)).status]
+            available[0] = True
+            statuses.append((await client.post('/server/api/logs', json=body)).status)
+            return statuses
+        finally:
+            await client.close()
+
+    assert asyncio.run(post_twice()) == [500, 200]
+    assert [row[0] for row in written] == [body['event_id']]
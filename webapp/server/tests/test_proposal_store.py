@@ -0,0 +1,293 @@
+import asyncio
+import os
+import random
+import re
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from mysql.connector.errors import get_mysql_exception
+
+import async_proposal_store
+import proposal_store
+
+MAX_PROPOSALS = 3
+RECIPES_PER_USER = 5
+LOCK_WAIT_TIMEOUT = 0.5
+
+
+class FakeProposalDatabase:
+    """
+    The recipe_proposal_counts, recipe_proposal_leases and recipe_proposals tables in memory, with InnoDB's
+    row locks: an UPDATE locks the row until the transaction ends, and a lock wait that times out fails
+    the statement with ER_LOCK_WAIT_TIMEOUT.
+    """
+
+    def __init__(self, recipe_ids):
+        self.counts = {str(recipe_id): {'completed': 0, 'leased': 0} for recipe_id in recipe_ids}
+        self.row_locks = {recipe_id: threading.Lock() for recipe_id in self.counts}
+        self.leases = []
+        self.proposals = set()
+        self.completions = set()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self._locked = []
+        self._increments = Counter()
+        self._leases = []
+        self._proposals = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def lock_row(self, recipe_id):
+        lock = self.db.row_locks[recipe_id]
+        if lock not in self._locked:
+            if not lock.acquire(timeout=LOCK_WAIT_TIMEOUT):
+                raise get_mysql_exception(1205, 'Lock wait timeout exceeded', 'HY000')
+            self._locked.append(lock)
+
+    def commit(self):
+        with self.db.lock:
+            for (recipe_id, column), amount in self._increments.items():
+                self.db.counts[recipe_id][column] += amount
+            self.db.leases.extend(self._leases)
+            self.db.proposals.update(self._proposals)
+        self.rollback()
+
+    def rollback(self):
+        self._increments.clear()
+        self._leases, self._proposals = [], []
+        while self._locked:
+            self._locked.pop().release()
+
+    def close(self):
+        self.rollback()
+
+
+class FakeCursor:
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.db = cnx.db
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, operation, params=()):
+        statement = ' '.join(operation.split())
+        if statement.startswith('SELECT 1 FROM recipe_proposal_completions'):
+            self._rows = [(1,)] if params[0] in self.db.completions else []
+        elif statement.startswith('UPDATE recipe_proposal_counts SET'):
+            column = re.match(r'UPDATE recipe_proposal_counts SET (\w+) =', statement).group(1)
+            recipe_id = params[0]
+            self.cnx.lock_row(recipe_id)
+            with self.db.lock:
+                row = self.db.counts[recipe_id]
+                total = row['completed'] + row['leased']
+            total += self.cnx._increments[(recipe_id, 'completed')] + self.cnx._increments[(recipe_id, 'leased')]
+            # The compare of the compare-and-increment, evaluated on the locked row
+            capped = statement.endswith('AND completed + leased < %s')
+            self.rowcount = int(not capped or total < params[1])
+            if self.rowcount:
+                self.cnx._increments[(recipe_id, column)] += 1
+        elif statement.startswith('SELECT recipe_id, completed + leased FROM recipe_proposal_counts'):
+            with self.db.lock:
+                self._rows = [(recipe_id, row['completed'] + row['leased']) for recipe_id, row in self.db.counts.items()
+                              if row['completed'] + row['leased'] > 0]
+        else:
+            raise AssertionError(statement)
+
+    def executemany(self, operation, params):
+        statement = ' '.join(operation.split())
+        if statement.startswith('INSERT INTO recipe_proposal_leases'):
+            self.cnx._leases.extend(params)
+        elif statement.startswith('INSERT IGNORE INTO recipe_proposals '):
+            self.cnx._proposals.extend(params)
+        else:
+            raise AssertionError(statement)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class AsyncFakeConnection:
+    """The aiomysql interface over a FakeConnection, for async_proposal_store"""
+
+    def __init__(self, cnx):
+        self.cnx = cnx
+
+    def cursor(self):
+        return AsyncFakeCursor(self.cnx.cursor())
+
+    async def commit(self):
+        self.cnx.commit()
+
+    async def rollback(self):
+        self.cnx.rollback()
+
+
+class AsyncFakeCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, operation, params=()):
+        self.cursor.execute(operation, params)
+
+    async def executemany(self, operation, params):
+        self.cursor.executemany(operation, params)
+
+    async def fetchone(self):
+        return self.cursor.fetchone()
+
+    async def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class FakeStore:
+    def __init__(self, recipe_ids):
+        self.db = FakeProposalDatabase(recipe_ids)
+        self.connect = self.db.connect
+
+    def proposals_per_recipe(self):
+        return Counter(recipe_id for _, recipe_id, _ in self.db.proposals)
+
+    def leases(self):
+        return len(self.db.leases)
+
+
+class MySQLStore:
+    """The proposal tables of the scratch database TEST_DB_NAME, emptied first"""
+
+    def __init__(self, recipe_ids):
+        import mysql.connector
+
+        self._connect_kwargs = dict(host=os.getenv('DB_HOST', 'localhost'), user=os.getenv('DB_USER', 'root'),
+                                    password=os.getenv('DB_PWD'), database=os.environ['TEST_DB_NAME'])
+        self._mysql = mysql.connector
+        cnx = self.connect()
+        try:
+            proposal_store.ensure_proposal_schema(cnx)
+            cursor = cnx.cursor()
+            for table in ('recipe_proposal_counts', 'recipe_proposal_leases', 'recipe_proposals',
+                          'recipe_proposal_completions'):
+                cursor.execute(f"DELETE FROM {table}")
+            cnx.commit()
+            cursor.close()
+            proposal_store.ensure_recipe_rows(cnx, recipe_ids)
+        finally:
+            cnx.close()
+
+    def connect(self):
+        return self._mysql.connect(**self._connect_kwargs)
+
+    def _query(self, statement):
+        cnx = self.connect()
+        try:
+            cursor = cnx.cursor()
+            cursor.execute(statement)
+            return cursor.fetchall()
+        finally:
+            cnx.close()
+
+    def proposals_per_recipe(self):
+        return Counter({recipe_id: count for recipe_id, count in
+                        self._query("SELECT recipe_id, COUNT(*) FROM recipe_proposals GROUP BY recipe_id")})
+
+    def leases(self):
+        return self._query("SELECT COUNT(*) FROM recipe_proposal_leases")[0][0]
+
+
+@pytest.fixture(params=['memory', 'mysql'])
+def make_store(request):
+    if request.param == 'mysql' and not os.getenv('TEST_DB_NAME'):
+        pytest.skip("set TEST_DB_NAME to a scratch MySQL database to run against MySQL")
+    return FakeStore if request.param == 'memory' else MySQLStore
+
+
+def reserve_concurrently(store, recipe_ids, users, threads=32):
+    """Reserve recipes for every user from `threads` threads, each user with its own shuffled candidates"""
+
+    def fetch(user):
+        candidates = list(recipe_ids)
+        random.Random(user).shuffle(candidates)
+        cnx = store.connect()
+        try:
+            return proposal_store.reserve_recipes(
+                cnx, user, candidates, RECIPES_PER_USER, MAX_PROPOSALS, lease_minutes=10)
+        finally:
+            cnx.close()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(users, executor.map(fetch, users)))
+
+
+def test_concurrent_reservations_never_exceed_the_cap(make_store):
+    recipe_ids = [str(recipe_id) for recipe_id in range(40)]
+    store = make_store(recipe_ids)
+    # More fetches than the catalog can serve: 40 recipes * 3 proposals = 24 full fetches of 5
+    users = [f'user-{i}' for i in range(60)]
+
+    reserved = reserve_concurrently(store, recipe_ids, users)
+
+    cnx = store.connect()
+    try:
+        counts = proposal_store.read_proposal_counts(cnx)
+    finally:
+        cnx.close()
+    assert max(counts.values()) <= MAX_PROPOSALS
+    assert sum(counts.values()) == len(recipe_ids) * MAX_PROPOSALS
+
+    proposed = Counter(recipe_id for recipe_ids_of_user in reserved.values() for recipe_id in recipe_ids_of_user)
+    assert proposed == Counter(counts)
+    assert store.proposals_per_recipe() == proposed
+    assert store.leases() == sum(proposed.values())
+    assert all(len(ids) <= RECIPES_PER_USER and len(set(ids)) == len(ids) for ids in reserved.values())
+
+
+def test_reservations_keep_the_candidate_order(make_store):
+    store = make_store([str(recipe_id) for recipe_id in range(10)])
+    cnx = store.connect()
+    try:
+        reserved = proposal_store.reserve_recipes(cnx, 'user', [7, 3, 9, 1, 5, 2], 4, MAX_PROPOSALS, 10)
+    finally:
+        cnx.close()
+
+    assert reserved == ['7', '3', '9', '1']
+
+
+def test_async_reservations_share_the_cap_and_the_candidate_order():
+    store = FakeStore([str(recipe_id) for recipe_id in range(10)])
+
+    async def reserve(user):
+        cnx = AsyncFakeConnection(store.connect())
+        return await async_proposal_store.reserve_recipes(cnx, user, [7, 3, 9, 1, 5, 2], 4, 1, 10)
+
+    first = asyncio.run(reserve('first'))
+    second = asyncio.run(reserve('second'))
+
+    assert first == ['7', '3', '9', '1']
+    # With a cap of one proposal, the second user gets what is left of its candidates
+    assert second == ['5', '2']
+    assert store.leases() == 6
@@ -0,0 +1,123 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from recaptcha_client import RecaptchaVerifier, TTLCache
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('recaptcha_client.time.monotonic', lambda: now[0])
+    cache = TTLCache(ttl=10, max_size=5)
+
+    cache.set('token', 'result')
+    now[0] = 109.0
+    assert cache.get('token') == 'result'
+    now[0] = 111.0
+    assert cache.get('token') is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_the_least_recently_used_entry():
+    cache = TTLCache(ttl=60, max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+@pytest.fixture
+def siteverify():
+    """Local stand-in for Google's siteverify endpoint; answers with the `responses` of each token"""
+    responses = {}
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            token = form['response'][0]
+            requests_seen.append((form['secret'][0], token))
+            status, body = responses.get(token, (200, {'success': False}))
+            payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}/siteverify', responses, requests_seen
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_verifier(url):
+    return RecaptchaVerifier({'v3': 'secret-v3', 'v2': 'secret-v2'}, verify_url=url,
+                             connect_timeout=1, read_timeout=1)
+
+
+def test_v3_scores_below_the_threshold_require_v2(siteverify):
+    url, responses, requests_seen = siteverify
+    responses['human'] = (200, {'success': True, 'score': 0.9})
+    responses['bot'] = (200, {'success': True, 'score': 0.1})
+    verifier = make_verifier(url)
+
+    assert verifier.verify('human') == {'success': True, 'score': 0.9, 'requireV2': False}
+    assert verifier.verify('bot') == {'success': True, 'score': 0.1, 'requireV2': True}
+    assert verifier.verify('other', version='v2') == {'success': False, 'requireV2': False}
+    assert requests_seen == [('secret-v3', 'human'), ('secret-v3', 'bot'), ('secret-v2', 'other')]
+
+
+def test_a_retried_token_is_not_sent_twice(siteverify):
+    url, responses, requests_seen = siteverify
+    responses['token'] = (200, {'success': True, 'score': 0.8})
+    verifier = make_verifier(url)
+
+    first = verifier.verify('token', user_id='user')
+    assert verifier.verify('token', user_id='user') == first
+
+    assert len(requests_seen) == 1
+    assert verifier.stats()['token_cache_hits'] == 1
+
+
+def test_a_user_id_that_passed_a_check_does_not_skip_the_next_one(siteverify):
+    url, responses, requests_seen = siteverify
+    responses['token'] = (200, {'success': True, 'score': 0.8})
+    verifier = make_verifier(url)
+    verifier.verify('token', user_id='user')
+
+    # Anyone can send that user id: a new token, or the same token for another user, is verified upstream
+    assert verifier.verify('forged', user_id='user') == {'success': False, 'score': 0, 'requireV2': True}
+    responses['token'] = (200, {'success': False, 'error-codes': ['timeout-or-duplicate']})
+    assert verifier.verify('token', user_id='other')['success'] is False
+
+    assert [token for _, token in requests_seen] == ['token', 'forged', 'token']
+
+
+def test_upstream_failures_are_not_cached(siteverify):
+    url, responses, requests_seen = siteverify
+    responses['token'] = (500, b'error')
+    verifier = make_verifier(url)
+
+    assert verifier.verify('token') == {'success': False, 'score': 0, 'requireV2': True}
+    responses['token'] = (200, b'not json')
+    assert verifier.verify('token', version='v2') == {'success': False, 'requireV2': False}
+    responses['token'] = (200, {'success': True, 'score': 0.7})
+    assert verifier.verify('token')['success']
+
+    assert len(requests_seen) == 3
+    assert verifier.stats()['upstream_errors'] == 2
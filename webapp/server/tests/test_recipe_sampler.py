@@ -0,0 +1,51 @@
+from recipe_sampler import RecipeSampler
+
+
+def test_reset_places_recipes_in_the_bucket_of_their_count():
+    sampler = RecipeSampler(3)
+    sampler.reset(range(6), 'v1', {0: 1, 1: 2, 2: 3, 3: 7, 4: -1})
+
+    assert sampler.catalog_version == 'v1'
+    assert sampler.bucket_sizes() == {0: 2, 1: 1, 2: 1, 3: 2}
+
+
+def test_draw_prefers_the_fullest_non_full_bucket():
+    sampler = RecipeSampler(3)
+    sampler.reset(range(10), counts={0: 2, 1: 2, 2: 1, 3: 3})
+
+    drawn = sampler.draw(4)
+
+    assert drawn[:2] in ([0, 1], [1, 0])
+    assert drawn[2] == 2
+    assert drawn[3] in range(4, 10)
+    assert len(set(sampler.draw(100))) == 9  # recipe 3 is full
+
+
+def test_add_and_sync_move_recipes_between_buckets():
+    sampler = RecipeSampler(2)
+    sampler.reset(['a', 'b', 'c'])
+
+    sampler.add(['a', 'b', 'unknown'])
+    assert sampler.bucket_sizes() == {0: 1, 1: 2, 2: 0}
+    sampler.add(['a'], delta=5)
+    assert sampler.bucket_sizes() == {0: 1, 1: 1, 2: 1}
+    sampler.mark_full(['c'])
+    assert sampler.draw(3) == ['b']
+
+    # Recipes missing from the snapshot have count 0
+    sampler.sync({'b': 2})
+    assert sampler.bucket_sizes() == {0: 2, 1: 0, 2: 1}
+    assert sorted(sampler.draw(3)) == ['a', 'c']
+
+
+def test_swap_remove_keeps_positions_consistent():
+    sampler = RecipeSampler(4)
+    sampler.reset(range(50))
+
+    for step in range(200):
+        sampler.add([step % 50, (step * 7) % 50])
+        sampler.sync({recipe_id: (recipe_id + step) % 5 for recipe_id in range(0, 50, 3)})
+
+    for recipe_id, (bucket, index) in sampler._position.items():
+        assert sampler._buckets[bucket][index] == recipe_id
+    assert sum(sampler.bucket_sizes().values()) == 50
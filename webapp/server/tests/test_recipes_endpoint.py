@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import async_server
+import production_server
+from db_pool import PoolExhaustedError
+
+
+@pytest.fixture
+def database_down(monkeypatch):
+    """No connection can be opened; returns the activity logs written meanwhile"""
+    logged = []
+
+    def create_db_connection(db=''):
+        raise PoolExhaustedError('No database connection available')
+
+    monkeypatch.setattr(production_server, 'create_db_connection', create_db_connection)
+    monkeypatch.setattr(production_server, 'proposal_store_ready', False)
+    monkeypatch.setattr(production_server, 'log_to_activity_logs', lambda *args, **kwargs: logged.append(args))
+    return logged
+
+
+def test_unreserved_recipes_are_not_served(database_down):
+    response = production_server.app.test_client().get('/server/api/recipes', query_string={'user_id': 'user'})
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(production_server.RESERVATION_RETRY_AFTER_SECONDS)
+    assert response.get_json()['success'] is False
+    assert database_down == []
+
+
+def test_recipes_need_a_user_to_reserve_for(database_down):
+    response = production_server.app.test_client().get('/server/api/recipes')
+
+    assert response.status_code == 400
+    assert database_down == []
+
+
+def test_async_server_does_not_serve_unreserved_recipes(database_down, monkeypatch):
+    async def log_to_activity_logs(state, *args):
+        database_down.append(args)
+
+    monkeypatch.setattr(async_server, 'log_to_activity_logs', log_to_activity_logs)
+
+    async def fetch():
+        client = TestClient(TestServer(async_server.create_app(production_server)))
+        await client.start_server()
+        try:
+            missing_user = await client.get('/server/api/recipes')
+            response = await client.get('/server/api/recipes', params={'user_id': 'user'})
+            return missing_user.status, response.status, response.headers.get('Retry-After'), await response.json()
+        finally:
+            await client.close()
+
+    missing_user_status, status, retry_after, body = asyncio.run(fetch())
+
+    assert missing_user_status == 400
+    assert status == 503
+    assert retry_after == str(production_server.RESERVATION_RETRY_AFTER_SECONDS)
+    assert body['success'] is False
+    assert database_down == []
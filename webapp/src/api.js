@@ -13,14 +13,83 @@ const api = axios.create({
   }
 })
 
+const LOG_ATTEMPTS = 3
+
+/**
+ * Id sent with each logged event. A retried request reuses it, so the server stores the event once.
+ */
+export function newEventId() {
+  if (window.crypto?.randomUUID) {
+    return window.crypto.randomUUID()
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}-${Math.random().toString(36).slice(2)}`
+}
+
+/**
+ * Post a log request, retrying on timeouts and network errors (but not on error responses)
+ */
+async function postLog(url, payload) {
+  for (let attempt = 1; ; attempt++) {
+    try {
+      return await api.post(url, payload)
+    } catch (error) {
+      if (error.response || attempt >= LOG_ATTEMPTS) {
+        throw error
+      }
+    }
+  }
+}
+
+const LLM_POLL_INTERVAL = 2000
+const LLM_RATING_MAX_WAIT = 3 * 60 * 1000
+const QUESTIONNAIRE_MAX_WAIT = 15 * 60 * 1000
+
+/**
+ * Repeat a request while the server answers 202 (work in progress) or 503 (busy, retry after the
+ * Retry-After delay), for at most `maxWait` ms. `request` gets the previous 202 response (null at first);
+ * `onPending` is called with the body of each 202.
+ */
+async function pollUntilDone(request, maxWait, onPending = null) {
+  const deadline = Date.now() + maxWait
+  let response = null
+  for (;;) {
+    let delay = LLM_POLL_INTERVAL
+    try {
+      response = await request(response)
+      if (response.status !== 202) {
+        return response
+      }
+      onPending?.(response.data)
+    } catch (error) {
+      if (error.response?.status !== 503) {
+        throw error
+      }
+      delay = (Number(error.response.headers['retry-after']) || LLM_POLL_INTERVAL / 1000) * 1000
+    }
+    if (Date.now() + delay > deadline) {
+      throw new Error(`The server did not finish within ${maxWait / 1000} seconds`)
+    }
+    await new Promise(resolve => setTimeout(resolve, delay))
+  }
+}
+
+/**
+ * Post an LLM rating request until all ratings are done: the server answers 202 with the ratings
+ * finished so far and keeps working on the others, so repeating the same request picks them up
+ */
+async function postUntilRated(url, payload) {
+  return pollUntilDone(() => api.post(url, payload), LLM_RATING_MAX_WAIT)
+}
+
 /**
  * Log user activity
  */
 export async function logActivity(type, userId, data) {
   try {
-    const response = await api.post('/logs', {
+    const response = await postLog('/logs', {
       type,
       user_id: userId,
+      event_id: newEventId(),
       ...data
     })
     return response.data
@@ -30,6 +99,24 @@ export async function logActivity(type, userId, data) {
   }
 }
 
+/**
+ * Log several events of the same user with one request.
+ * Each event is an object with a `type`, an optional `timestamp` (ms since epoch or ISO string)
+ * and any additional payload fields. Events without an `event_id` get one.
+ */
+export async function logActivities(userId, events) {
+  try {
+    const response = await postLog('/logs/batch', {
+      user_id: userId,
+      events: events.map(event => ({ event_id: newEventId(), ...event }))
+    })
+    return response.data
+  } catch (error) {
+    console.error('Failed to log activities:', error)
+    return { success: false }
+  }
+}
+
 /**
  * Start a new study session
  */
@@ -55,11 +142,15 @@ export async function submitContext(userId, text) {
 /**
  * Generate FCQ and JC questionnaires using LLM
  */
-export async function generateQuestionnaires(userId, text) {
-  const response = await api.post('/llm/generate-questionnaires', {
-    user_id: userId,
-    text
-  })
+export async function generateQuestionnaires(userId, text, onProgress = null) {
+  // The server compiles the questionnaires in a background job; poll it until it has finished
+  const response = await pollUntilDone(
+    pending => pending
+      ? api.get(`/llm/generate-questionnaires/${pending.data.job_id}`)
+      : api.post('/llm/generate-questionnaires', { user_id: userId, text }),
+    QUESTIONNAIRE_MAX_WAIT,
+    onProgress
+  )
   return response.data
 }
 
@@ -89,15 +180,23 @@ export async function submitReview(userId, fcqReview, jcReview) {
 }
 
 /**
- * Get recipes for rating
+ * Get recipes for rating: id, name, image and ingredients only (see getRecipeDetails)
  */
 export async function getRecipes(userId) {
   const response = await api.get('/recipes', {
-    params: { user_id: userId }
+    params: { user_id: userId, view: 'summary' }
   })
   return response.data
 }
 
+/**
+ * Get the full recipe (directions, tags, ...). The browser caches it and revalidates it with its ETag.
+ */
+export async function getRecipeDetails(recipeId) {
+  const response = await api.get(`/recipes/${encodeURIComponent(recipeId)}`)
+  return response.data.recipe
+}
+
 /**
  * Submit recipe ratings (static context)
  */
@@ -113,7 +212,7 @@ export async function submitStaticRatings(userId, ratings) {
  * Get LLM ratings for recipes (static context)
  */
 export async function getLLMStaticRatings(userId, recipes, context) {
-  const response = await api.post('/llm/rate-recipes-static', {
+  const response = await postUntilRated('/llm/rate-recipes-static', {
     user_id: userId,
     recipes,
     context
@@ -146,7 +245,7 @@ export async function submitDynamicRatings(userId, ratings) {
  * Get LLM ratings for recipes (dynamic context)
  */
 export async function getLLMDynamicRatings(userId, ratings) {
-  const response = await api.post('/llm/rate-recipes-dynamic', {
+  const response = await postUntilRated('/llm/rate-recipes-dynamic', {
     user_id: userId,
     ratings
   })